@@ -0,0 +1,91 @@
+# Spes合规审查Agent - FAISS索引类型基准测试
+
+import argparse
+import time
+import faiss
+import numpy as np
+from shenhe import EmbeddingCache, FaissIndexFactory
+
+INDEX_TYPES = ["Flat", "HNSW", "IVFFlat", "IVFSQ8", "IVFPQ"]
+
+def load_vectors(args) -> np.ndarray:
+    """读取嵌入缓存中的真实向量，未指定时生成带聚类结构的模拟向量"""
+    if args.cache_dir:
+        cache = EmbeddingCache(args.cache_dir, args.model)
+        if not len(cache):
+            raise SystemExit(f"嵌入缓存为空: {cache.cache_dir}")
+        print(f"📂 使用嵌入缓存中的 {len(cache)} 条向量: {cache.cache_dir}")
+        return np.ascontiguousarray(cache._vectors, dtype=np.float32)
+
+    rng = np.random.default_rng(args.seed)
+    centers = rng.normal(size=(max(1, args.n // 100), args.dim)).astype(np.float32)
+    assignments = rng.integers(0, len(centers), size=args.n)
+    vectors = centers[assignments] + 0.3 * rng.normal(size=(args.n, args.dim)).astype(np.float32)
+    print(f"🧪 生成 {args.n} 条 {args.dim} 维模拟向量")
+    return vectors.astype(np.float32)
+
+def benchmark(index_type: str, vectors: np.ndarray, queries: np.ndarray, truth: np.ndarray, args) -> dict:
+    """构建索引并测量构建耗时、内存占用、查询延迟和recall@k"""
+    factory = FaissIndexFactory(index_type=index_type, recall_target=args.recall,
+                                nprobe=args.nprobe, ef_search=args.ef_search)
+    started = time.perf_counter()
+    index = factory.build(vectors)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - started
+
+    latencies = []
+    found = np.empty_like(truth)
+    for i, query in enumerate(queries):
+        started = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), args.k)
+        latencies.append(time.perf_counter() - started)
+        found[i] = ids[0]
+
+    recall = np.mean([len(set(found[i]) & set(truth[i])) / args.k for i in range(len(queries))])
+    latencies.sort()
+    return {
+        "index": index_type,
+        "params": FaissIndexFactory.describe(index),
+        "build_s": build_seconds,
+        "memory_mb": faiss.serialize_index(index).nbytes / (1 << 20),
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "recall": recall
+    }
+
+def main():
+    """运行基准测试并输出报告"""
+    parser = argparse.ArgumentParser(description="FAISS索引类型基准测试")
+    parser.add_argument("--n", type=int, default=100000, help="模拟向量数量")
+    parser.add_argument("--dim", type=int, default=256, help="模拟向量维度")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--k", type=int, default=10, help="recall@k中的k")
+    parser.add_argument("--recall", type=float, default=0.95, help="召回目标（影响默认nprobe/efSearch）")
+    parser.add_argument("--nprobe", type=int, default=None, help="IVF查询的nprobe")
+    parser.add_argument("--ef-search", type=int, default=None, help="HNSW查询的efSearch")
+    parser.add_argument("--cache-dir", default="", help="使用嵌入缓存目录中的真实向量，如 compliance_knowledge_base/embedding_cache")
+    parser.add_argument("--model", default="text-embedding-ada-002", help="嵌入缓存对应的模型标识")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = load_vectors(args)
+    rng = np.random.default_rng(args.seed + 1)
+    queries = vectors[rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)]
+    queries = queries + 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+
+    # 精确检索结果作为recall基准
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    _, truth = flat.search(queries, args.k)
+
+    print(f"\n自动选择的索引类型: {FaissIndexFactory(recall_target=args.recall).select_type(len(vectors))}")
+    print("\n" + "=" * 96)
+    print(f"{'索引':<10}{'构建(s)':>10}{'内存(MB)':>12}{'P50(ms)':>10}{'P99(ms)':>10}{f'recall@{args.k}':>12}  参数")
+    for index_type in INDEX_TYPES:
+        result = benchmark(index_type, vectors, queries, truth, args)
+        print(f"{result['index']:<10}{result['build_s']:>10.2f}{result['memory_mb']:>12.1f}"
+              f"{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}{result['recall']:>12.3f}  {result['params']}")
+    print("=" * 96)
+
+if __name__ == "__main__":
+    main()
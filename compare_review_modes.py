@@ -0,0 +1,49 @@
+# Spes合规审查Agent - 单次调用模式与两次调用模式对比
+
+import json
+import sys
+from shenhe import ComplianceAgent
+
+# 对比用的示例文本
+SAMPLE_TEXTS = [
+    "【干发喷雾】瞬间蓬松，持久留香",
+    "【多肽蓬蓬瓶】本产品能根治脱发并修复毛囊，效果立竿见影",
+    "【洗发水】温和清洁，呵护秀发健康",
+    "【面膜】深层补水，让肌肤水润光滑",
+    "【护发素】百分之百有效，彻底解决头发问题",
+    "【防脱洗发水】有助于减少脱发，改善头皮油腻",
+    "这款免洗洗发水能快速去除油光，清爽一整天"
+]
+
+def main():
+    """运行对比并输出报告"""
+    texts = SAMPLE_TEXTS
+    if len(sys.argv) > 1:
+        # 支持传入文本文件，每行一条待审查文本
+        with open(sys.argv[1], 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    
+    print("🚀 初始化Spes合规审查Agent...")
+    agent = ComplianceAgent(gating=False)
+    
+    print(f"\n📊 对比 {len(texts)} 条文本的两种审查模式...")
+    report = agent.compare_review_modes(texts)
+    
+    print("\n" + "=" * 60)
+    print("延迟（秒）：")
+    for mode, summary in report["latency"].items():
+        print(f"  {mode}: 平均 {summary['mean']} / P50 {summary['p50']} / 最大 {summary['max']}")
+    
+    print("一致性：")
+    print(f"  审核结论一致率: {report['verdict_agreement']:.1%}")
+    print(f"  产品名一致率: {report['product_agreement']:.1%}")
+    print(f"  命中词平均Jaccard: {report['mean_hit_word_jaccard']}")
+    
+    print("\n不一致的条目：")
+    for item in report["items"]:
+        if not item["verdict_agree"] or not item["product_agree"]:
+            print(json.dumps(item, ensure_ascii=False, indent=2))
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main()
@@ -4,25 +4,50 @@
 import os
 import re
 import json
+import asyncio
 import unicodedata
 import base64
-import requests
-from typing import List, Dict, Any, Optional, Tuple
-from dataclasses import dataclass
+import contextvars
+import hashlib
+import math
+import random
+import sqlite3
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+import xml.etree.ElementTree as ET
+import httpx
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Callable
+from dataclasses import asdict, dataclass, field
 from dotenv import load_dotenv
 from PIL import Image
 import cv2
+import faiss
 import numpy as np
+import tiktoken
 
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_core.prompts import PromptTemplate
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.tools import tool
 from langchain.agents import create_tool_calling_agent, AgentExecutor
 from langchain import hub
 
+try:
+    import h2  # noqa: F401  HTTP/2支持（可选依赖）
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # 文档加载器
 from langchain_community.document_loaders import (
     PyPDFLoader,
@@ -34,6 +59,40 @@ from langchain_community.document_loaders import (
 # 加载环境变量
 load_dotenv()
 
+# 通用禁用词汇（指引 一、核心法规依据与通用禁用原则）
+GENERAL_RULE_SOURCE = "指引 一、核心法规依据与通用禁用原则"
+ABSOLUTE_WORDS = ["根治", "彻底", "立竿见影", "百分之百", "完全", "绝对", "全方位", "全面", "顶级", "最", "第一", "瞬间", "永不"]
+MEDICAL_WORDS = ["毛囊", "修复", "治疗", "除菌", "抗菌", "排毒", "活化", "颠覆", "逆转", "药用", "消炎", "抗敏"]
+# 模糊语义提示词（FR-015），命中后需交由LLM判断或人工复核
+FUZZY_RISK_WORDS = ["有助于", "缓解", "改善", "减少", "减缓", "预防", "防止", "促进", "抑制", "舒缓"]
+
+# 风险等级
+RISK_LEVEL_FORBIDDEN = "绝对禁止"
+RISK_LEVEL_WARNING = "警告"
+RISK_LEVEL_GRAY = "灰色提醒"
+
+# 知识库片段的规则类别（片段元数据rule_category）
+RULE_CATEGORY_GENERAL = "通用禁用"
+RULE_CATEGORY_PRODUCT = "产品专属"
+RULE_CATEGORY_REFERENCE = "参考说明"
+
+# 产品别名 -> 规则表中的标准产品名
+PRODUCT_ALIASES = {
+    "蓬蓬瓶": "多肽蓬蓬瓶",
+    "干喷": "干发喷雾",
+    "干洗喷雾": "干发喷雾",
+    "免洗洗头水": "免洗洗发水",
+    "防脱洗头水": "防脱洗发水",
+}
+
+# 风险类别对应的简要说明
+RISK_CATEGORY_DESCRIPTIONS = {
+    "绝对化": "使用绝对化表述",
+    "医疗术语": "使用医疗术语",
+    "超范围": "超出备案功效范围",
+    "产品专属禁用": "使用产品专属禁用词汇",
+}
+
 @dataclass
 class ComplianceResult:
     """合规审查结果数据类"""
@@ -46,6 +105,748 @@ class ComplianceResult:
     rule_source: str = ""
     brief_description: str = ""
     manual_review_needed: bool = False
+    analysis_error: str = ""
+
+@dataclass
+class LexiconMatch:
+    """词库命中结果数据类"""
+    hit_word: str
+    start: int
+    end: int
+    risk_category: str
+    risk_level: str
+    rule_source: str
+    product: str = ""
+    # 未提取到产品名时命中产品专属规则，是否适用需结合上下文判断
+    needs_context: bool = False
+    
+    @property
+    def is_forbidden(self) -> bool:
+        """是否为可直接判定的绝对禁止级别命中"""
+        return self.risk_level == RISK_LEVEL_FORBIDDEN and not self.needs_context
+    
+    def to_violation(self) -> Dict[str, str]:
+        """转换为与LLM分析结果一致的违规字典"""
+        description = RISK_CATEGORY_DESCRIPTIONS.get(self.risk_category, "命中禁用词汇")
+        return {
+            "hit_word": self.hit_word,
+            "risk_category": self.risk_category,
+            "risk_level": self.risk_level,
+            "rule_source": self.rule_source,
+            "brief_description": f"{description}: {self.hit_word}"
+        }
+
+class AhoCorasickAutomaton:
+    """Aho-Corasick多模式匹配自动机，一次线性扫描找出所有模式串"""
+    
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+        self.patterns: List[str] = []
+        self._built = True
+    
+    def add_pattern(self, pattern: str) -> int:
+        """添加模式串，返回模式编号"""
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        
+        self.patterns.append(pattern)
+        pattern_id = len(self.patterns) - 1
+        self._output[node].append(pattern_id)
+        self._built = False
+        return pattern_id
+    
+    def build(self):
+        """构建失败指针（广度优先）"""
+        queue = deque()
+        for next_node in self._goto[0].values():
+            self._fail[next_node] = 0
+            queue.append(next_node)
+        
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self._goto[node].items():
+                queue.append(next_node)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_node] = self._goto[fail].get(char, 0)
+                self._output[next_node] = self._output[next_node] + self._output[self._fail[next_node]]
+        
+        self._built = True
+    
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """扫描文本，逐个产出 (起始位置, 结束位置, 模式编号)"""
+        if not self._built:
+            self.build()
+        
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for pattern_id in self._output[node]:
+                yield i + 1 - len(self.patterns[pattern_id]), i + 1, pattern_id
+
+class ComplianceLexicon:
+    """合规禁用词库 - 基于Aho-Corasick的确定性匹配，长词优先（FR-011）"""
+    
+    def __init__(self):
+        self._automaton = AhoCorasickAutomaton()
+        self._term_ids: Dict[str, int] = {}
+        self._entries: List[List[Dict[str, str]]] = []
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def add_term(self, term: str, risk_category: str, risk_level: str,
+                 rule_source: str, product: str = ""):
+        """添加禁用词，product为空表示共性禁用词"""
+        term = TextPreprocessor.preprocess(term)
+        product = TextPreprocessor.preprocess(product)
+        if not term:
+            return
+        
+        entry = {
+            "risk_category": risk_category,
+            "risk_level": risk_level,
+            "rule_source": rule_source,
+            "product": product
+        }
+        
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            term_id = self._automaton.add_pattern(term)
+            self._term_ids[term] = term_id
+            self._entries.append([])
+        
+        # 同一词汇在同一产品范围内只保留首条规则
+        if all(existing["product"] != product for existing in self._entries[term_id]):
+            self._entries[term_id].append(entry)
+    
+    def build(self):
+        """编译自动机"""
+        self._automaton.build()
+        return self
+    
+    def _select_entry(self, term_id: int, product_name: str) -> Optional[Dict[str, str]]:
+        """选择适用的规则：产品专属优先，其次共性；未提取到产品名时共性优先，再退回任一产品专属规则（FR-008/FR-009）"""
+        general = None
+        scoped = None
+        for entry in self._entries[term_id]:
+            if not entry["product"]:
+                general = general or entry
+            elif entry["product"] == product_name:
+                return entry
+            elif not product_name:
+                scoped = scoped or entry
+        return general or scoped
+    
+    def scan(self, text: str, product_name: str = "") -> List[LexiconMatch]:
+        """单次线性扫描预处理后的文本，返回互不重叠的最长命中"""
+        candidates = []
+        for start, end, term_id in self._automaton.iter_matches(text):
+            entry = self._select_entry(term_id, product_name)
+            if entry:
+                candidates.append((start, end, term_id, entry))
+        
+        # 长词优先：按长度降序贪心选取不重叠的命中
+        candidates.sort(key=lambda c: (c[0] - c[1], c[0]))
+        occupied = [False] * len(text)
+        selected = []
+        for start, end, term_id, entry in candidates:
+            if any(occupied[start:end]):
+                continue
+            for i in range(start, end):
+                occupied[i] = True
+            selected.append(LexiconMatch(
+                hit_word=self._automaton.patterns[term_id],
+                start=start,
+                end=end,
+                risk_category=entry["risk_category"],
+                risk_level=entry["risk_level"],
+                rule_source=entry["rule_source"],
+                product=entry["product"],
+                needs_context=bool(entry["product"]) and not product_name
+            ))
+        
+        selected.sort(key=lambda m: m.start)
+        return selected
+    
+    @classmethod
+    def from_default_rules(cls) -> "ComplianceLexicon":
+        """使用内置的通用禁用词汇构建词库"""
+        lexicon = cls()
+        for word in ABSOLUTE_WORDS:
+            lexicon.add_term(word, "绝对化", RISK_LEVEL_FORBIDDEN, GENERAL_RULE_SOURCE)
+        for word in MEDICAL_WORDS:
+            lexicon.add_term(word, "医疗术语", RISK_LEVEL_FORBIDDEN, GENERAL_RULE_SOURCE)
+        for word in FUZZY_RISK_WORDS:
+            lexicon.add_term(word, "超范围", RISK_LEVEL_GRAY, GENERAL_RULE_SOURCE)
+        return lexicon.build()
+
+@dataclass
+class ComplianceRule:
+    """编译后的合规规则条目"""
+    product: str
+    phrase: str
+    risk_category: str
+    risk_level: str
+    rule_source: str
+    efficacy: str = ""
+    note: str = ""
+
+class RuleTable:
+    """合规规则表 - 按产品索引的禁用词规则，product为空表示共性规则"""
+    
+    COLUMNS = ["product", "phrase", "risk_category", "risk_level", "rule_source", "efficacy", "note"]
+    
+    def __init__(self, rules: List[ComplianceRule], checksum: str = "", source: str = ""):
+        self.rules = rules
+        self.checksum = checksum
+        self.source = source
+        self._by_product: Dict[str, List[ComplianceRule]] = {}
+        for rule in rules:
+            self._by_product.setdefault(rule.product, []).append(rule)
+    
+    def __len__(self) -> int:
+        return len(self.rules)
+    
+    def products(self) -> List[str]:
+        """获取规则表中的所有产品名称"""
+        return [product for product in self._by_product if product]
+    
+    def general_rules(self) -> List[ComplianceRule]:
+        """获取共性禁用规则"""
+        return self._by_product.get("", [])
+    
+    def rules_for_product(self, product: str) -> List[ComplianceRule]:
+        """获取产品专属禁用规则"""
+        if not product:
+            return []
+        return self._by_product.get(product, [])
+    
+    def save(self, path: str):
+        """以紧凑的列式JSON保存规则表"""
+        data = {
+            "compiler_version": RuleCompiler.VERSION,
+            "checksum": self.checksum,
+            "source": self.source,
+            "compiled_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "columns": self.COLUMNS,
+            "rows": [[getattr(rule, column) for column in self.COLUMNS] for rule in self.rules]
+        }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(cls, path: str) -> Optional["RuleTable"]:
+        """加载规则表，格式版本不一致时返回None"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        
+        if data.get("compiler_version") != RuleCompiler.VERSION:
+            return None
+        
+        columns = data["columns"]
+        rules = [ComplianceRule(**dict(zip(columns, row))) for row in data["rows"]]
+        return cls(rules, checksum=data.get("checksum", ""), source=data.get("source", ""))
+
+class RuleCompiler:
+    """合规指引编译器 - 将rules.docx的章节与表格解析为规则表"""
+    
+    VERSION = 1
+    
+    WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+    SECTION_PATTERN = re.compile(r'^([一二三四五六七八九十]+)、\s*(.+)$')
+    PRODUCT_PATTERN = re.compile(r'^(\d+)、\s*([^（(]+?)\s*[（(].*备案功效')
+    # 章节下的编号小节（如"2、可仅用文献资料或研究数据说明"）与条目（"1.""（1）""-"或"类别："开头）
+    SUBSECTION_PATTERN = re.compile(r'^\d+、\s*\S')
+    ITEM_PATTERN = re.compile(r'^(\d+[.．]\s*\S|[（(]\d+[）)]|[-•·]\s*\S|[^：:，。]{1,12}[：:]\s*\S)')
+    LEVEL_PATTERN = re.compile(r'[（(](绝对禁止|警告|灰色提醒)[）)]')
+    QUOTE_CHARS = '"“”'
+    
+    # 表头名称 -> 规则字段
+    HEADER_FIELDS = {
+        "备案功效": "efficacy",
+        "禁用词汇及表述": "phrases",
+        "风险类型": "risk_types",
+        "备注": "note"
+    }
+    
+    @staticmethod
+    def file_checksum(path: str) -> str:
+        """计算文件的SHA-256校验和"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def load_or_compile(self, doc_path: str, table_path: str) -> Optional[RuleTable]:
+        """加载规则表，仅当指引文档校验和变化时重新编译"""
+        if not os.path.exists(doc_path):
+            return RuleTable.load(table_path) if os.path.exists(table_path) else None
+        
+        checksum = self.file_checksum(doc_path)
+        table = RuleTable.load(table_path) if os.path.exists(table_path) else None
+        if table is not None and table.checksum == checksum:
+            return table
+        
+        try:
+            table = self.compile_document(doc_path)
+        except Exception as e:
+            print(f"编译合规规则表失败: {e}")
+            return table
+        
+        table.save(table_path)
+        print(f"合规规则表编译完成，共 {len(table)} 条规则: {table_path}")
+        return table
+    
+    def compile_document(self, doc_path: str) -> RuleTable:
+        """编译指引文档，docx按段落与表格解析，其他格式按行解析"""
+        if doc_path.lower().endswith('.docx'):
+            blocks = self._read_docx_blocks(doc_path)
+        else:
+            with open(doc_path, 'r', encoding='utf-8') as f:
+                blocks = [("paragraph", line) for line in f.read().splitlines()]
+        
+        rules = self.compile_blocks(blocks)
+        return RuleTable(rules, checksum=self.file_checksum(doc_path), source=doc_path)
+    
+    def compile_text(self, text: str) -> List[ComplianceRule]:
+        """编译纯文本形式的指引"""
+        return self.compile_blocks([("paragraph", line) for line in text.splitlines()])
+    
+    def compile_blocks(self, blocks: List[Tuple[str, Any]]) -> List[ComplianceRule]:
+        """按文档顺序遍历段落与表格，生成规则列表"""
+        rules = []
+        section = ""
+        product = ""
+        product_heading = ""
+        general_terms = {"绝对化": set(ABSOLUTE_WORDS), "医疗术语": set(MEDICAL_WORDS)}
+        
+        for block_type, content in blocks:
+            if block_type == "table":
+                if product:
+                    rules.extend(self._compile_product_table(content, product, product_heading, general_terms))
+                continue
+            
+            text = content.strip()
+            if not text:
+                continue
+            
+            section_match = self.SECTION_PATTERN.match(text)
+            if section_match:
+                section = text
+                product = ""
+                continue
+            
+            product_match = self.PRODUCT_PATTERN.match(text)
+            if product_match:
+                product = product_match.group(2).strip()
+                product_heading = f"{product_match.group(1)}、{product}"
+                continue
+            
+            # 共性禁用原则仅从标题含"禁用"的章节中提取
+            if "禁用" not in section or product:
+                continue
+            
+            category = self._general_category(text)
+            if not category:
+                continue
+            
+            for term in self._extract_terms(text):
+                general_terms[category].add(term)
+                rules.append(ComplianceRule(
+                    product="",
+                    phrase=term,
+                    risk_category=category,
+                    risk_level=RISK_LEVEL_FORBIDDEN,
+                    rule_source=f"指引 {section}"
+                ))
+        
+        return rules
+    
+    def _compile_product_table(self, rows: List[List[str]], product: str, product_heading: str,
+                               general_terms: Dict[str, set]) -> List[ComplianceRule]:
+        """解析产品专属禁用词表格"""
+        if not rows:
+            return []
+        
+        fields = [self.HEADER_FIELDS.get(cell.strip(), "") for cell in rows[0]]
+        if "phrases" not in fields:
+            return []
+        
+        rules = []
+        for row in rows[1:]:
+            values = {field: cell.strip() for field, cell in zip(fields, row) if field}
+            efficacy = values.get("efficacy", "")
+            risk_types = [t.strip() for t in re.split(r'[/／]', values.get("risk_types", "")) if t.strip()]
+            
+            for phrase in re.split(r'[、，,；;]', values.get("phrases", "")):
+                level_match = self.LEVEL_PATTERN.search(phrase)
+                phrase = self.LEVEL_PATTERN.sub('', phrase).strip()
+                if not phrase:
+                    continue
+                
+                rules.append(ComplianceRule(
+                    product=product,
+                    phrase=phrase,
+                    risk_category=self._product_category(phrase, risk_types, general_terms),
+                    risk_level=level_match.group(1) if level_match else RISK_LEVEL_FORBIDDEN,
+                    rule_source=f"指引 {product_heading}-{efficacy}" if efficacy else f"指引 {product_heading}",
+                    efficacy=efficacy,
+                    note=values.get("note", "")
+                ))
+        
+        return rules
+    
+    @staticmethod
+    def _general_category(text: str) -> str:
+        """根据条目前缀判断共性禁用类别"""
+        prefix = re.split(r'[：:]', text, maxsplit=1)[0]
+        if len(prefix) == len(text):
+            return ""
+        for category in ("绝对化", "医疗术语"):
+            if category in prefix:
+                return category
+        return ""
+    
+    @staticmethod
+    def _product_category(phrase: str, risk_types: List[str], general_terms: Dict[str, set]) -> str:
+        """确定产品专属禁用词的风险类别，多个类型时参考共性词汇归类"""
+        if len(risk_types) > 1:
+            for category, terms in general_terms.items():
+                if category in risk_types and phrase in terms:
+                    return category
+        return risk_types[0] if risk_types else "产品专属禁用"
+    
+    def _extract_terms(self, text: str) -> List[str]:
+        """从"类别：如 "词1""词2"等"形式的条目中提取禁用词"""
+        body = re.split(r'[：:]', text, maxsplit=1)[1]
+        
+        quote_positions = [i for i, char in enumerate(body) if char in self.QUOTE_CHARS]
+        if len(quote_positions) >= 2:
+            body = body[quote_positions[0]:quote_positions[-1] + 1]
+            candidates = re.split(r'[\s、，,；;' + self.QUOTE_CHARS + r']+', body)
+        else:
+            candidates = re.split(r'[、，,；;。]', body)
+        
+        terms = []
+        for candidate in candidates:
+            term = re.sub(r'^(如|包括但不限于)', '', candidate.strip())
+            term = re.sub(r'等.*$', '', term).strip()
+            if term and len(term) <= 10 and term not in terms:
+                terms.append(term)
+        return terms
+    
+    def _read_docx_blocks(self, path: str) -> List[Tuple[str, Any]]:
+        """按文档顺序读取docx中的段落与表格"""
+        with zipfile.ZipFile(path) as archive:
+            root = ET.fromstring(archive.read('word/document.xml'))
+        
+        body = root.find(f'{self.WORD_NAMESPACE}body')
+        blocks = []
+        for element in body:
+            if element.tag == f'{self.WORD_NAMESPACE}p':
+                blocks.append(("paragraph", self._element_text(element)))
+            elif element.tag == f'{self.WORD_NAMESPACE}tbl':
+                rows = []
+                for row in element.iter(f'{self.WORD_NAMESPACE}tr'):
+                    rows.append([self._element_text(cell) for cell in row.iter(f'{self.WORD_NAMESPACE}tc')])
+                blocks.append(("table", rows))
+        return blocks
+    
+    def _element_text(self, element) -> str:
+        """拼接元素下所有文本节点"""
+        return "".join(node.text or "" for node in element.iter(f'{self.WORD_NAMESPACE}t'))
+
+class OCRCache:
+    """OCR结果缓存 - 按图片字节SHA-256精确寻址，感知哈希（dHash + pHash）匹配重新编码、
+    缩放或压缩后的同一张图片；SQLite持久化，每个模型按结果总大小分别淘汰最久未使用的条目"""
+    
+    # 感知哈希相近的候选再比对64x64灰度缩略图，像素最大差值超过该值视为不同图片
+    # （重新压缩、缩放的差值较小，改动文案会产生局部大差值）
+    THUMBNAIL_SIZE = 64
+    MAX_PIXEL_DIFF = 32
+    
+    def __init__(self, db_path: str, model_name: str, max_bytes: int = 64 << 20, max_distance: int = 4):
+        self.db_path = db_path
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        # 两种感知哈希的汉明距离都不超过该值才视为同一张图片，0表示只做精确匹配
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_results "
+            "(model TEXT NOT NULL, sha256 TEXT NOT NULL, dhash INTEGER, phash INTEGER, aspect REAL, thumbnail BLOB, "
+            "text TEXT NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL, PRIMARY KEY (model, sha256))"
+        )
+        self._db.commit()
+        
+        # 感知哈希索引常驻内存，近似查找时批量计算汉明距离；写入时追加，容量按倍数增长，前len(_keys)行有效
+        self._sizes: Dict[str, int] = {}
+        self._total_size = 0
+        self._keys: List[str] = []
+        self._hashes = np.zeros((0, 2), dtype=np.uint64)
+        self._aspects = np.zeros(0, dtype=np.float32)
+        self._load_index()
+    
+    def _load_index(self):
+        """从数据库载入当前模型的条目大小与感知哈希索引"""
+        rows = self._db.execute(
+            "SELECT sha256, dhash, phash, aspect, size FROM ocr_results WHERE model = ?", (self.model_name,)
+        ).fetchall()
+        self._sizes = {row[0]: row[4] for row in rows}
+        self._total_size = sum(self._sizes.values())
+        indexed = [row for row in rows if row[1] is not None]
+        self._keys = [row[0] for row in indexed]
+        self._hashes = np.array([[row[1], row[2]] for row in indexed], dtype=np.int64).view(np.uint64).reshape(-1, 2)
+        self._aspects = np.array([row[3] for row in indexed], dtype=np.float32)
+    
+    def _append_index(self, sha256: str, fingerprint: Tuple[int, int, float, bytes]):
+        """将新条目追加到感知哈希索引"""
+        count = len(self._keys)
+        if count == len(self._hashes):
+            capacity = max(2 * count, 64)
+            hashes = np.zeros((capacity, 2), dtype=np.uint64)
+            hashes[:count] = self._hashes[:count]
+            aspects = np.zeros(capacity, dtype=np.float32)
+            aspects[:count] = self._aspects[:count]
+            self._hashes, self._aspects = hashes, aspects
+        self._hashes[count] = np.array(fingerprint[:2], dtype=np.int64).view(np.uint64)
+        self._aspects[count] = fingerprint[2]
+        self._keys.append(sha256)
+    
+    def _remove_index(self, removed: set):
+        """从感知哈希索引中删除已淘汰的条目"""
+        keep = [i for i, key in enumerate(self._keys) if key not in removed]
+        self._keys = [self._keys[i] for i in keep]
+        self._hashes = self._hashes[keep]
+        self._aspects = self._aspects[keep]
+    
+    def __len__(self) -> int:
+        return len(self._sizes)
+    
+    @staticmethod
+    def _bits_to_int(bits: np.ndarray) -> int:
+        """将64个布尔位打包为有符号64位整数（SQLite INTEGER范围）"""
+        value = int(np.packbits(bits.astype(np.uint8)).view('>u8')[0])
+        return value - (1 << 64) if value >= 1 << 63 else value
+    
+    @classmethod
+    def fingerprint(cls, image_bytes: bytes) -> Optional[Tuple[int, int, float, bytes]]:
+        """计算图片的dHash、pHash、宽高比与灰度缩略图，无法解码时返回None"""
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None or image.size == 0:
+            return None
+        height, width = image.shape
+        
+        # dHash：9x8缩略图相邻像素的明暗梯度
+        small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+        dhash = cls._bits_to_int((small[:, 1:] > small[:, :-1]).flatten())
+        
+        # pHash：32x32缩略图DCT低频8x8系数与中位数比较
+        dct = cv2.dct(cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32))[:8, :8]
+        coefficients = dct.flatten()
+        phash = cls._bits_to_int(coefficients > np.median(coefficients[1:]))
+        
+        thumbnail = cv2.resize(image, (cls.THUMBNAIL_SIZE, cls.THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+        return dhash, phash, width / height, thumbnail.tobytes()
+    
+    def _find_near(self, fingerprint: Tuple[int, int, float, bytes]) -> Optional[Tuple[str, str]]:
+        """查找感知哈希相近、宽高比一致且缩略图逐像素接近的已缓存图片，返回(键, OCR结果)"""
+        count = len(self._keys)
+        if not count:
+            return None
+        dhash, phash, aspect, thumbnail = fingerprint
+        query = np.array([dhash, phash], dtype=np.int64).view(np.uint64)
+        distances = np.unpackbits((self._hashes[:count] ^ query).view(np.uint8).reshape(count, 2, 8), axis=2).sum(axis=2)
+        aspects = self._aspects[:count]
+        matches = (distances.max(axis=1) <= self.max_distance) & (np.abs(aspects - aspect) <= 0.02 * aspect)
+        
+        query_thumbnail = np.frombuffer(thumbnail, dtype=np.uint8).astype(np.int16)
+        for i in sorted(np.flatnonzero(matches), key=lambda i: distances[i].sum()):
+            row = self._db.execute(
+                "SELECT thumbnail, text FROM ocr_results WHERE model = ? AND sha256 = ?", (self.model_name, self._keys[i])
+            ).fetchone()
+            if row is None:
+                continue
+            diff = np.abs(np.frombuffer(row[0], dtype=np.uint8).astype(np.int16) - query_thumbnail).max()
+            if diff <= self.MAX_PIXEL_DIFF:
+                return self._keys[i], row[1]
+        return None
+    
+    def get(self, image_bytes: bytes) -> Optional[str]:
+        """读取图片的OCR结果，先按SHA-256精确匹配，再按感知哈希近似匹配，未命中返回None"""
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT text FROM ocr_results WHERE model = ? AND sha256 = ?", (self.model_name, sha256)
+            ).fetchone()
+            if row is not None:
+                self.exact_hits += 1
+                self._touch(sha256)
+                return row[0]
+        
+        # 解码与哈希计算在锁外进行
+        fingerprint = self.fingerprint(image_bytes) if self.max_distance > 0 else None
+        with self._lock:
+            match = self._find_near(fingerprint) if fingerprint else None
+            if match is not None:
+                self.near_hits += 1
+                self._touch(match[0])
+                return match[1]
+            self.misses += 1
+            return None
+    
+    def _touch(self, sha256: str):
+        """更新最近使用时间"""
+        self._db.execute(
+            "UPDATE ocr_results SET used_at = ? WHERE model = ? AND sha256 = ?", (time.time(), self.model_name, sha256)
+        )
+        self._db.commit()
+    
+    def put(self, image_bytes: bytes, text: str):
+        """写入OCR结果并按总大小淘汰最久未使用的条目"""
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+        fingerprint = self.fingerprint(image_bytes)
+        size = len(text.encode('utf-8')) + (len(fingerprint[3]) if fingerprint else 0) + 64
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO ocr_results (model, sha256, dhash, phash, aspect, thumbnail, text, size, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.model_name, sha256, *(fingerprint or (None, None, None, None)), text, size, time.time())
+            )
+            previous_size = self._sizes.get(sha256)
+            if previous_size is None and fingerprint:
+                self._append_index(sha256, fingerprint)
+            self._sizes[sha256] = size
+            self._total_size += size - (previous_size or 0)
+            
+            if self._total_size > self.max_bytes:
+                # 从当前模型最久未使用的条目开始淘汰，直到总大小回到上限以内（其他模型的条目各自计算上限）
+                evicted = set()
+                for key, entry_size in self._db.execute(
+                    "SELECT sha256, size FROM ocr_results WHERE model = ? ORDER BY used_at", (self.model_name,)
+                ).fetchall():
+                    if self._total_size <= self.max_bytes:
+                        break
+                    self._db.execute("DELETE FROM ocr_results WHERE model = ? AND sha256 = ?", (self.model_name, key))
+                    self._sizes.pop(key, None)
+                    self._total_size -= entry_size
+                    evicted.add(key)
+                self._remove_index(evicted)
+            self._db.commit()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取OCR缓存命中统计"""
+        with self._lock:
+            lookups = self.exact_hits + self.near_hits + self.misses
+            return {
+                "model": self.model_name,
+                "entries": len(self._sizes),
+                "size_bytes": self._total_size,
+                "max_bytes": self.max_bytes,
+                "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.exact_hits + self.near_hits) / lookups, 4) if lookups else 0.0
+            }
+
+class TextRegionDetector:
+    """文字区域预检 - 在本地CPU上用OpenCV MSER检测类字符区域并连成文字行，
+    判断图片是否包含文字；检测偏保守，宁可误报也不漏掉文字"""
+    
+    def __init__(self, max_side: int = 1200, min_components: int = 2):
+        # 检测前将短边缩放到max_side以内；一行至少包含min_components个互不重叠的类字符区域
+        self.max_side = max_side
+        self.min_components = min_components
+        self._mser = cv2.MSER_create()
+        self._mser.setMinArea(8)
+    
+    def detect(self, image: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        """检测文字行，返回原图坐标下的(x, y, 宽, 高)列表，无文字时返回空列表"""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        height, width = gray.shape
+        scale = min(1.0, self.max_side / min(height, width))
+        if scale < 1.0:
+            gray = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        rows, cols = gray.shape
+        self._mser.setMaxArea(max(64, rows * cols // 100))
+        _, boxes = self._mser.detectRegions(gray)
+        
+        # 保留尺寸与宽高比接近字符（或字符笔画）的区域
+        mask = np.zeros((rows, cols), dtype=np.uint8)
+        candidates = []
+        for x, y, w, h in boxes:
+            if 5 <= h <= rows * 0.5 and w <= cols * 0.5 and 0.1 <= w / h <= 8:
+                cv2.rectangle(mask, (int(x), int(y)), (int(x + w), int(y + h)), 255, -1)
+                candidates.append((int(x), int(y), int(w), int(h)))
+        
+        # 水平方向闭运算把相邻字符连成文字行，包含足够多字符的横排或竖排区域视为文字
+        lines = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 3)))
+        contours, _ = cv2.findContours(lines, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        regions = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if not (w >= 1.2 * h or h >= 3 * w):
+                continue
+            if self._count_characters(candidates, (x, y, w, h)) < self.min_components:
+                continue
+            regions.append((int(x / scale), int(y / scale), int(np.ceil(w / scale)), int(np.ceil(h / scale))))
+        return sorted(regions, key=lambda box: (box[1], box[0]))
+    
+    @staticmethod
+    def _count_characters(candidates: List[Tuple[int, int, int, int]], line: Tuple[int, int, int, int]) -> int:
+        """统计文字行内水平方向互不重叠的类字符区域数（MSER对同一字符会返回多个嵌套区域）"""
+        x0, y0, w0, h0 = line
+        spans = sorted((x, x + w) for x, y, w, h in candidates
+                       if x0 <= x and x + w <= x0 + w0 and y0 <= y and y + h <= y0 + h0)
+        count, right = 0, -1
+        for left, end in spans:
+            if left >= right:
+                count += 1
+                right = end
+            else:
+                right = min(right, end)
+        return count
+    
+    @staticmethod
+    def text_bands(regions: List[Tuple[int, int, int, int]], height: int) -> List[Tuple[int, int]]:
+        """将文字行扩展为整行宽度的横向条带（上下各留至少一个行高的边距）并合并重叠条带，
+        同一行中未被检测到的文字也包含在条带内"""
+        bands: List[List[int]] = []
+        for _, y, _, h in sorted(regions, key=lambda box: box[1]):
+            padding = max(h, 24)
+            top, bottom = max(0, y - padding), min(height, y + h + padding)
+            if bands and top <= bands[-1][1]:
+                bands[-1][1] = max(bands[-1][1], bottom)
+            else:
+                bands.append([top, bottom])
+        return [(top, bottom) for top, bottom in bands]
 
 class ImageProcessor:
     """图片处理模块 - 使用硅基流动Qwen/Qwen2.5-VL-32B-Instruct模型"""
@@ -59,18 +860,509 @@ class ImageProcessor:
         if not self.api_key:
             raise ValueError("请设置环境变量 SILICONFLOW_API_KEY")
         
-        print(f"✅ 硅基流动多模态模型已初始化: {self.model}")
+        # 共享的长连接HTTP客户端：连续识别多张图片时复用TCP/TLS连接
+        http2 = os.getenv('SILICONFLOW_HTTP2', 'false').lower() == 'true'
+        if http2 and not HTTP2_AVAILABLE:
+            print("⚠️ 未安装h2，HTTP/2不可用，使用HTTP/1.1（pip install h2）")
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.limits = httpx.Limits(
+            max_connections=int(os.getenv('SILICONFLOW_POOL_SIZE', '10')),
+            max_keepalive_connections=int(os.getenv('SILICONFLOW_POOL_SIZE', '10')),
+            keepalive_expiry=float(os.getenv('SILICONFLOW_KEEPALIVE_SECONDS', '30'))
+        )
+        self.timeout = httpx.Timeout(
+            float(os.getenv('SILICONFLOW_READ_TIMEOUT', '60')),
+            connect=float(os.getenv('SILICONFLOW_CONNECT_TIMEOUT', '5'))
+        )
+        self.client = httpx.Client(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_lifetime = None
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        
+        # OCR结果缓存：重复上传的图片不再调用多模态模型，留空路径则不缓存
+        ocr_cache_db = os.getenv('COMPLIANCE_OCR_CACHE_DB', os.path.join('compliance_knowledge_base', 'ocr_cache.db'))
+        self.ocr_cache = OCRCache(
+            ocr_cache_db,
+            self.model,
+            max_bytes=int(float(os.getenv('COMPLIANCE_OCR_CACHE_MB', '64')) * (1 << 20)),
+            max_distance=int(os.getenv('COMPLIANCE_OCR_CACHE_DISTANCE', '4'))
+        ) if ocr_cache_db else None
+        
+        # 上传前压缩图片：限制最长边、重新编码为JPEG/WebP，可选转为灰度
+        self.max_edge = int(os.getenv('COMPLIANCE_OCR_MAX_EDGE', '2048'))
+        self.min_edge = int(os.getenv('COMPLIANCE_OCR_MIN_EDGE', '768'))
+        self.image_format = os.getenv('COMPLIANCE_OCR_IMAGE_FORMAT', 'jpeg').lower()
+        if self.image_format not in self.IMAGE_ENCODERS:
+            raise ValueError(f"不支持的图片格式: {self.image_format}，可选: {', '.join(self.IMAGE_ENCODERS)}")
+        self.image_quality = int(os.getenv('COMPLIANCE_OCR_IMAGE_QUALITY', '85'))
+        self.grayscale = os.getenv('COMPLIANCE_OCR_GRAYSCALE', 'false').lower() == 'true'
+        self.original_bytes = 0
+        self.sent_bytes = 0
+        
+        # 长图切块：块高为宽度的tile_aspect倍，相邻块重叠tile_overlap比例，最多并行识别tile_workers块
+        self.tile_aspect = float(os.getenv('COMPLIANCE_OCR_TILE_ASPECT', '2.0'))
+        self.tile_overlap = float(os.getenv('COMPLIANCE_OCR_TILE_OVERLAP', '0.1'))
+        self.tile_workers = max(1, int(os.getenv('COMPLIANCE_OCR_TILE_WORKERS', '4')))
+        self.tiled_images = 0
+        self.tiles = 0
+        
+        # 文字区域预检（默认关闭）：crop 文字区域占比低于crop_ratio时只上传文字条带，未检测到文字时仍上传整张图片；
+        # skip 另外跳过未检测到文字的图片（低对比度、艺术字可能漏检，漏检的图片返回空结果）
+        self.prescreen_mode = os.getenv('COMPLIANCE_OCR_PRESCREEN', 'off').lower()
+        if self.prescreen_mode not in self.PRESCREEN_MODES:
+            raise ValueError(f"不支持的预检模式: {self.prescreen_mode}，可选: {', '.join(self.PRESCREEN_MODES)}")
+        self.text_detector = TextRegionDetector() if self.prescreen_mode != "off" else None
+        self.crop_ratio = float(os.getenv('COMPLIANCE_OCR_CROP_RATIO', '0.3'))
+        self.skipped_images = 0
+        self.cropped_images = 0
+        self.undetected_images = 0
+        
+        print(f"✅ 硅基流动多模态模型已初始化: {self.model}（连接池 {self.limits.max_connections}，"
+              f"{'HTTP/2' if self.http2 else 'HTTP/1.1'}）")
     
-    def encode_image_to_base64(self, image_path: str) -> str:
-        """将图片编码为base64"""
+    def _trace(self, event: str, info: Dict[str, Any]):
+        """统计新建的TCP连接与TLS握手，其余请求复用了连接池中的连接"""
+        if event == "connection.connect_tcp.complete":
+            with self._stats_lock:
+                self.connections += 1
+        elif event == "connection.start_tls.complete":
+            with self._stats_lock:
+                self.tls_handshakes += 1
+    
+    async def _atrace(self, event: str, info: Dict[str, Any]):
+        """异步客户端的连接统计回调"""
+        self._trace(event, info)
+    
+    async def _aget_async_client(self) -> httpx.AsyncClient:
+        """获取当前事件循环的异步客户端（连接与事件循环绑定，事件循环变化时关闭旧客户端并重新创建）"""
+        loop = asyncio.get_running_loop()
+        if self._async_client is not None and self._async_loop is not loop:
+            self._release_async_client()
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+            self._async_loop = loop
+            # 事件循环结束前（asyncio.run退出时会关闭所有异步生成器）随之关闭客户端
+            self._async_lifetime = self._async_client_lifetime(self._async_client)
+            await self._async_lifetime.__anext__()
+        return self._async_client
+    
+    @staticmethod
+    async def _async_client_lifetime(client: httpx.AsyncClient):
+        """异步客户端的生命周期，生成器被关闭时关闭客户端"""
+        try:
+            yield
+        finally:
+            await client.aclose()
+    
+    def _release_async_client(self):
+        """关闭其他事件循环创建的异步客户端"""
+        client, loop = self._async_client, self._async_loop
+        self._async_client, self._async_loop, self._async_lifetime = None, None, None
+        if client is None or client.is_closed:
+            return
+        if loop.is_closed():
+            print("⚠️ 异步HTTP客户端所属的事件循环已关闭，无法关闭其连接，请在事件循环结束前调用 aclose()")
+            return
+        try:
+            asyncio.get_running_loop()
+            in_event_loop = True
+        except RuntimeError:
+            in_event_loop = False
+        if loop.is_running() or in_event_loop:
+            # 在原事件循环上关闭（原事件循环空闲时在其下次运行时关闭）
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        else:
+            loop.run_until_complete(client.aclose())
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取HTTP连接复用统计"""
+        with self._stats_lock:
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "tls_handshakes": self.tls_handshakes,
+                "reused": max(0, self.requests - self.connections),
+                "pool_size": self.limits.max_connections,
+                "http2": self.http2,
+                "timeout": {"connect": self.timeout.connect, "read": self.timeout.read},
+                "upload": {
+                    "original_bytes": self.original_bytes,
+                    "sent_bytes": self.sent_bytes,
+                    "saved_ratio": round(1 - self.sent_bytes / self.original_bytes, 4) if self.original_bytes else 0.0
+                },
+                "tiling": {"tiled_images": self.tiled_images, "tiles": self.tiles},
+                "prescreen": {
+                    "mode": self.prescreen_mode if self.text_detector is not None else "off",
+                    "undetected_images": self.undetected_images,
+                    "skipped_images": self.skipped_images,
+                    "cropped_images": self.cropped_images
+                }
+            }
+    
+    def close(self):
+        """关闭共享HTTP客户端（异步客户端所属的事件循环仍在运行时在其上关闭）"""
+        self.client.close()
+        self._release_async_client()
+    
+    async def aclose(self):
+        """关闭共享HTTP客户端，在创建异步客户端的事件循环中调用"""
+        self.client.close()
+        if self._async_client is not None and self._async_loop is asyncio.get_running_loop():
+            lifetime = self._async_lifetime
+            self._async_client, self._async_loop, self._async_lifetime = None, None, None
+            await lifetime.aclose()
+        else:
+            self._release_async_client()
+    
+    def read_image_bytes(self, image_path: str) -> bytes:
+        """读取图片文件内容"""
         try:
             with open(image_path, 'rb') as image_file:
-                image_data = image_file.read()
-                base64_string = base64.b64encode(image_data).decode('utf-8')
-                return base64_string
+                return image_file.read()
         except Exception as e:
             raise ValueError(f"无法读取图片文件: {e}")
     
+    def encode_image_to_base64(self, image_path: str) -> str:
+        """将图片编码为base64"""
+        return base64.b64encode(self.read_image_bytes(image_path)).decode('utf-8')
+    
+    # 重新编码使用的格式：(扩展名, MIME类型, 质量参数)
+    IMAGE_ENCODERS = {
+        "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+        "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY)
+    }
+    
+    # 文字区域预检模式：关闭 / 只裁剪文字条带 / 另外跳过未检测到文字的图片
+    PRESCREEN_MODES = ("off", "crop", "skip")
+    
+    IMAGE_SIGNATURES = [
+        (b"\x89PNG\r\n\x1a\n", "image/png"),
+        (b"\xff\xd8\xff", "image/jpeg"),
+        (b"GIF87a", "image/gif"),
+        (b"GIF89a", "image/gif"),
+        (b"BM", "image/bmp")
+    ]
+    
+    @classmethod
+    def detect_mime_type(cls, image_bytes: bytes) -> str:
+        """根据文件头识别图片的MIME类型"""
+        if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+            return "image/webp"
+        for signature, mime_type in cls.IMAGE_SIGNATURES:
+            if image_bytes.startswith(signature):
+                return mime_type
+        return "image/jpeg"
+    
+    def decode_image(self, image_bytes: bytes) -> Optional[np.ndarray]:
+        """解码图片为8位数组，透明背景合成到白底，无法解码时返回None"""
+        # PNG/WebP可能带透明通道；其他格式按彩色解码（同时应用EXIF方向）
+        mime_type = self.detect_mime_type(image_bytes)
+        flags = cv2.IMREAD_UNCHANGED if mime_type in ("image/png", "image/webp") else cv2.IMREAD_COLOR
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flags)
+        if image is None or image.size == 0:
+            return None
+        
+        # 透明背景合成到白底，避免透明区域变黑与深色文字混在一起
+        if image.ndim == 3 and image.shape[2] == 4:
+            alpha = image[:, :, 3:4].astype(np.float32) / 255
+            image = (image[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8)
+        if image.dtype != np.uint8:
+            image = cv2.convertScaleAbs(image, alpha=255.0 / max(1, int(image.max())))
+        return image
+    
+    def encode_image(self, image: np.ndarray, source_mime: str = "",
+                     source_size: int = 0) -> Tuple[Optional[bytes], str, bool]:
+        """按配置缩放并重新编码图片，返回(图片内容, MIME类型, 是否缩放)，编码失败时内容为None；
+        source_mime/source_size为原图（或对应区域）的格式与字节数"""
+        if self.grayscale and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        
+        # 最长边不超过max_edge，但短边不低于min_edge（长图缩放后文字仍可辨认）
+        height, width = image.shape[:2]
+        scale = min(1.0, self.max_edge / max(height, width))
+        scale = max(scale, min(1.0, self.min_edge / min(height, width)))
+        if scale < 1.0:
+            image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+        
+        extension, mime_type, quality_flag = self.IMAGE_ENCODERS[self.image_format]
+        encoded, buffer = cv2.imencode(extension, image, [quality_flag, self.image_quality])
+        if not encoded:
+            return None, mime_type, scale < 1.0
+        payload = buffer.tobytes()
+        if source_mime == "image/png" and len(payload) * 2 > source_size:
+            # 纯色块为主的截图无损PNG可能更小（照片类PNG有损编码后已明显变小，不再尝试）
+            encoded, buffer = cv2.imencode(".png", image)
+            if encoded and len(buffer) < len(payload):
+                payload, mime_type = buffer.tobytes(), "image/png"
+        return payload, mime_type, scale < 1.0
+    
+    def prepare_image(self, image_bytes: bytes, image: Optional[np.ndarray] = None) -> Tuple[bytes, str]:
+        """压缩待上传的图片（image为已解码或裁剪后的图片），返回(图片内容, MIME类型)；
+        无法解码或压缩后不小于原图时返回原图"""
+        original = (image_bytes, self.detect_mime_type(image_bytes))
+        if image is None:
+            image = self.decode_image(image_bytes)
+        if image is None:
+            return original
+        
+        payload, mime_type, resized = self.encode_image(image, original[1], len(image_bytes))
+        if payload is None or (not resized and len(payload) >= len(image_bytes)):
+            return original
+        
+        height, width = image.shape[:2]
+        print(f"🗜️ 图片压缩: {len(image_bytes) / 1024:.0f}KB → {len(payload) / 1024:.0f}KB"
+              f"（{width}x{height}，节省 {1 - len(payload) / len(image_bytes):.0%}）")
+        return payload, mime_type
+    
+    def tile_bounds(self, height: int, width: int) -> List[Tuple[int, int]]:
+        """计算长图切块的纵向范围，相邻块重叠以免切断的文字行丢失；不需切块时返回整图"""
+        tile_height = max(1, round(width * self.tile_aspect))
+        if height <= tile_height * 1.5:
+            return [(0, height)]
+        # 块数按最小重叠计算，再均匀分布起点，使各块重叠相同
+        overlap = round(tile_height * self.tile_overlap)
+        count = math.ceil((height - overlap) / max(1, tile_height - overlap))
+        step = (height - tile_height) / (count - 1)
+        return [(round(i * step), round(i * step) + tile_height) for i in range(count)]
+    
+    def crop_text_bands(self, image: np.ndarray, bands: List[Tuple[int, int]]) -> np.ndarray:
+        """按从上到下的顺序拼接文字条带，条带之间留白分隔"""
+        separator = np.full((16,) + image.shape[1:], 255, dtype=image.dtype)
+        parts = []
+        for top, bottom in bands:
+            parts.extend([image[top:bottom], separator])
+        return np.concatenate(parts[:-1])
+    
+    def split_tiles(self, image_bytes: bytes) -> List[Tuple[bytes, str]]:
+        """压缩待上传的图片：文字区域较小时只保留文字条带，skip预检模式下未检测到文字的图片返回空列表，
+        长图切分为重叠的块分别编码，记录上传字节数"""
+        image = self.decode_image(image_bytes)
+        regions = self.text_detector.detect(image) if image is not None and self.text_detector is not None else None
+        if regions == []:
+            skip = self.prescreen_mode == "skip"
+            with self._stats_lock:
+                self.undetected_images += 1
+                self.skipped_images += skip
+            if skip:
+                print("🔍 未检测到文字区域，跳过多模态识别")
+                return []
+            print("🔍 未检测到文字区域（可能为低对比度或艺术字），仍上传整张图片识别")
+        elif regions:
+            height = image.shape[0]
+            bands = self.text_detector.text_bands(regions, height)
+            covered = sum(bottom - top for top, bottom in bands)
+            if covered < height * self.crop_ratio:
+                print(f"✂️ 文字区域占图片高度 {covered / height:.0%}，只上传 {len(bands)} 个文字条带")
+                image = self.crop_text_bands(image, bands)
+                with self._stats_lock:
+                    self.cropped_images += 1
+        
+        bounds = self.tile_bounds(*image.shape[:2]) if image is not None else [(0, 0)]
+        if len(bounds) == 1:
+            payloads = [self.prepare_image(image_bytes, image)]
+        else:
+            source_mime = self.detect_mime_type(image_bytes)
+            payloads = []
+            for top, bottom in bounds:
+                source_size = len(image_bytes) * (bottom - top) // image.shape[0]
+                payload, mime_type, _ = self.encode_image(image[top:bottom], source_mime, source_size)
+                if payload is None:
+                    payloads = [self.prepare_image(image_bytes, image)]
+                    break
+                payloads.append((payload, mime_type))
+            else:
+                height, width = image.shape[:2]
+                print(f"🧩 长图 {width}x{height} 切分为 {len(payloads)} 块（块高 {bounds[0][1]}，"
+                      f"重叠 {bounds[0][1] - bounds[1][0]}）")
+        
+        with self._stats_lock:
+            self.original_bytes += len(image_bytes)
+            self.sent_bytes += sum(len(payload) for payload, _ in payloads)
+            if len(payloads) > 1:
+                self.tiled_images += 1
+                self.tiles += len(payloads)
+        return payloads
+    
+    @staticmethod
+    def _normalize_line(line: str) -> str:
+        """归一化OCR行用于比较：去除空白与标点"""
+        return re.sub(r'[\s\W_]+', '', line)
+    
+    @classmethod
+    def _lines_match(cls, left: str, right: str) -> bool:
+        """判断两行OCR结果是否为同一行（忽略空白与标点差异；不做模糊匹配，
+        以免“含量5%”与“含量8%”这类只差一个字的相邻行被误合并）"""
+        return cls._normalize_line(left) == cls._normalize_line(right)
+    
+    @classmethod
+    def merge_tile_lines(cls, tile_texts: List[str]) -> str:
+        """拼接相邻切块的OCR结果，去除重叠区域重复识别的行；
+        块边缘被切断的行在两块中可能识别不完整，匹配时允许跳过上一块的末行与下一块的首行"""
+        merged: List[str] = []
+        for text in tile_texts:
+            lines = [line.strip() for line in text.splitlines() if line.strip()]
+            if not merged:
+                merged = lines
+                continue
+            
+            best = None
+            for count in range(min(len(merged), len(lines)), 0, -1):
+                for skip_tail in (0, 1):
+                    for skip_head in (0, 1):
+                        tail = merged[len(merged) - skip_tail - count:len(merged) - skip_tail]
+                        head = lines[skip_head:skip_head + count]
+                        if len(tail) == count == len(head) and all(map(cls._lines_match, tail, head)):
+                            best = (skip_tail, skip_head + count)
+                            break
+                    if best:
+                        break
+                if best:
+                    break
+            
+            if best:
+                # 上一块末尾被切断的行由下一块中完整的行替代
+                skip_tail, start = best
+                merged = merged[:len(merged) - skip_tail] + lines[start:]
+            else:
+                merged.extend(lines)
+        return "\n".join(merged)
+    
+    def _cached_text(self, image_bytes: bytes) -> Optional[str]:
+        """查询OCR缓存，未启用缓存或未命中返回None"""
+        if self.ocr_cache is None:
+            return None
+        text = self.ocr_cache.get(image_bytes)
+        if text is not None:
+            print(f"✅ OCR缓存命中: {text[:100]}...")
+        return text
+    
+    def _cache_text(self, image_bytes: bytes, text: str):
+        """缓存识别成功的OCR结果"""
+        if self.ocr_cache is not None and text:
+            self.ocr_cache.put(image_bytes, text)
+    
+    OCR_PROMPT = "请仔细识别这张图片中的所有文字内容。要求：1. 准确识别中文、英文、数字、符号等所有文字；2. 按照图片中的原始布局顺序输出文字；3. 保持文字的完整性和准确性；4. 特别关注产品名称、功效描述、宣传语等关键信息；5. 如果文字有特殊格式（如加粗、颜色等），请在输出中说明。请直接输出识别到的文字内容，不要添加额外的解释。"
+    
+    def _build_ocr_request(self, base64_image: str, mime_type: str = "image/jpeg") -> Tuple[Dict[str, str], Dict[str, Any]]:
+        """构建OCR请求的请求头与请求体"""
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        data = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": self.OCR_PROMPT
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{mime_type};base64,{base64_image}"
+                            }
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": 2000,
+            "temperature": 0.1
+        }
+        return headers, data
+    
+    def _parse_ocr_response(self, status_code: int, response_text: str, result: Optional[Dict[str, Any]]) -> str:
+        """解析OCR响应，返回保留换行的原始文字"""
+        if status_code == 200:
+            if result and 'choices' in result and len(result['choices']) > 0:
+                return result['choices'][0]['message']['content'].strip()
+            else:
+                print("❌ API响应格式错误")
+                return ""
+        else:
+            print(f"❌ API请求失败: {status_code} - {response_text}")
+            return ""
+    
+    @staticmethod
+    def _clean_text(extracted_text: str) -> str:
+        """清理OCR文字：合并换行与多余空格"""
+        extracted_text = extracted_text.strip()
+        extracted_text = re.sub(r'\n+', ' ', extracted_text)  # 将多个换行符替换为空格
+        extracted_text = re.sub(r'\s+', ' ', extracted_text)  # 将多个空格替换为单个空格
+        if extracted_text:
+            print(f"✅ 成功从图片提取文字: {extracted_text[:100]}...")
+        return extracted_text
+    
+    def _ocr_payload(self, payload: Tuple[bytes, str]) -> str:
+        """识别一张图片（或长图的一块），返回保留换行的原始文字"""
+        image_data, mime_type = payload
+        headers, data = self._build_ocr_request(base64.b64encode(image_data).decode('utf-8'), mime_type)
+        
+        # 发送请求（复用连接池中的长连接）
+        with self._stats_lock:
+            self.requests += 1
+        response = self.client.post(
+            f"{self.base_url}/chat/completions",
+            headers=headers,
+            json=data,
+            extensions={"trace": self._trace}
+        )
+        
+        result = response.json() if response.status_code == 200 else None
+        return self._parse_ocr_response(response.status_code, response.text, result)
+    
+    async def _aocr_payload(self, payload: Tuple[bytes, str]) -> str:
+        """异步识别一张图片（或长图的一块）"""
+        image_data, mime_type = payload
+        headers, data = self._build_ocr_request(base64.b64encode(image_data).decode('utf-8'), mime_type)
+        
+        with self._stats_lock:
+            self.requests += 1
+        client = await self._aget_async_client()
+        response = await client.post(
+            f"{self.base_url}/chat/completions",
+            headers=headers,
+            json=data,
+            extensions={"trace": self._atrace}
+        )
+        
+        result = response.json() if response.status_code == 200 else None
+        return self._parse_ocr_response(response.status_code, response.text, result)
+    
+    def _ocr_tile(self, index: int, payload: Tuple[bytes, str]) -> str:
+        """识别长图的一块，失败时返回空字符串，不影响其他块"""
+        try:
+            return self._ocr_payload(payload)
+        except Exception as e:
+            print(f"❌ 第 {index + 1} 块识别失败: {e}")
+            return ""
+    
+    async def _aocr_tile(self, index: int, payload: Tuple[bytes, str], semaphore: asyncio.Semaphore) -> str:
+        """异步识别长图的一块，并发数受信号量限制"""
+        async with semaphore:
+            try:
+                return await self._aocr_payload(payload)
+            except Exception as e:
+                print(f"❌ 第 {index + 1} 块识别失败: {e}")
+                return ""
+    
+    def _finish_tiles(self, image_bytes: bytes, tile_texts: List[str]) -> str:
+        """拼接切块结果；有块识别失败时结果不完整，不写入缓存"""
+        text = self._clean_text(self.merge_tile_lines(tile_texts) if len(tile_texts) > 1 else tile_texts[0])
+        if all(tile_texts):
+            self._cache_text(image_bytes, text)
+        else:
+            print(f"⚠️ {tile_texts.count('')}/{len(tile_texts)} 块未识别到文字，结果可能不完整")
+        return text
+    
     def extract_text_from_image(self, image_path: str) -> str:
         """使用硅基流动多模态模型从图片中提取文字"""
         try:
@@ -78,65 +1370,51 @@ class ImageProcessor:
             if not os.path.exists(image_path):
                 raise ValueError(f"图片文件不存在: {image_path}")
             
-            # 编码图片为base64
-            base64_image = self.encode_image_to_base64(image_path)
+            # 重复上传的图片直接返回缓存结果
+            image_bytes = self.read_image_bytes(image_path)
+            cached = self._cached_text(image_bytes)
+            if cached is not None:
+                return cached
             
-            # 构建请求数据
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "model": self.model,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "请仔细识别这张图片中的所有文字内容。要求：1. 准确识别中文、英文、数字、符号等所有文字；2. 按照图片中的原始布局顺序输出文字；3. 保持文字的完整性和准确性；4. 特别关注产品名称、功效描述、宣传语等关键信息；5. 如果文字有特殊格式（如加粗、颜色等），请在输出中说明。请直接输出识别到的文字内容，不要添加额外的解释。"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "max_tokens": 2000,
-                "temperature": 0.1
-            }
+            # 压缩图片，长图切块后并行识别，总耗时取决于最慢的一块
+            payloads = self.split_tiles(image_bytes)
+            if not payloads:
+                return ""
+            if len(payloads) == 1:
+                tile_texts = [self._ocr_payload(payloads[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=min(self.tile_workers, len(payloads))) as executor:
+                    tile_texts = list(executor.map(self._ocr_tile, range(len(payloads)), payloads))
+            return self._finish_tiles(image_bytes, tile_texts)
+                
+        except Exception as e:
+            print(f"❌ 图片文字提取失败: {e}")
+            return ""
+    
+    async def aextract_text_from_image(self, image_path: str) -> str:
+        """异步版本：使用异步HTTP客户端调用多模态模型提取文字"""
+        try:
+            if not os.path.exists(image_path):
+                raise ValueError(f"图片文件不存在: {image_path}")
             
-            # 发送请求
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=60  # 增加超时时间到60秒
-            )
+            # 读取图片、查询缓存与压缩切块放到线程中，避免阻塞事件循环
+            image_bytes = await asyncio.to_thread(self.read_image_bytes, image_path)
+            cached = await asyncio.to_thread(self._cached_text, image_bytes)
+            if cached is not None:
+                return cached
+            payloads = await asyncio.to_thread(self.split_tiles, image_bytes)
             
-            if response.status_code == 200:
-                result = response.json()
-                if 'choices' in result and len(result['choices']) > 0:
-                    extracted_text = result['choices'][0]['message']['content']
-                    
-                    # 清理文本
-                    extracted_text = extracted_text.strip()
-                    extracted_text = re.sub(r'\n+', ' ', extracted_text)  # 将多个换行符替换为空格
-                    extracted_text = re.sub(r'\s+', ' ', extracted_text)  # 将多个空格替换为单个空格
-                    
-                    print(f"✅ 成功从图片提取文字: {extracted_text[:100]}...")
-                    return extracted_text
-                else:
-                    print("❌ API响应格式错误")
-                    return ""
-            else:
-                print(f"❌ API请求失败: {response.status_code} - {response.text}")
+            if not payloads:
                 return ""
-                
+            if len(payloads) == 1:
+                tile_texts = [await self._aocr_payload(payloads[0])]
+            else:
+                semaphore = asyncio.Semaphore(self.tile_workers)
+                tile_texts = list(await asyncio.gather(
+                    *(self._aocr_tile(i, payload, semaphore) for i, payload in enumerate(payloads))
+                ))
+            return await asyncio.to_thread(self._finish_tiles, image_bytes, tile_texts)
+        
         except Exception as e:
             print(f"❌ 图片文字提取失败: {e}")
             return ""
@@ -186,16 +1464,13 @@ class TextPreprocessor:
         return text
 
 class ProductNameExtractor:
-    """产品名提取模块"""
+    """产品名提取模块 - 依次使用【】正则、已知产品名字典树、LLM兜底，结果带缓存"""
     
-    def __init__(self, llm: ChatOpenAI):
-        self.llm = llm
+    BRACKET_PATTERN = re.compile(r'【([^【】]+)】')
     
-    def extract_product_name(self, text: str) -> str:
-        """从文本中提取产品名称"""
-        prompt = PromptTemplate(
-            input_variables=["text"],
-            template="""
+    PROMPT = PromptTemplate(
+        input_variables=["text"],
+        template="""
 请从以下文本中提取产品名称。产品名称通常出现在方括号【】中，或者是文本开头的主要产品标识。
 
 文本：{text}
@@ -204,23 +1479,148 @@ class ProductNameExtractor:
 
 产品名称：
 """
-        )
+    )
+    
+    def __init__(self, llm: ChatOpenAI, knowledge_base=None, use_llm_fallback: bool = True,
+                 cache_size: int = 1024):
+        self.llm = llm
+        self.knowledge_base = knowledge_base
+        self.use_llm_fallback = use_llm_fallback
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        
+        # 已知产品名及别名的字典树，随规则表变化重建
+        self._product_automaton: Optional[AhoCorasickAutomaton] = None
+        self._canonical_names: List[str] = []
+        self._rule_table_checksum = None
+    
+    @classmethod
+    def extract_bracketed_product_name(cls, text: str) -> str:
+        """不调用LLM，直接读取【】中的产品名称"""
+        match = cls.BRACKET_PATTERN.search(text)
+        return match.group(1).strip() if match else ""
+    
+    def _known_product_names(self) -> List[str]:
+        """获取规则表中的已知产品名"""
+        rule_table = getattr(self.knowledge_base, "rule_table", None)
+        return rule_table.products() if rule_table else []
+    
+    def _ensure_product_automaton(self):
+        """规则表变化时重建产品名字典树并清空缓存"""
+        rule_table = getattr(self.knowledge_base, "rule_table", None)
+        checksum = rule_table.checksum if rule_table else ""
+        if self._product_automaton is not None and checksum == self._rule_table_checksum:
+            return
+        
+        automaton = AhoCorasickAutomaton()
+        canonical_names = []
+        names = {name: name for name in self._known_product_names()}
+        for alias, name in PRODUCT_ALIASES.items():
+            names.setdefault(alias, name)
+        
+        for name, canonical in names.items():
+            automaton.add_pattern(TextPreprocessor.preprocess(name))
+            canonical_names.append(canonical)
+        automaton.build()
+        
+        self._product_automaton = automaton
+        self._canonical_names = canonical_names
+        self._rule_table_checksum = checksum
+        self._cache.clear()
+    
+    def match_known_product(self, text: str) -> str:
+        """在文本中查找最长的已知产品名或别名，返回标准产品名"""
+        self._ensure_product_automaton()
+        matches = list(self._product_automaton.iter_matches(text))
+        if not matches:
+            return ""
+        
+        # 长名优先，长度相同时取最靠前的
+        start, end, pattern_id = max(matches, key=lambda m: (m[1] - m[0], -m[0]))
+        return self._canonical_names[pattern_id]
+    
+    def _extract_locally(self, text: str) -> Optional[str]:
+        """本地提取产品名：命中缓存或本地规则时返回结果，否则返回None"""
+        self._ensure_product_automaton()
+        if text in self._cache:
+            self._cache.move_to_end(text)
+            return self._cache[text]
+        
+        # 1. 【】中的产品名，若为已知产品的别名则归一为标准名
+        product_name = self.extract_bracketed_product_name(text)
+        if product_name:
+            product_name = self.match_known_product(product_name) or product_name
+        
+        # 2. 在全文中匹配已知产品名及别名
+        if not product_name:
+            product_name = self.match_known_product(text)
+        
+        if product_name:
+            self._remember(text, product_name)
+            return product_name
+        return None
+    
+    def _remember(self, text: str, product_name: str):
+        """写入提取结果缓存"""
+        self._cache[text] = product_name
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    def extract_product_name(self, text: str, allow_llm: Optional[bool] = None) -> str:
+        """从文本中提取产品名称"""
+        product_name = self._extract_locally(text)
+        if product_name is not None:
+            return product_name
+        
+        # 3. LLM兜底
+        if allow_llm is None:
+            allow_llm = self.use_llm_fallback
+        if not allow_llm:
+            return ""
         
         try:
-            response = self.llm.invoke(prompt.format(text=text))
-            product_name = response.content.strip()
-            
-            # 清理结果
-            if product_name == "未识别" or not product_name:
-                return ""
-            
-            # 移除可能的引号或其他符号
-            product_name = re.sub(r'["""]', '', product_name)
+            response = self.llm.invoke(self.PROMPT.format(text=text))
+            product_name = self._clean_llm_product_name(response.content)
+        except Exception as e:
+            print(f"产品名提取失败: {e}")
+            return ""
+        
+        self._remember(text, product_name)
+        return product_name
+    
+    async def aextract_product_name(self, text: str, allow_llm: Optional[bool] = None) -> str:
+        """异步版本：本地提取未命中时使用ainvoke调用LLM"""
+        product_name = self._extract_locally(text)
+        if product_name is not None:
             return product_name
-            
+        
+        if allow_llm is None:
+            allow_llm = self.use_llm_fallback
+        if not allow_llm:
+            return ""
+        
+        try:
+            response = await self.llm.ainvoke(self.PROMPT.format(text=text))
+            product_name = self._clean_llm_product_name(response.content)
         except Exception as e:
             print(f"产品名提取失败: {e}")
             return ""
+        
+        self._remember(text, product_name)
+        return product_name
+    
+    @staticmethod
+    def _clean_llm_product_name(content: str) -> str:
+        """清理LLM返回的产品名称"""
+        product_name = content.strip()
+        
+        # 清理结果
+        if product_name == "未识别" or not product_name:
+            return ""
+        
+        # 移除可能的引号或其他符号
+        product_name = re.sub(r'["""]', '', product_name)
+        return product_name
 
 class DocumentUploader:
     """文档上传处理器"""
@@ -298,23 +1698,986 @@ class DocumentUploader:
                 print(f"跳过文件 {file_path}: {e}")
                 continue
         
-        return all_documents
+        return all_documents
+
+class EmbeddingCache:
+    """持久化嵌入缓存 - 按(嵌入模型, 文本哈希)寻址，向量以float32连续存储"""
+    
+    def __init__(self, cache_dir: str, model_name: str):
+        self.model_name = model_name
+        model_slug = re.sub(r'[^0-9A-Za-z._-]+', '_', model_name)
+        self.cache_dir = os.path.join(cache_dir, model_slug)
+        self.vectors_path = os.path.join(self.cache_dir, "vectors.f32")
+        self.keys_path = os.path.join(self.cache_dir, "keys.idx")
+        self.meta_path = os.path.join(self.cache_dir, "meta.json")
+        
+        self.dimension = 0
+        self._rows: Dict[str, int] = {}
+        # 向量写入预分配的缓冲区（容量按倍数增长），_vectors为已用部分的视图
+        self._buffer = np.zeros((0, 0), dtype=np.float32)
+        self._vectors = self._buffer
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+    
+    def __len__(self) -> int:
+        return len(self._rows)
+    
+    def make_key(self, text: str) -> str:
+        """生成缓存键：嵌入模型 + 文本内容的SHA-256"""
+        return hashlib.sha256(f"{self.model_name}\x1f{text}".encode('utf-8')).hexdigest()
+    
+    def _load(self):
+        """加载索引与向量文件，以两者中较短的一方为准（容忍写入中断）"""
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.dimension = int(json.load(f)["dimension"])
+            with open(self.keys_path, 'r', encoding='utf-8') as f:
+                keys = f.read().split()
+            vectors = np.fromfile(self.vectors_path, dtype=np.float32)
+        except (OSError, ValueError, KeyError):
+            return
+        
+        if not self.dimension:
+            return
+        
+        row_count = min(len(keys), vectors.size // self.dimension)
+        self._buffer = vectors[:row_count * self.dimension].reshape(row_count, self.dimension)
+        self._vectors = self._buffer
+        self._rows = {key: row for row, key in enumerate(keys[:row_count])}
+    
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """批量读取向量，未命中的位置返回None"""
+        with self._lock:
+            found = []
+            for key in keys:
+                row = self._rows.get(key)
+                if row is None:
+                    self.misses += 1
+                    found.append(None)
+                else:
+                    self.hits += 1
+                    found.append(self._vectors[row])
+            return found
+    
+    def put_many(self, keys: List[str], vectors: List[List[float]]):
+        """追加写入新向量"""
+        with self._lock:
+            new_items = [(key, vector) for key, vector in zip(keys, vectors) if key not in self._rows]
+            if not new_items:
+                return
+            
+            array = np.asarray([vector for _, vector in new_items], dtype=np.float32)
+            if not self.dimension:
+                self.dimension = array.shape[1]
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(self.meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({"model": self.model_name, "dimension": self.dimension}, f)
+                self._buffer = np.zeros((0, self.dimension), dtype=np.float32)
+                self._vectors = self._buffer
+            
+            if array.shape[1] != self.dimension:
+                print(f"嵌入维度不一致，跳过缓存写入: {array.shape[1]} != {self.dimension}")
+                return
+            
+            # 先写向量再写索引，中断时多出的向量会在加载时被忽略
+            with open(self.vectors_path, 'ab') as f:
+                array.tofile(f)
+            with open(self.keys_path, 'a', encoding='utf-8') as f:
+                f.write("".join(f"{key}\n" for key, _ in new_items))
+            
+            start = len(self._rows)
+            end = start + len(array)
+            if end > len(self._buffer):
+                buffer = np.empty((max(end, 2 * len(self._buffer), 1024), self.dimension), dtype=np.float32)
+                buffer[:start] = self._vectors
+                self._buffer = buffer
+            self._buffer[start:end] = array
+            self._vectors = self._buffer[:end]
+            for offset, (key, _) in enumerate(new_items):
+                self._rows[key] = start + offset
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计"""
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "entries": len(self._rows),
+                "dimension": self.dimension,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+class QueryEmbeddingCache:
+    """查询嵌入缓存 - 按(嵌入模型, 归一化查询)寻址的内存LRU + 可选SQLite持久层"""
+    
+    def __init__(self, model_name: str, max_entries: int = 4096, db_path: str = ""):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+        # 持久层批量维护：命中时间攒够一批或下次写入时再落盘，磁盘条目超出上限batch_size条后才淘汰
+        self.batch_size = max(16, max_entries // 8)
+        self._touched: Dict[str, float] = {}
+        self._db_rows = 0
+        
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings "
+                "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.commit()
+            self._db_rows = self._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+            # 按最近使用顺序载入，最久未使用的条目在前
+            rows = self._db.execute(
+                "SELECT key, vector FROM query_embeddings ORDER BY used_at DESC LIMIT ?", (max_entries,)
+            ).fetchall()
+            for key, blob in reversed(rows):
+                self._entries[key] = np.frombuffer(blob, dtype=np.float32)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """归一化查询文本：折叠空白"""
+        return " ".join(text.split())
+    
+    def make_key(self, text: str) -> str:
+        """生成缓存键：嵌入模型 + 归一化查询的SHA-256"""
+        return hashlib.sha256(f"{self.model_name}\x1f{self.normalize(text)}".encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """读取查询向量，未命中返回None"""
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if self._db is not None:
+                self._touched[key] = time.time()
+                if len(self._touched) >= self.batch_size:
+                    self._flush_touched()
+                    self._db.commit()
+            return vector
+    
+    def put(self, key: str, vector: List[float]):
+        """写入查询向量并淘汰最久未使用的条目"""
+        array = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            is_new = key not in self._entries
+            self._entries[key] = array
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            
+            if self._db is not None:
+                self._touched.pop(key, None)
+                self._flush_touched()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (key, vector, used_at) VALUES (?, ?, ?)",
+                    (key, array.tobytes(), time.time())
+                )
+                # 内存中已淘汰的键重新写入时会多计一条，计数只作为上界，淘汰后重新统计
+                self._db_rows += is_new
+                if self._db_rows > self.max_entries + self.batch_size:
+                    self._db.execute(
+                        "DELETE FROM query_embeddings WHERE key NOT IN "
+                        "(SELECT key FROM query_embeddings ORDER BY used_at DESC LIMIT ?)", (self.max_entries,)
+                    )
+                    self._db_rows = self._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+                self._db.commit()
+    
+    def _flush_touched(self):
+        """将命中时间写入持久层，重启后按最近使用顺序载入（调用方持有锁并提交）"""
+        if self._touched:
+            self._db.executemany(
+                "UPDATE query_embeddings SET used_at = ? WHERE key = ?",
+                [(used_at, key) for key, used_at in self._touched.items()]
+            )
+            self._touched.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存命中统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model_name,
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "persistent": self._db is not None
+            }
+
+class EmbeddingPipeline:
+    """批量嵌入管线 - 分批并行请求上游，限制并发与速率，失败按指数退避重试；
+    每个完成的批次立即写入嵌入缓存作为断点，中断后重新构建只嵌入剩余批次"""
+    
+    def __init__(self, base_embeddings: Embeddings, cache: EmbeddingCache, batch_size: int = 64,
+                 max_workers: int = 4, requests_per_minute: float = 0, max_retries: int = 5,
+                 backoff_seconds: float = 1.0):
+        self.base_embeddings = base_embeddings
+        self.cache = cache
+        self.batch_size = max(1, batch_size)
+        self.max_workers = max(1, max_workers)
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._rate_lock = threading.Lock()
+        self._next_request_at = 0.0
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.embedded_texts = 0
+        self.last_run: Dict[str, Any] = {}
+    
+    def _wait_for_rate_limit(self):
+        """按每分钟请求数限制控制请求间隔"""
+        if self.requests_per_minute <= 0:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + 60.0 / self.requests_per_minute
+        if wait > 0:
+            time.sleep(wait)
+    
+    def _embed_batch(self, keys: List[str], texts: List[str]) -> int:
+        """嵌入一个批次并写入缓存，失败时指数退避（带随机抖动）重试"""
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit()
+            try:
+                vectors = self.base_embeddings.embed_documents(texts)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_seconds * (2 ** attempt) * (0.5 + random.random())
+                with self._stats_lock:
+                    self.retries += 1
+                print(f"⚠️ 嵌入批次失败（第 {attempt + 1} 次），{delay:.1f}s 后重试: {e}")
+                time.sleep(delay)
+        
+        # 统一为float32精度，保证首次构建与缓存命中的结果一致
+        self.cache.put_many(keys, np.asarray(vectors, dtype=np.float32).tolist())
+        with self._stats_lock:
+            self.requests += 1
+            self.embedded_texts += len(texts)
+        return len(texts)
+    
+    def embed(self, texts: List[str], progress: Optional[Callable[[int, int], None]] = None) -> np.ndarray:
+        """嵌入文本，命中缓存的文本不再请求上游；progress(已完成数, 待嵌入总数)报告进度"""
+        if not texts:
+            return np.empty((0, self.cache.dimension), dtype=np.float32)
+        keys = [self.cache.make_key(text) for text in texts]
+        
+        # 未命中的文本去重后分批
+        missing: Dict[str, str] = {}
+        for key, text, vector in zip(keys, texts, self.cache.get_many(keys)):
+            if vector is None:
+                missing.setdefault(key, text)
+        
+        if missing:
+            self._embed_missing(missing, len(texts), progress)
+        
+        vectors = self.cache.get_many(keys)
+        if any(vector is None for vector in vectors):
+            raise RuntimeError("嵌入结果未能写入缓存")
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+    
+    def _embed_missing(self, missing: Dict[str, str], total: int, progress: Optional[Callable[[int, int], None]]):
+        """并行嵌入未命中的文本"""
+        items = list(missing.items())
+        batches = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+        print(f"嵌入缓存未命中 {len(items)}/{total} 个片段，分 {len(batches)} 批请求上游嵌入...")
+        
+        started = time.perf_counter()
+        done = 0
+        reported = 0
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            futures = [
+                executor.submit(self._embed_batch, [key for key, _ in batch], [text for _, text in batch])
+                for batch in batches
+            ]
+            try:
+                for future in as_completed(futures):
+                    done += future.result()
+                    if progress:
+                        progress(done, len(items))
+                    # 大批量时每完成约10%输出一次吞吐
+                    if len(batches) > 1 and (done == len(items) or done - reported >= len(items) / 10):
+                        reported = done
+                        elapsed = time.perf_counter() - started
+                        print(f"嵌入进度 {done}/{len(items)}，{done / elapsed if elapsed else 0:.1f} 片段/秒")
+            except Exception:
+                # 已完成批次已写入缓存，重新构建时从断点继续
+                for future in futures:
+                    future.cancel()
+                print(f"❌ 嵌入中断，已完成 {done}/{len(items)} 个片段已保存，重新构建时将从断点继续")
+                raise
+        
+        elapsed = time.perf_counter() - started
+        self.last_run = {
+            "texts": len(items),
+            "batches": len(batches),
+            "seconds": round(elapsed, 3),
+            "texts_per_second": round(len(items) / elapsed, 1) if elapsed else 0.0
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取嵌入管线统计"""
+        with self._stats_lock:
+            return {
+                "batch_size": self.batch_size,
+                "max_workers": self.max_workers,
+                "requests_per_minute": self.requests_per_minute,
+                "requests": self.requests,
+                "retries": self.retries,
+                "embedded_texts": self.embedded_texts,
+                "last_run": dict(self.last_run)
+            }
+
+class CachedEmbeddings(Embeddings):
+    """带持久化缓存的嵌入模型包装，仅将未缓存的文本发送到上游"""
+    
+    def __init__(self, base_embeddings: Embeddings, cache: EmbeddingCache,
+                 query_cache: Optional[QueryEmbeddingCache] = None, pipeline: Optional[EmbeddingPipeline] = None):
+        self.base_embeddings = base_embeddings
+        self.cache = cache
+        self.query_cache = query_cache
+        self.pipeline = pipeline or EmbeddingPipeline(base_embeddings, cache)
+    
+    @staticmethod
+    def model_name_of(embeddings: Embeddings) -> str:
+        """获取嵌入模型标识（模型名 + 输出维度）"""
+        model = getattr(embeddings, "model", None) or type(embeddings).__name__
+        dimensions = getattr(embeddings, "dimensions", None)
+        return f"{model}-{dimensions}" if dimensions else str(model)
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """嵌入文档，命中缓存的文本不再请求上游，未命中的文本经嵌入管线分批并行请求"""
+        return self.pipeline.embed(texts).tolist()
+    
+    def embed_query(self, text: str) -> List[float]:
+        """嵌入查询，相同查询命中缓存时不请求上游"""
+        if self.query_cache is None:
+            return self.base_embeddings.embed_query(text)
+        
+        key = self.query_cache.make_key(text)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = np.asarray(self.base_embeddings.embed_query(text), dtype=np.float32)
+            self.query_cache.put(key, vector)
+        return vector.tolist()
+    
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """批量嵌入查询，未命中缓存的查询去重后合并为一次上游请求"""
+        if self.query_cache is None:
+            return self.base_embeddings.embed_documents(texts)
+        
+        keys = [self.query_cache.make_key(text) for text in texts]
+        cached = [self.query_cache.get(key) for key in keys]
+        
+        missing: Dict[str, str] = {}
+        for key, text, vector in zip(keys, texts, cached):
+            if vector is None:
+                missing.setdefault(key, text)
+        
+        new_vectors: Dict[str, np.ndarray] = {}
+        if missing:
+            vectors = np.asarray(self.base_embeddings.embed_documents(list(missing.values())), dtype=np.float32)
+            for key, vector in zip(missing.keys(), vectors):
+                self.query_cache.put(key, vector)
+                new_vectors[key] = vector
+        
+        return [
+            (vector if vector is not None else new_vectors[key]).tolist()
+            for key, vector in zip(keys, cached)
+        ]
+    
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """异步嵌入文档"""
+        return await asyncio.to_thread(self.embed_documents, texts)
+    
+    async def aembed_query(self, text: str) -> List[float]:
+        """异步嵌入查询"""
+        if self.query_cache is None:
+            return await self.base_embeddings.aembed_query(text)
+        
+        key = self.query_cache.make_key(text)
+        vector = await asyncio.to_thread(self.query_cache.get, key)
+        if vector is None:
+            vector = np.asarray(await self.base_embeddings.aembed_query(text), dtype=np.float32)
+            await asyncio.to_thread(self.query_cache.put, key, vector)
+        return vector.tolist()
+
+class LexicalIndex:
+    """字符n-gram BM25词法索引 - 中文无需分词，检索全程在本地完成"""
+    
+    VERSION = 1
+    
+    def __init__(self, ngram_sizes: Tuple[int, ...] = (2, 3), k1: float = 1.5, b: float = 0.75):
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.k1 = k1
+        self.b = b
+        self.doc_ids: List[str] = []
+        self.doc_lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._idf: Dict[str, float] = {}
+        self._avg_length = 0.0
+    
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+    
+    def tokenize(self, text: str) -> List[str]:
+        """预处理后去除空白，生成字符二元与三元组"""
+        chars = "".join(TextPreprocessor.preprocess(text).split())
+        tokens = []
+        for size in self.ngram_sizes:
+            tokens.extend(chars[i:i + size] for i in range(len(chars) - size + 1))
+        # 短于最小n的文本退化为单字
+        return tokens or list(chars)
+    
+    @classmethod
+    def from_documents(cls, documents: Dict[str, Document], **kwargs) -> "LexicalIndex":
+        """由 片段ID -> 文档 构建索引"""
+        index = cls(**kwargs)
+        for doc_id, doc in documents.items():
+            term_counts: Dict[str, int] = {}
+            tokens = index.tokenize(doc.page_content)
+            for token in tokens:
+                term_counts[token] = term_counts.get(token, 0) + 1
+            
+            doc_index = len(index.doc_ids)
+            index.doc_ids.append(doc_id)
+            index.doc_lengths.append(len(tokens))
+            for term, count in term_counts.items():
+                index.postings.setdefault(term, []).append((doc_index, count))
+        
+        index._prepare()
+        return index
+    
+    def _prepare(self):
+        """计算IDF与平均文档长度"""
+        doc_count = len(self.doc_ids)
+        self._avg_length = sum(self.doc_lengths) / doc_count if doc_count else 0.0
+        self._idf = {
+            term: math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+    
+    def search(self, query: str, k: Optional[int] = None) -> List[Tuple[str, float]]:
+        """BM25检索，返回按得分降序的(片段ID, 得分)，k为None时返回全部命中"""
+        scores: Dict[int, float] = {}
+        for term in set(self.tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self._idf[term]
+            for doc_index, count in postings:
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_index] / (self._avg_length or 1.0)
+                scores[doc_index] = scores.get(doc_index, 0.0) + idf * count * (self.k1 + 1) / (count + self.k1 * length_norm)
+        
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        if k is not None:
+            ranked = ranked[:k]
+        return [(self.doc_ids[doc_index], score) for doc_index, score in ranked]
+    
+    def save(self, path: str):
+        """保存索引"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "version": self.VERSION,
+                "ngram_sizes": list(self.ngram_sizes),
+                "k1": self.k1,
+                "b": self.b,
+                "doc_ids": self.doc_ids,
+                "doc_lengths": self.doc_lengths,
+                "postings": self.postings
+            }, f, ensure_ascii=False)
+    
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        """加载索引，文件不存在或版本不一致时返回None"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != cls.VERSION:
+            return None
+        
+        index = cls(tuple(data["ngram_sizes"]), data["k1"], data["b"])
+        index.doc_ids = data["doc_ids"]
+        index.doc_lengths = data["doc_lengths"]
+        index.postings = {term: [tuple(item) for item in postings] for term, postings in data["postings"].items()}
+        index._prepare()
+        return index
+
+class FaissIndexFactory:
+    """FAISS索引工厂 - 按语料规模与召回目标选择Flat/HNSW/IVF-Flat/IVF-SQ8/IVF-PQ"""
+    
+    INDEX_TYPES = ("auto", "Flat", "HNSW", "IVFFlat", "IVFSQ8", "IVFPQ")
+    
+    # 自动选择的规模阈值（向量数）
+    FLAT_MAX_VECTORS = 10000
+    GRAPH_MAX_VECTORS = 200000
+    SQ_MAX_VECTORS = 2000000
+    MAX_TRAINING_VECTORS = 100000
+    
+    def __init__(self, index_type: str = "auto", recall_target: float = 0.95,
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None, hnsw_m: int = 32):
+        if index_type not in self.INDEX_TYPES:
+            raise ValueError(f"不支持的索引类型: {index_type}")
+        self.index_type = index_type
+        self.recall_target = recall_target
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.hnsw_m = hnsw_m
+    
+    def select_type(self, vector_count: int) -> str:
+        """按语料规模与召回目标选择索引类型"""
+        if self.index_type != "auto":
+            return self.index_type
+        if vector_count <= self.FLAT_MAX_VECTORS:
+            return "Flat"
+        if vector_count <= self.GRAPH_MAX_VECTORS:
+            return "HNSW" if self.recall_target >= 0.95 else "IVFFlat"
+        if vector_count <= self.SQ_MAX_VECTORS:
+            return "IVFSQ8"
+        return "IVFPQ"
+    
+    @staticmethod
+    def nlist_for(vector_count: int) -> int:
+        """IVF聚类中心数：约4*sqrt(N)，且保证每个中心至少39个训练样本"""
+        return max(1, min(int(4 * math.sqrt(vector_count)), vector_count // 39))
+    
+    @staticmethod
+    def pq_subquantizers(dimension: int) -> int:
+        """PQ子量化器数量，需整除向量维度"""
+        for m in (64, 48, 32, 16, 8, 4, 2):
+            if dimension % m == 0 and dimension // m >= 4:
+                return m
+        return 1
+    
+    def factory_string(self, index_type: str, vector_count: int, dimension: int) -> str:
+        """生成faiss.index_factory描述串"""
+        if index_type == "HNSW":
+            return f"HNSW{self.hnsw_m}"
+        nlist = self.nlist_for(vector_count)
+        if index_type == "IVFFlat":
+            return f"IVF{nlist},Flat"
+        if index_type == "IVFSQ8":
+            return f"IVF{nlist},SQ8"
+        if index_type == "IVFPQ":
+            return f"IVF{nlist},PQ{self.pq_subquantizers(dimension)}"
+        return "Flat"
+    
+    def default_nprobe(self, nlist: int) -> int:
+        """按召回目标确定默认nprobe"""
+        fraction = 0.02 if self.recall_target < 0.9 else 0.05 if self.recall_target < 0.97 else 0.1
+        return max(1, min(nlist, int(math.ceil(nlist * fraction)), 256))
+    
+    def default_ef_search(self, k: int = 10) -> int:
+        """按召回目标确定默认efSearch"""
+        return max(k, 64 if self.recall_target < 0.97 else 128)
+    
+    def build(self, vectors: np.ndarray) -> "faiss.Index":
+        """创建并训练（IVF）索引，返回尚未添加向量的空索引"""
+        vector_count, dimension = vectors.shape
+        index_type = self.select_type(vector_count)
+        # PQ训练每个子量化器需要至少256个样本，样本不足时退回精确索引
+        if index_type.startswith("IVF") and (vector_count < 39 or (index_type == "IVFPQ" and vector_count < 256)):
+            print(f"向量数 {vector_count} 不足以训练 {index_type} 索引，改用 Flat")
+            index_type = "Flat"
+        
+        description = self.factory_string(index_type, vector_count, dimension)
+        index = faiss.index_factory(dimension, description)
+        if not index.is_trained:
+            started = time.perf_counter()
+            # 训练样本超过上限时随机抽样，聚类质量基本不变而训练耗时大幅降低
+            if vector_count > self.MAX_TRAINING_VECTORS:
+                sample = np.random.default_rng(0).choice(vector_count, self.MAX_TRAINING_VECTORS, replace=False)
+                index.train(vectors[np.sort(sample)])
+            else:
+                index.train(vectors)
+            print(f"索引训练完成: {description}，耗时 {time.perf_counter() - started:.2f}s")
+        self.apply_search_params(index)
+        return index
+    
+    def apply_search_params(self, index: "faiss.Index"):
+        """设置查询参数（IVF的nprobe、HNSW的efSearch）"""
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            ivf = None
+        if ivf is not None:
+            ivf.nprobe = self.nprobe or self.default_nprobe(ivf.nlist)
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = self.ef_search or self.default_ef_search()
+    
+    @staticmethod
+    def describe(index: "faiss.Index") -> Dict[str, Any]:
+        """索引类型与查询参数"""
+        info: Dict[str, Any] = {"type": type(index).__name__, "is_trained": bool(index.is_trained)}
+        try:
+            ivf = faiss.extract_index_ivf(index)
+            info.update({"nlist": ivf.nlist, "nprobe": ivf.nprobe})
+        except RuntimeError:
+            pass
+        if hasattr(index, "hnsw"):
+            info["efSearch"] = index.hnsw.efSearch
+        return info
+    
+    @staticmethod
+    def mmap_io_flags() -> int:
+        """内存映射读取标志：IO_FLAG_MMAP只映射IVF倒排表，faiss>=1.10另有IO_FLAG_MMAP_IFC映射Flat/HNSW的向量存储"""
+        return faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    
+    @staticmethod
+    def is_memory_mapped(index: "faiss.Index") -> bool:
+        """以内存映射标志读取后，索引数据是否确实映射自磁盘（否则已完整读入内存）"""
+        try:
+            ivf = faiss.extract_index_ivf(index)
+            return isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists)
+        except RuntimeError:
+            pass
+        if not hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+            return False
+        storage = faiss.downcast_index(index.storage) if hasattr(index, "storage") else index
+        return isinstance(storage, faiss.IndexFlatCodes)
+
+@dataclass
+class ReloadJob:
+    """后台重新加载任务状态"""
+    job_id: str
+    status: str = "pending"  # pending / running / succeeded / failed
+    progress: float = 0.0
+    message: str = ""
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    result: Dict[str, Any] = field(default_factory=dict)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
 
 class ComplianceKnowledgeBase:
     """合规知识库管理器"""
     
-    def __init__(self, embeddings: OpenAIEmbeddings):
-        self.embeddings = embeddings
+    RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+    
+    def __init__(self, embeddings: OpenAIEmbeddings, retrieval_mode: Optional[str] = None):
+        self.knowledge_base_path = "compliance_knowledge_base"
+        
+        # 嵌入结果按(模型, 文本哈希)持久化缓存，重建知识库时只嵌入新增或修改的片段
+        self.embedding_cache_path = os.path.join(self.knowledge_base_path, "embedding_cache")
+        self.embedding_cache = EmbeddingCache(self.embedding_cache_path, CachedEmbeddings.model_name_of(embeddings))
+        
+        # 查询嵌入缓存：直播间重复出现的文案不再请求嵌入接口
+        self.query_cache = QueryEmbeddingCache(
+            CachedEmbeddings.model_name_of(embeddings),
+            max_entries=int(os.getenv('COMPLIANCE_QUERY_CACHE_SIZE', '4096')),
+            db_path=os.getenv('COMPLIANCE_QUERY_CACHE_DB', '')
+        )
+        
+        # 构建知识库时分批并行嵌入，完成的批次写入嵌入缓存作为断点
+        self.embedding_pipeline = EmbeddingPipeline(
+            embeddings,
+            self.embedding_cache,
+            batch_size=int(os.getenv('COMPLIANCE_EMBED_BATCH_SIZE', '64')),
+            max_workers=int(os.getenv('COMPLIANCE_EMBED_WORKERS', '4')),
+            requests_per_minute=float(os.getenv('COMPLIANCE_EMBED_RPM', '0')),
+            max_retries=int(os.getenv('COMPLIANCE_EMBED_RETRIES', '5'))
+        )
+        self.embeddings = CachedEmbeddings(embeddings, self.embedding_cache, self.query_cache, self.embedding_pipeline)
         self.vectorstore = None
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=200
         )
         self.document_uploader = DocumentUploader()
-        self.knowledge_base_path = "compliance_knowledge_base"
+        
+        # 持久化格式：FAISS原生索引文件（可内存映射）+ SQLite片段库，不使用pickle
+        self.index_file_name = "index.faiss"
+        self.docstore_file_name = "docstore.sqlite"
+        self.legacy_docstore_file_name = "index.pkl"
+        self.mmap_index = os.getenv('COMPLIANCE_KB_MMAP', 'true').lower() == 'true'
+        self._mmapped_index = None
+        
+        # 快照按内容哈希存放在versions/<快照ID>，manifest.json记录各快照的来源与嵌入模型，
+        # CURRENT指针文件原子切换；检索始终使用切换前后完整的一份状态
+        self.pointer_file_name = "CURRENT"
+        self.versions_dir_name = "versions"
+        self.manifest_file_name = "manifest.json"
+        self.snapshot_retention = max(1, int(os.getenv('COMPLIANCE_KB_SNAPSHOTS', '5')))
+        self.snapshot_id = ""
+        self._state_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        
+        # 审查期间固定使用的快照状态（按上下文隔离，线程与协程互不影响）
+        self._pinned_state: contextvars.ContextVar = contextvars.ContextVar(f"pinned_kb_{id(self)}", default=None)
+        
+        # 后台重新加载任务
+        self._reload_jobs: "OrderedDict[str, ReloadJob]" = OrderedDict()
+        self._job_lock = threading.Lock()
+        
+        # 知识库版本号，每个新快照递增；旧版单文件版本记录仅用于迁移
+        self.legacy_version_file_name = "kb_version.json"
+        self.version = 0
+        
+        # 检索模式：vector（向量）、lexical（本地BM25）、hybrid（两者RRF融合）
+        if retrieval_mode is None:
+            retrieval_mode = os.getenv('COMPLIANCE_RETRIEVAL_MODE', 'vector').lower()
+        if retrieval_mode not in self.RETRIEVAL_MODES:
+            raise ValueError(f"不支持的检索模式: {retrieval_mode}")
+        self.retrieval_mode = retrieval_mode
+        self.lexical_index_file_name = "lexical_index.json"
+        self.lexical_index: Optional[LexicalIndex] = None
+        
+        # FAISS索引类型：auto按片段数量自动选择，也可指定Flat/HNSW/IVFFlat/IVFSQ8/IVFPQ
+        nprobe = os.getenv('COMPLIANCE_FAISS_NPROBE', '')
+        ef_search = os.getenv('COMPLIANCE_FAISS_EF_SEARCH', '')
+        self.index_factory = FaissIndexFactory(
+            index_type=os.getenv('COMPLIANCE_FAISS_INDEX', 'auto'),
+            recall_target=float(os.getenv('COMPLIANCE_FAISS_RECALL', '0.95')),
+            nprobe=int(nprobe) if nprobe else None,
+            ef_search=int(ef_search) if ef_search else None
+        )
+        
+        # 按产品过滤检索时附带的通用禁用原则片段数
+        self.general_rule_k = 2
+        self._chunk_products_cache: Tuple[Any, set] = (None, set())
+        
+        # 最近一次增量重载的片段变化（added/removed/unchanged）
+        self.last_reload_changes: Dict[str, List[str]] = {}
         
         # 合规指引文档路径
         self.compliance_doc_path = "rules.docx"
+        
+        # 编译后的规则表（与其他派生数据一同存放在知识库目录下）
+        self.rule_table_path = os.path.join(self.knowledge_base_path, "compliance_rule_table.json")
+        self.rule_compiler = RuleCompiler()
+        self.rule_table = self.load_rule_table()
+        
+        # 确定性禁用词库（与当前规则集一同构建）
+        self.lexicon = self.build_lexicon()
+    
+    def load_rule_table(self) -> Optional[RuleTable]:
+        """加载规则表，指引文档校验和变化时自动重新编译"""
+        return self.rule_compiler.load_or_compile(self.compliance_doc_path, self.rule_table_path)
+    
+    def build_lexicon(self, rule_table: Optional[RuleTable] = None) -> ComplianceLexicon:
+        """根据规则集（默认当前规则表）构建禁用词库，规则表中的条目优先于内置词汇"""
+        rule_table = rule_table or self.rule_table
+        lexicon = ComplianceLexicon()
+        if rule_table:
+            for rule in rule_table.rules:
+                lexicon.add_term(rule.phrase, rule.risk_category, rule.risk_level,
+                                 rule.rule_source, product=rule.product)
+        
+        for word in ABSOLUTE_WORDS:
+            lexicon.add_term(word, "绝对化", RISK_LEVEL_FORBIDDEN, GENERAL_RULE_SOURCE)
+        for word in MEDICAL_WORDS:
+            lexicon.add_term(word, "医疗术语", RISK_LEVEL_FORBIDDEN, GENERAL_RULE_SOURCE)
+        for word in FUZZY_RISK_WORDS:
+            lexicon.add_term(word, "超范围", RISK_LEVEL_GRAY, GENERAL_RULE_SOURCE)
+        
+        print(f"禁用词库构建完成，共 {len(lexicon)} 个词条")
+        return lexicon.build()
+    
+    @property
+    def version_stamp(self) -> str:
+        """知识库版本标识（快照ID + 规则表校验和），审查期间返回固定快照的标识"""
+        pinned = self._pinned_state.get()
+        if pinned is not None:
+            return pinned["stamp"]
+        with self._state_lock:
+            return self._compute_stamp()
+    
+    def _compute_stamp(self) -> str:
+        """按当前状态计算版本标识，调用方需持有状态锁"""
+        rule_checksum = self.rule_table.checksum[:12] if self.rule_table else ""
+        return f"{self.snapshot_id or f'v{self.version}'}:{rule_checksum}"
+    
+    def _read_manifest(self) -> Dict[str, Any]:
+        """读取快照清单"""
+        manifest_path = os.path.join(self.knowledge_base_path, self.manifest_file_name)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if isinstance(manifest.get("snapshots"), list):
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {"active": "", "snapshots": []}
+    
+    def _write_manifest(self, manifest: Dict[str, Any]):
+        """写入快照清单（临时文件后原子替换）"""
+        manifest_path = os.path.join(self.knowledge_base_path, self.manifest_file_name)
+        with open(f"{manifest_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+    
+    def _read_version(self) -> int:
+        """读取已分配的最大版本号（快照清单优先，其次为旧版版本文件）"""
+        versions = [entry.get("version", 0) for entry in self._read_manifest()["snapshots"]]
+        if versions:
+            return max(versions)
+        
+        version_path = os.path.join(self.knowledge_base_path, self.legacy_version_file_name)
+        try:
+            with open(version_path, 'r', encoding='utf-8') as f:
+                return int(json.load(f).get("version", 0))
+        except (OSError, ValueError):
+            return 0
+    
+    def snapshot_id_of(self, vectorstore: FAISS) -> str:
+        """按嵌入模型、维度、索引类型与片段ID集合计算快照ID，内容相同的知识库得到相同ID"""
+        payload = json.dumps({
+            "model": self.embedding_cache.model_name,
+            "dimension": vectorstore.index.d,
+            "index_type": self._index_type(vectorstore.index),
+            "chunks": sorted(vectorstore.index_to_docstore_id.values())
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+    
+    @staticmethod
+    def _index_type(index: "faiss.Index") -> str:
+        """索引类型名；从文件读取的Flat索引类名为IndexFlatL2，统一为IndexFlat"""
+        return "IndexFlat" if isinstance(index, faiss.IndexFlat) else type(index).__name__
+    
+    def _source_checksums(self) -> Dict[str, str]:
+        """合规指引源文档的SHA-256校验和"""
+        checksums = {}
+        for path in (self.compliance_doc_path,):
+            if path and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    checksums[os.path.basename(path)] = hashlib.sha256(f.read()).hexdigest()
+        return checksums
+    
+    @staticmethod
+    def chunk_ids(documents: List[Document]) -> List[str]:
+        """按片段内容与元数据生成稳定ID，内容相同的片段按出现顺序追加序号"""
+        ids = []
+        occurrences: Dict[str, int] = {}
+        for doc in documents:
+            payload = doc.page_content + "\x00" + json.dumps(doc.metadata, ensure_ascii=False, sort_keys=True, default=str)
+            digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+            count = occurrences.get(digest, 0)
+            occurrences[digest] = count + 1
+            ids.append(digest if count == 0 else f"{digest}-{count}")
+        return ids
+    
+    def _create_vectorstore(self, documents: List[Document],
+                            progress: Optional[Callable[[int, int], None]] = None,
+                            dimension: int = 0) -> FAISS:
+        """使用稳定片段ID创建向量数据库，索引类型由索引工厂按片段数量选择；
+        没有片段时创建空索引，维度取dimension，未知时嵌入一条探测文本获取"""
+        texts = [doc.page_content for doc in documents]
+        vectors = self.embedding_pipeline.embed(texts, progress)
+        if not texts and not vectors.shape[1]:
+            vectors = np.empty((0, dimension or len(self.embeddings.embed_query("合规"))), dtype=np.float32)
+        
+        vectorstore = FAISS(
+            embedding_function=self.embeddings,
+            index=self.index_factory.build(vectors),
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={}
+        )
+        if texts:
+            vectorstore.add_embeddings(
+                list(zip(texts, vectors.tolist())),
+                metadatas=[doc.metadata for doc in documents],
+                ids=self.chunk_ids(documents)
+            )
+        return vectorstore
+    
+    def _working_copy(self) -> Optional[FAISS]:
+        """复制当前向量数据库用于修改，正在服务的版本保持不变；内存映射的索引从磁盘完整读取"""
+        with self._state_lock:
+            vectorstore = self.vectorstore
+        if vectorstore is None:
+            return None
+        
+        if vectorstore.index is self._mmapped_index:
+            index = faiss.read_index(os.path.join(self._active_dir(), self.index_file_name))
+        else:
+            index = faiss.clone_index(vectorstore.index)
+        self.index_factory.apply_search_params(index)
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(dict(vectorstore.docstore._dict)),
+            index_to_docstore_id=dict(vectorstore.index_to_docstore_id)
+        )
+    
+    def add_documents(self, documents: List[Document]) -> int:
+        """追加片段并发布新版本，已存在的片段ID直接跳过，返回实际新增数量"""
+        with self._write_lock:
+            vectorstore = self._working_copy()
+            if vectorstore is None:
+                raise RuntimeError("知识库未初始化")
+            
+            existing_ids = set(vectorstore.index_to_docstore_id.values())
+            new_items = [(chunk_id, doc) for chunk_id, doc in zip(self.chunk_ids(documents), documents)
+                         if chunk_id not in existing_ids]
+            if new_items:
+                vectorstore.add_documents([doc for _, doc in new_items], ids=[chunk_id for chunk_id, _ in new_items])
+                self.save_knowledge_base(
+                    chunk_changes={"added": [chunk_id for chunk_id, _ in new_items], "removed": []},
+                    vectorstore=vectorstore
+                )
+            return len(new_items)
+    
+    def apply_incremental_update(self, vectorstore: FAISS, documents: List[Document],
+                                 progress: Optional[Callable[[int, int], None]] = None) -> Tuple[FAISS, Dict[str, List[str]]]:
+        """按片段ID差异更新向量数据库副本：删除已移除片段，嵌入新增片段，未变化片段ID保持不变"""
+        new_ids = self.chunk_ids(documents)
+        new_id_set = set(new_ids)
+        existing_ids = set(vectorstore.index_to_docstore_id.values())
+        
+        removed_ids = sorted(existing_ids - new_id_set)
+        added = [(chunk_id, doc) for chunk_id, doc in zip(new_ids, documents) if chunk_id not in existing_ids]
+        
+        rebuilt = False
+        if removed_ids:
+            try:
+                vectorstore.delete(removed_ids)
+            except RuntimeError:
+                # HNSW等索引不支持删除，按新片段集合重建（未变化片段命中嵌入缓存）
+                print("当前索引不支持删除向量，重建索引")
+                vectorstore = self._create_vectorstore(documents, progress, vectorstore.index.d)
+                rebuilt = True
+        if added and not rebuilt:
+            texts = [doc.page_content for _, doc in added]
+            vectors = self.embedding_pipeline.embed(texts, progress)
+            vectorstore.add_embeddings(
+                list(zip(texts, vectors.tolist())),
+                metadatas=[doc.metadata for _, doc in added],
+                ids=[chunk_id for chunk_id, _ in added]
+            )
+        
+        return vectorstore, {
+            "added": [chunk_id for chunk_id, _ in added],
+            "removed": removed_ids,
+            "unchanged": [chunk_id for chunk_id in new_ids if chunk_id in existing_ids]
+        }
+    
+    def get_product_rules(self, product_name: str) -> List[ComplianceRule]:
+        """按产品名直接查询专属禁用规则"""
+        if not self.rule_table:
+            return []
+        return self.rule_table.rules_for_product(product_name)
     
     def build_knowledge_base_from_files(self, file_paths: List[str]):
         """从文件构建知识库"""
@@ -326,14 +2689,18 @@ class ComplianceKnowledgeBase:
         if not documents:
             raise ValueError("没有成功加载任何文档")
         
-        # 分割文档
-        split_documents = self.text_splitter.split_documents(documents)
-        
-        # 创建向量数据库
-        self.vectorstore = FAISS.from_documents(split_documents, self.embeddings)
+        # 按章节、产品小节与条目分割文档并标注元数据，docx按文档结构切分
+        split_documents = []
+        for document in documents:
+            source = document.metadata.get("source", "")
+            if source.lower().endswith('.docx') and os.path.exists(source):
+                blocks = self.rule_compiler._read_docx_blocks(source)
+                split_documents.extend(self.split_guideline_blocks(blocks, document.metadata))
+            else:
+                split_documents.extend(self.split_guideline(document.page_content, document.metadata))
         
-        # 保存知识库
-        self.save_knowledge_base()
+        # 创建向量数据库并发布
+        self.save_knowledge_base(vectorstore=self._create_vectorstore(split_documents))
         
         print(f"知识库构建完成，共 {len(split_documents)} 个文档片段")
         return len(split_documents)
@@ -342,18 +2709,123 @@ class ComplianceKnowledgeBase:
         """从文本构建知识库"""
         print("从文本构建合规知识库...")
         
-        # 将指引文本分割成文档
-        documents = self.text_splitter.create_documents([guide_text])
+        # 将指引文本按章节与产品分割成文档
+        documents = self.split_guideline(guide_text)
         
-        # 创建向量数据库
-        self.vectorstore = FAISS.from_documents(documents, self.embeddings)
-        
-        # 保存知识库
-        self.save_knowledge_base()
+        # 创建向量数据库并发布
+        self.save_knowledge_base(vectorstore=self._create_vectorstore(documents))
         
         print(f"知识库构建完成，共 {len(documents)} 个文档片段")
         return len(documents)
     
+    @staticmethod
+    def _rule_category(section: str, product: str) -> str:
+        """根据所在章节与产品判断片段的规则类别"""
+        if product:
+            return RULE_CATEGORY_PRODUCT
+        if "禁用" in section:
+            return RULE_CATEGORY_GENERAL
+        return RULE_CATEGORY_REFERENCE
+    
+    def split_guideline(self, content: str, metadata: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """按标题与编号层级切分纯文本指引，每行视为一个段落"""
+        return self.split_guideline_blocks([("paragraph", line) for line in content.splitlines()], metadata)
+    
+    def split_guideline_blocks(self, blocks: List[Tuple[str, Any]],
+                               metadata: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """按指引的章节、产品小节与编号条目切分，每个规则单元一个片段（产品标题与其禁用词表格为一个单元），
+        片段标注section/product/rule_category/heading_path，超长单元再按字符切分"""
+        units: List[Tuple[Dict[str, Any], List[str]]] = []
+        section = ""
+        subsection = ""
+        product = ""
+        
+        def start_unit(lines: List[str]):
+            heading_path = " > ".join(heading for heading in (section, subsection) if heading)
+            unit_metadata = dict(metadata or {})
+            unit_metadata.update({
+                "section": section,
+                "product": product,
+                "rule_category": self._rule_category(section, product),
+                "heading_path": heading_path
+            })
+            units.append((unit_metadata, lines))
+        
+        for block_type, content in blocks:
+            if block_type == "table":
+                rows = self._table_lines(content)
+                if not rows:
+                    continue
+                # 表格归入所在产品小节的单元，否则单独成为一个单元
+                if product and units and units[-1][0]["product"] == product:
+                    units[-1][1].extend(rows)
+                else:
+                    start_unit(rows)
+                continue
+            
+            text = content.strip()
+            if not text:
+                continue
+            
+            if RuleCompiler.SECTION_PATTERN.match(text):
+                section, subsection, product = text, "", ""
+                continue
+            
+            product_match = RuleCompiler.PRODUCT_PATTERN.match(text)
+            if product_match or RuleCompiler.SUBSECTION_PATTERN.match(text):
+                subsection = text
+                product = product_match.group(2).strip() if product_match else ""
+                start_unit([text])
+            elif RuleCompiler.ITEM_PATTERN.match(text) or not units or units[-1][0]["section"] != section:
+                start_unit([text])
+            else:
+                # 条目的续行或标题下的说明文字
+                units[-1][1].append(text)
+        
+        documents = []
+        for index, (unit_metadata, lines) in enumerate(units):
+            # 仅含小节标题且其下还有条目的单元不单独成片段（标题已在条目的heading_path中）
+            next_metadata = units[index + 1][0] if index + 1 < len(units) else None
+            if len(lines) == 1 and next_metadata and lines[0] in next_metadata["heading_path"] \
+                    and lines[0] in unit_metadata["heading_path"]:
+                continue
+            
+            # 片段开头附带所在标题，超长单元按字符切分后每段都保留标题
+            prefix = [heading for heading in unit_metadata["heading_path"].split(" > ") if heading and heading not in lines]
+            body = "\n".join(lines)
+            pieces = self.text_splitter.split_text(body) if len(body) > self.text_splitter._chunk_size else [body]
+            documents.extend(
+                Document(page_content="\n".join(prefix + [piece]), metadata=dict(unit_metadata))
+                for piece in pieces
+            )
+        return documents
+    
+    @staticmethod
+    def _table_lines(rows: List[List[str]]) -> List[str]:
+        """将表格按行转为"表头：内容"形式的文本行"""
+        if len(rows) < 2:
+            return ["；".join(cell.strip() for cell in row if cell.strip()) for row in rows if any(c.strip() for c in row)]
+        header = [cell.strip() for cell in rows[0]]
+        lines = []
+        for row in rows[1:]:
+            cells = [f"{name}：{cell.strip()}" for name, cell in zip(header, row) if cell.strip()]
+            if cells:
+                lines.append("；".join(cells))
+        return lines
+    
+    def load_compliance_blocks(self) -> List[Tuple[str, Any]]:
+        """读取合规指引的段落与表格结构：docx直接解析文档结构，其他格式按行读取"""
+        if self.compliance_doc_path.lower().endswith('.docx') and os.path.exists(self.compliance_doc_path):
+            try:
+                blocks = self.rule_compiler._read_docx_blocks(self.compliance_doc_path)
+                print(f"成功加载合规指引文档：{self.compliance_doc_path}")
+                return blocks
+            except Exception as e:
+                print(f"解析合规指引文档结构失败，按纯文本加载：{e}")
+        
+        content = self.load_compliance_document()
+        return [("paragraph", line) for line in content.splitlines()]
+    
     def load_compliance_document(self) -> str:
         """动态加载合规指引文档内容"""
         if not os.path.exists(self.compliance_doc_path):
@@ -377,10 +2849,10 @@ class ComplianceKnowledgeBase:
         """初始化内置的合规知识库"""
         print("初始化Spes合规知识库...")
         
-        # 动态加载合规指引文档
-        compliance_content = self.load_compliance_document()
+        # 动态加载合规指引文档（保留段落与表格结构）
+        blocks = self.load_compliance_blocks()
         
-        if not compliance_content:
+        if not any(content for _, content in blocks):
             print("无法加载合规指引文档，使用默认规则")
             # 使用基本的默认规则
             compliance_content = """
@@ -397,117 +2869,799 @@ class ComplianceKnowledgeBase:
                - 风险等级：绝对禁止
                - 规则出处：指引 1、多肽蓬蓬瓶-修护
             """
+            blocks = [("paragraph", line) for line in compliance_content.splitlines()]
         
-        # 使用加载的合规规则构建知识库
-        documents = self.text_splitter.create_documents([compliance_content])
+        # 使用加载的合规规则构建知识库，每个规则单元一个片段
+        documents = self.split_guideline_blocks(blocks)
         
-        # 创建向量数据库
-        self.vectorstore = FAISS.from_documents(documents, self.embeddings)
-        
-        # 保存知识库
-        self.save_knowledge_base()
+        # 创建向量数据库并发布
+        self.save_knowledge_base(vectorstore=self._create_vectorstore(documents))
         
         print(f"合规知识库初始化完成，共 {len(documents)} 个文档片段")
         return len(documents)
     
-    def reload_compliance_document(self):
-        """重新加载合规指引文档"""
-        print("重新加载合规指引文档...")
+    def reload_compliance_document(self, progress: Optional[Callable[[float, str], None]] = None):
+        """重新加载合规指引文档：在副本上增量更新并写入新版本目录，完成后原子切换，期间检索不受影响"""
+        def report(value: float, message: str):
+            print(message)
+            if progress:
+                progress(value, message)
         
-        # 重新加载文档内容
-        compliance_content = self.load_compliance_document()
+        def report_embedding(done: int, total: int):
+            # 嵌入阶段占任务进度的 40%-80%
+            if progress:
+                progress(0.4 + 0.4 * done / total, f"嵌入文档片段 {done}/{total}...")
         
-        if not compliance_content:
-            print("无法加载合规指引文档")
-            return False
+        with self._write_lock:
+            report(0.05, "重新加载合规指引文档...")
+            
+            # 重新加载文档内容（保留段落与表格结构）
+            blocks = self.load_compliance_blocks()
+            
+            if not any(content for _, content in blocks):
+                print("无法加载合规指引文档")
+                return False
+            
+            # 编译新的规则表与禁用词库，与向量库一同切换
+            report(0.2, "编译规则表与禁用词库...")
+            rule_table = self.load_rule_table()
+            rules = (rule_table, self.build_lexicon(rule_table))
+            
+            documents = self.split_guideline_blocks(blocks)
+            
+            if self._current_state()[0] is None:
+                self.load_knowledge_base()
+            
+            vectorstore = self._working_copy()
+            if vectorstore is None:
+                # 尚无可用知识库时完整构建
+                report(0.4, f"构建知识库，共 {len(documents)} 个文档片段...")
+                self.save_knowledge_base(vectorstore=self._create_vectorstore(documents, report_embedding), rules=rules)
+                report(1.0, f"合规指引文档重新加载完成，共 {len(documents)} 个文档片段")
+                return True
+            
+            # 增量更新：只嵌入新增片段，删除已移除片段
+            report(0.4, f"增量更新 {len(documents)} 个文档片段...")
+            vectorstore, changes = self.apply_incremental_update(vectorstore, documents, report_embedding)
+            self.last_reload_changes = changes
+            
+            if changes["added"] or changes["removed"]:
+                report(0.8, "写入新版本并切换...")
+                self.save_knowledge_base(
+                    chunk_changes={"added": changes["added"], "removed": changes["removed"]},
+                    vectorstore=vectorstore,
+                    rules=rules
+                )
+            else:
+                self._publish(rule_table=rules[0], lexicon=rules[1])
+                print("合规指引文档内容未变化，知识库版本保持不变")
+            
+            report(1.0, f"合规指引文档重新加载完成，共 {len(documents)} 个文档片段"
+                        f"（新增 {len(changes['added'])}，删除 {len(changes['removed'])}，未变化 {len(changes['unchanged'])}）")
+            return True
+    
+    def start_reload_job(self, on_complete: Optional[Callable[[ReloadJob], None]] = None) -> ReloadJob:
+        """在后台线程中重新加载合规指引文档，已有任务运行时返回该任务"""
+        with self._job_lock:
+            for job in self._reload_jobs.values():
+                if job.status in ("pending", "running"):
+                    return job
+            
+            job = ReloadJob(job_id=uuid.uuid4().hex[:12])
+            self._reload_jobs[job.job_id] = job
+            while len(self._reload_jobs) > 20:
+                self._reload_jobs.popitem(last=False)
+        
+        threading.Thread(target=self._run_reload_job, args=(job, on_complete), daemon=True).start()
+        return job
+    
+    def _run_reload_job(self, job: ReloadJob, on_complete: Optional[Callable[[ReloadJob], None]]):
+        """执行后台重新加载任务"""
+        def update(progress: float, message: str):
+            job.progress = round(progress, 2)
+            job.message = message
+        
+        job.status = "running"
+        try:
+            success = self.reload_compliance_document(progress=update)
+            job.status = "succeeded" if success else "failed"
+            if not success:
+                job.message = "无法加载合规指引文档"
+            job.result = {
+                "version": self.version_stamp,
+                "added": len(self.last_reload_changes.get("added", [])),
+                "removed": len(self.last_reload_changes.get("removed", []))
+            }
+        except Exception as e:
+            job.status = "failed"
+            job.message = f"重新加载失败: {e}"
+        finally:
+            job.finished_at = time.time()
         
-        # 重新构建知识库
-        documents = self.text_splitter.create_documents([compliance_content])
+        if on_complete:
+            on_complete(job)
+    
+    def get_reload_job(self, job_id: str) -> Optional[ReloadJob]:
+        """查询后台重新加载任务"""
+        with self._job_lock:
+            return self._reload_jobs.get(job_id)
+    
+    def _active_dir(self) -> str:
+        """当前生效的版本目录，尚无指针文件时为知识库根目录（旧版布局）"""
+        try:
+            with open(os.path.join(self.knowledge_base_path, self.pointer_file_name), 'r', encoding='utf-8') as f:
+                name = f.read().strip()
+        except OSError:
+            name = ""
+        return os.path.join(self.knowledge_base_path, self.versions_dir_name, name) if name else self.knowledge_base_path
+    
+    def _current_state(self) -> Tuple[Optional[FAISS], Optional[LexicalIndex]]:
+        """获取当前向量数据库与词法索引（同一版本），审查期间返回固定的快照"""
+        pinned = self._pinned_state.get()
+        if pinned is not None:
+            return pinned["vectorstore"], pinned["lexical_index"]
+        with self._state_lock:
+            return self.vectorstore, self.lexical_index
+    
+    def current_lexicon(self) -> Optional[ComplianceLexicon]:
+        """获取与当前快照配套的禁用词库"""
+        pinned = self._pinned_state.get()
+        return pinned["lexicon"] if pinned is not None else self.lexicon
+    
+    @contextmanager
+    def pin_snapshot(self) -> Iterator[str]:
+        """在当前上下文中固定知识库快照，期间的检索、词库扫描与版本标识都来自同一快照"""
+        if self._pinned_state.get() is not None:
+            yield self.version_stamp
+            return
+        
+        with self._state_lock:
+            state = {
+                "vectorstore": self.vectorstore,
+                "lexical_index": self.lexical_index,
+                "lexicon": self.lexicon,
+                "stamp": self._compute_stamp()
+            }
+        token = self._pinned_state.set(state)
+        try:
+            yield state["stamp"]
+        finally:
+            self._pinned_state.reset(token)
+    
+    def _publish(self, **state):
+        """原子替换内存中的知识库状态，检索中的请求继续使用替换前的引用"""
+        with self._state_lock:
+            for name, value in state.items():
+                setattr(self, name, value)
+    
+    def load_knowledge_base(self, mmap: Optional[bool] = None):
+        """加载已保存的知识库：向量索引尽可能以内存映射方式读取，片段从SQLite读取，不执行pickle反序列化"""
+        active_dir = self._active_dir()
+        index_path = os.path.join(active_dir, self.index_file_name)
+        docstore_path = os.path.join(active_dir, self.docstore_file_name)
+        
+        if not os.path.exists(docstore_path):
+            return self._migrate_legacy_knowledge_base()
+        
+        if mmap is None:
+            mmap = self.mmap_index
+        try:
+            index = faiss.read_index(index_path, FaissIndexFactory.mmap_io_flags() if mmap else 0)
+            if mmap and not FaissIndexFactory.is_memory_mapped(index):
+                print(f"当前faiss版本不支持内存映射 {type(index).__name__} 索引，已完整读入内存")
+                mmap = False
+            docstore, index_to_docstore_id = self._read_docstore(docstore_path)
+            if index.ntotal != len(index_to_docstore_id):
+                raise ValueError(f"向量数 {index.ntotal} 与片段数 {len(index_to_docstore_id)} 不一致")
+            
+            self.index_factory.apply_search_params(index)
+            vectorstore = FAISS(
+                embedding_function=self.embeddings,
+                index=index,
+                docstore=docstore,
+                index_to_docstore_id=index_to_docstore_id
+            )
+            snapshot_id = os.path.basename(active_dir) if active_dir != self.knowledge_base_path else ""
+            entry = next((item for item in self._read_manifest()["snapshots"] if item["id"] == snapshot_id), None)
+            if snapshot_id and entry is None:
+                entry = self._register_snapshot(snapshot_id, vectorstore)
+            self._publish(
+                vectorstore=vectorstore,
+                lexical_index=self._load_lexical_index(vectorstore, active_dir),
+                version=entry["version"] if entry else self._read_version(),
+                snapshot_id=snapshot_id if entry else "",
+                _mmapped_index=index if mmap else None
+            )
+            print("成功加载已保存的知识库")
+            return True
+        except Exception as e:
+            print(f"加载知识库失败: {e}")
+            return False
+    
+    def _migrate_legacy_knowledge_base(self) -> bool:
+        """旧版pickle格式知识库默认不加载；显式允许时加载一次并转换为新格式"""
+        if not os.path.exists(os.path.join(self.knowledge_base_path, self.legacy_docstore_file_name)):
+            return False
         
-        # 创建新的向量数据库
-        self.vectorstore = FAISS.from_documents(documents, self.embeddings)
+        if os.getenv('COMPLIANCE_ALLOW_PICKLE_MIGRATION', 'false').lower() != 'true':
+            print("检测到旧版pickle格式知识库，出于安全考虑不再加载（设置 COMPLIANCE_ALLOW_PICKLE_MIGRATION=true 可转换一次）")
+            return False
         
-        # 保存知识库
-        self.save_knowledge_base()
+        try:
+            vectorstore = FAISS.load_local(
+                self.knowledge_base_path,
+                self.embeddings,
+                allow_dangerous_deserialization=True
+            )
+        except Exception as e:
+            print(f"加载旧版知识库失败: {e}")
+            return False
         
-        print(f"合规指引文档重新加载完成，共 {len(documents)} 个文档片段")
+        self.version = self._read_version()
+        self.index_factory.apply_search_params(vectorstore.index)
+        self.save_knowledge_base(vectorstore=vectorstore)
+        print("旧版知识库已转换为无pickle格式")
         return True
     
-    def load_knowledge_base(self):
-        """加载已保存的知识库"""
-        if os.path.exists(self.knowledge_base_path):
+    @staticmethod
+    def _read_docstore(docstore_path: str) -> Tuple[InMemoryDocstore, Dict[int, str]]:
+        """从SQLite读取片段与 向量位置 -> 片段ID 映射"""
+        connection = sqlite3.connect(f"file:{docstore_path}?mode=ro", uri=True)
+        try:
+            rows = connection.execute(
+                "SELECT position, id, content, metadata FROM chunks ORDER BY position"
+            ).fetchall()
+        finally:
+            connection.close()
+        
+        documents = {
+            chunk_id: Document(id=chunk_id, page_content=content, metadata=json.loads(metadata))
+            for _, chunk_id, content, metadata in rows
+        }
+        return InMemoryDocstore(documents), {position: chunk_id for position, chunk_id, _, _ in rows}
+    
+    @staticmethod
+    def _write_docstore(vectorstore: FAISS, docstore_path: str):
+        """将片段写入SQLite文件"""
+        connection = sqlite3.connect(docstore_path)
+        try:
+            connection.execute(
+                "CREATE TABLE chunks (position INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, "
+                "content TEXT NOT NULL, metadata TEXT NOT NULL)"
+            )
+            rows = []
+            for position, chunk_id in sorted(vectorstore.index_to_docstore_id.items()):
+                doc = vectorstore.docstore.search(chunk_id)
+                rows.append((position, chunk_id, doc.page_content,
+                             json.dumps(doc.metadata, ensure_ascii=False, default=str)))
+            connection.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+            connection.commit()
+        finally:
+            connection.close()
+    
+    def save_knowledge_base(self, chunk_changes: Optional[Dict[str, List[str]]] = None,
+                            vectorstore: Optional[FAISS] = None,
+                            rules: Optional[Tuple[Optional[RuleTable], ComplianceLexicon]] = None):
+        """保存知识库：按内容哈希写入快照目录并登记到清单，切换CURRENT指针后原子替换内存中的向量库；
+        内容与已有快照相同时直接切换，不重复写入"""
+        vectorstore = vectorstore or self.vectorstore
+        if not vectorstore:
+            return
+        
+        with self._write_lock:
+            manifest = self._read_manifest()
+            snapshot_id = self.snapshot_id_of(vectorstore)
+            versions_dir = os.path.join(self.knowledge_base_path, self.versions_dir_name)
+            snapshot_dir = os.path.join(versions_dir, snapshot_id)
+            entry = next((item for item in manifest["snapshots"] if item["id"] == snapshot_id), None)
+            
+            if entry and os.path.isdir(snapshot_dir):
+                lexical_index = self._load_lexical_index(vectorstore, snapshot_dir)
+                print(f"知识库内容与快照 {snapshot_id} 相同，直接切换")
+            else:
+                # 在临时目录中写完整个快照后再重命名，写入中断不会留下半个快照
+                temp_dir = f"{snapshot_dir}.tmp"
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                os.makedirs(temp_dir)
+                faiss.write_index(vectorstore.index, os.path.join(temp_dir, self.index_file_name))
+                self._write_docstore(vectorstore, os.path.join(temp_dir, self.docstore_file_name))
+                lexical_index = LexicalIndex.from_documents(vectorstore.docstore._dict)
+                lexical_index.save(os.path.join(temp_dir, self.lexical_index_file_name))
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+                os.replace(temp_dir, snapshot_dir)
+                
+                entry = {
+                    "id": snapshot_id,
+                    "version": max(self.version, self._read_version()) + 1,
+                    "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "parent": self.snapshot_id,
+                    "chunk_count": vectorstore.index.ntotal,
+                    "embedding_model": self.embedding_cache.model_name,
+                    "dimension": vectorstore.index.d,
+                    "index_type": self._index_type(vectorstore.index),
+                    "sources": self._source_checksums(),
+                    "chunk_changes": chunk_changes or {}
+                }
+                manifest["snapshots"] = [item for item in manifest["snapshots"] if item["id"] != snapshot_id] + [entry]
+            
+            entry["activated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            manifest["active"] = snapshot_id
+            manifest["snapshots"] = self._retained_snapshots(manifest["snapshots"], snapshot_id)
+            self._write_manifest(manifest)
+            self._write_pointer(snapshot_id)
+            
+            state = {"vectorstore": vectorstore, "lexical_index": lexical_index, "version": entry["version"],
+                     "snapshot_id": snapshot_id, "_mmapped_index": None}
+            if rules is not None:
+                state.update(rule_table=rules[0], lexicon=rules[1])
+            self._publish(**state)
+            self._prune_snapshots(manifest)
+            print(f"知识库已保存到: {snapshot_dir} (版本 {self.version})")
+    
+    def _register_snapshot(self, snapshot_id: str, vectorstore: FAISS) -> Dict[str, Any]:
+        """将清单中缺失的版本目录（旧版按序号命名的目录）登记到清单，使其可以回滚"""
+        with self._write_lock:
+            manifest = self._read_manifest()
+            entry = {
+                "id": snapshot_id,
+                "version": self._read_version() or 1,
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "parent": "",
+                "chunk_count": vectorstore.index.ntotal,
+                "embedding_model": self.embedding_cache.model_name,
+                "dimension": vectorstore.index.d,
+                "index_type": self._index_type(vectorstore.index),
+                "sources": {},
+                "chunk_changes": {},
+                "activated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            manifest["snapshots"].append(entry)
+            manifest["active"] = snapshot_id
+            self._write_manifest(manifest)
+            return entry
+    
+    def _write_pointer(self, snapshot_id: str):
+        """原子切换CURRENT指针文件"""
+        pointer_path = os.path.join(self.knowledge_base_path, self.pointer_file_name)
+        with open(f"{pointer_path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(snapshot_id)
+        os.replace(f"{pointer_path}.tmp", pointer_path)
+    
+    def _retained_snapshots(self, snapshots: List[Dict[str, Any]], active_id: str) -> List[Dict[str, Any]]:
+        """按版本号保留最近的若干个快照，当前快照始终保留"""
+        recent = sorted(snapshots, key=lambda item: item["version"], reverse=True)[:self.snapshot_retention]
+        keep = {item["id"] for item in recent} | {active_id}
+        return [item for item in snapshots if item["id"] in keep]
+    
+    def _prune_snapshots(self, manifest: Dict[str, Any]):
+        """删除versions/下清单之外的快照目录；知识库根目录中的旧版布局文件（可能受版本控制）保持不动"""
+        versions_dir = os.path.join(self.knowledge_base_path, self.versions_dir_name)
+        keep = {item["id"] for item in manifest["snapshots"]}
+        stale = [os.path.join(versions_dir, name) for name in os.listdir(versions_dir) if name not in keep]
+        for path in stale:
             try:
-                self.vectorstore = FAISS.load_local(
-                    self.knowledge_base_path, 
-                    self.embeddings,
-                    allow_dangerous_deserialization=True
-                )
-                print("成功加载已保存的知识库")
-                return True
-            except Exception as e:
-                print(f"加载知识库失败: {e}")
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                # 其他进程仍在映射旧文件时（如Windows）稍后再清理
+                print(f"清理旧快照失败，稍后重试: {e}")
+    
+    def list_snapshots(self) -> List[Dict[str, Any]]:
+        """列出清单中的快照（按版本号从新到旧）"""
+        manifest = self._read_manifest()
+        snapshots = sorted(manifest["snapshots"], key=lambda item: item["version"], reverse=True)
+        return [
+            {**{key: value for key, value in item.items() if key != "chunk_changes"},
+             "added": len(item.get("chunk_changes", {}).get("added", [])),
+             "removed": len(item.get("chunk_changes", {}).get("removed", [])),
+             "active": item["id"] == manifest["active"]}
+            for item in snapshots
+        ]
+    
+    def activate_snapshot(self, snapshot_id: str) -> Dict[str, Any]:
+        """切换到清单中的已有快照：只切换指针并加载索引，不重新嵌入"""
+        with self._write_lock:
+            manifest = self._read_manifest()
+            entry = next((item for item in manifest["snapshots"] if item["id"] == snapshot_id), None)
+            if entry is None or not os.path.isdir(os.path.join(self.knowledge_base_path, self.versions_dir_name, snapshot_id)):
+                raise ValueError(f"快照不存在: {snapshot_id}")
+            if entry["embedding_model"] != self.embedding_cache.model_name:
+                raise ValueError(f"快照使用的嵌入模型 {entry['embedding_model']} 与当前模型 {self.embedding_cache.model_name} 不一致")
+            
+            previous_id = self.snapshot_id
+            self._write_pointer(snapshot_id)
+            if not self.load_knowledge_base():
+                if previous_id:
+                    self._write_pointer(previous_id)
+                raise RuntimeError(f"加载快照失败: {snapshot_id}")
+            
+            entry["activated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            manifest["active"] = snapshot_id
+            self._write_manifest(manifest)
+            print(f"已切换到知识库快照 {snapshot_id} (版本 {entry['version']})")
+            return entry
+    
+    def rollback_snapshot(self) -> Dict[str, Any]:
+        """回滚到当前快照之前的最近一个快照"""
+        with self._write_lock:
+            candidates = [item for item in self._read_manifest()["snapshots"] if item["version"] < self.version]
+            if not candidates:
+                raise ValueError("没有可回滚的更早快照")
+            return self.activate_snapshot(max(candidates, key=lambda item: item["version"])["id"])
+    
+    def _load_lexical_index(self, vectorstore: FAISS, snapshot_dir: str) -> LexicalIndex:
+        """加载词法索引，与向量库片段不一致时重新构建"""
+        index_path = os.path.join(snapshot_dir, self.lexical_index_file_name)
+        documents = vectorstore.docstore._dict
+        index = LexicalIndex.load(index_path)
+        if index is None or set(index.doc_ids) != set(documents):
+            index = LexicalIndex.from_documents(documents)
+            index.save(index_path)
+        return index
+    
+    def _chunk_products(self, vectorstore: FAISS) -> set:
+        """知识库片段中出现的产品名集合（按向量库与片段数缓存）"""
+        cache_key = (id(vectorstore), vectorstore.index.ntotal)
+        cached_key, cached_products = self._chunk_products_cache
+        if cached_key != cache_key:
+            cached_products = {doc.metadata.get("product", "") for doc in vectorstore.docstore._dict.values()}
+            cached_products.discard("")
+            self._chunk_products_cache = (cache_key, cached_products)
+        return cached_products
+    
+    def resolve_product(self, product_name: str, vectorstore: Optional[FAISS] = None) -> str:
+        """将提取到的产品名对应到知识库片段中的产品名，无法对应时返回空字符串"""
+        vectorstore = vectorstore or self.vectorstore
+        if not product_name or vectorstore is None:
+            return ""
+        products = self._chunk_products(vectorstore)
+        product_name = PRODUCT_ALIASES.get(product_name, product_name)
+        if product_name in products:
+            return product_name
+        
+        candidates = [product for product in products if product in product_name or product_name in product]
+        return max(candidates, key=len) if candidates else ""
+    
+    def _filtered_search(self, search: Callable[[int, Optional[Callable[[Dict[str, Any]], bool]]], List[Document]],
+                         vectorstore: FAISS, k: int, product: Optional[str] = None,
+                         category: Optional[str] = None) -> List[Document]:
+        """按产品或类别过滤检索，并始终附带通用禁用原则；search(数量, 元数据过滤函数)执行实际检索"""
+        product = self.resolve_product(product, vectorstore) if product else ""
+        if not product and not category:
+            return search(k, None)
+        
+        def matches(metadata: Dict[str, Any]) -> bool:
+            if product and metadata.get("product") != product:
                 return False
-        return False
+            return not category or metadata.get("rule_category") == category
+        
+        general_docs = search(
+            min(self.general_rule_k, k),
+            lambda metadata: metadata.get("rule_category") == RULE_CATEGORY_GENERAL
+        )
+        if category == RULE_CATEGORY_GENERAL and not product:
+            docs = search(k, matches)
+        else:
+            docs = search(max(k - len(general_docs), 1), matches)
+            docs += [doc for doc in general_docs if doc not in docs]
+        
+        # 知识库片段没有元数据（旧版本知识库）时退回全库检索
+        if not docs:
+            return search(k, None)
+        return docs
+    
+    @staticmethod
+    def _vector_search(vectorstore: FAISS, vector: List[float]) -> Callable[[int, Optional[Callable]], List[Document]]:
+        """向量检索函数"""
+        def search(k: int, metadata_filter: Optional[Callable] = None) -> List[Document]:
+            if metadata_filter is None:
+                return vectorstore.similarity_search_by_vector(vector, k=k)
+            fetch_k = min(vectorstore.index.ntotal, max(50, k * 10))
+            return vectorstore.similarity_search_by_vector(vector, k=k, fetch_k=fetch_k, filter=metadata_filter)
+        return search
+    
+    @staticmethod
+    def _lexical_search(vectorstore: FAISS, lexical_index: Optional[LexicalIndex],
+                        query: str) -> Callable[[int, Optional[Callable]], List[Document]]:
+        """词法检索函数"""
+        if lexical_index is None:
+            lexical_index = LexicalIndex.from_documents(vectorstore.docstore._dict)
+        
+        ranked = lexical_index.search(query)
+        
+        def search(k: int, metadata_filter: Optional[Callable] = None) -> List[Document]:
+            docs = []
+            for doc_id, _ in ranked:
+                doc = vectorstore.docstore.search(doc_id)
+                if not isinstance(doc, Document):
+                    continue
+                if metadata_filter is None or metadata_filter(doc.metadata):
+                    docs.append(doc)
+                    if len(docs) >= k:
+                        break
+            return docs
+        return search
+    
+    @staticmethod
+    def _hybrid_search(vector_search: Callable, lexical_search: Callable, rrf_k: int = 60) -> Callable:
+        """混合检索函数：向量与词法结果按倒数排名融合（RRF）"""
+        def search(k: int, metadata_filter: Optional[Callable] = None) -> List[Document]:
+            scores: Dict[str, float] = {}
+            docs_by_key: Dict[str, Document] = {}
+            for ranked_docs in (vector_search(k * 2, metadata_filter), lexical_search(k * 2, metadata_filter)):
+                for rank, doc in enumerate(ranked_docs):
+                    key = doc.id or doc.page_content
+                    docs_by_key.setdefault(key, doc)
+                    scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            ranked_keys = sorted(scores, key=lambda key: -scores[key])
+            return [docs_by_key[key] for key in ranked_keys[:k]]
+        return search
+    
+    def _searcher(self, vectorstore: FAISS, lexical_index: Optional[LexicalIndex], query: str,
+                  vector: Optional[List[float]]) -> Callable[[int, Optional[Callable]], List[Document]]:
+        """按检索模式组合检索函数，vector为None时只使用词法检索"""
+        if self.retrieval_mode == "lexical" or vector is None:
+            return self._lexical_search(vectorstore, lexical_index, query)
+        if self.retrieval_mode == "hybrid":
+            return self._hybrid_search(self._vector_search(vectorstore, vector),
+                                       self._lexical_search(vectorstore, lexical_index, query))
+        return self._vector_search(vectorstore, vector)
+    
+    def _embed_query_safely(self, query: str) -> Optional[List[float]]:
+        """嵌入查询；混合模式下嵌入接口失败时返回None，退回词法检索"""
+        if self.retrieval_mode == "lexical":
+            return None
+        try:
+            return self.embeddings.embed_query(query)
+        except Exception as e:
+            if self.retrieval_mode != "hybrid":
+                raise
+            print(f"查询嵌入失败，退回词法检索: {e}")
+            return None
     
-    def save_knowledge_base(self):
-        """保存知识库到本地"""
-        if self.vectorstore:
-            self.vectorstore.save_local(self.knowledge_base_path)
-            print(f"知识库已保存到: {self.knowledge_base_path}")
+    def search_compliance_rules(self, query: str, k: int = 5, product: Optional[str] = None,
+                                category: Optional[str] = None) -> List[Document]:
+        """搜索相关的合规规则，可按产品与规则类别过滤"""
+        vectorstore, lexical_index = self._current_state()
+        if not vectorstore:
+            print("知识库未初始化，请先构建或加载知识库")
+            return []
+        
+        vector = self._embed_query_safely(query)
+        return self._filtered_search(self._searcher(vectorstore, lexical_index, query, vector),
+                                     vectorstore, k, product, category)
     
-    def search_compliance_rules(self, query: str, k: int = 5) -> List[Document]:
-        """搜索相关的合规规则"""
-        if not self.vectorstore:
+    async def asearch_compliance_rules(self, query: str, k: int = 5, product: Optional[str] = None,
+                                       category: Optional[str] = None) -> List[Document]:
+        """异步搜索相关的合规规则"""
+        vectorstore, lexical_index = self._current_state()
+        if not vectorstore:
             print("知识库未初始化，请先构建或加载知识库")
             return []
         
-        docs = self.vectorstore.similarity_search(query, k=k)
-        return docs
+        vector = None
+        if self.retrieval_mode != "lexical":
+            try:
+                vector = await self.embeddings.aembed_query(query)
+            except Exception as e:
+                if self.retrieval_mode != "hybrid":
+                    raise
+                print(f"查询嵌入失败，退回词法检索: {e}")
+        # FAISS检索与元数据过滤是CPU密集操作，放到线程中执行，避免阻塞事件循环
+        return await asyncio.to_thread(self._filtered_search,
+                                       self._searcher(vectorstore, lexical_index, query, vector),
+                                       vectorstore, k, product, category)
+    
+    def search_compliance_rules_batch(self, queries: List[str], k: int = 5,
+                                      products: Optional[List[str]] = None) -> List[List[Document]]:
+        """批量搜索合规规则，所有查询只发起一次嵌入请求"""
+        vectorstore, lexical_index = self._current_state()
+        if not vectorstore:
+            print("知识库未初始化，请先构建或加载知识库")
+            return [[] for _ in queries]
+        
+        # 查询向量只写入查询缓存，不写入片段嵌入缓存
+        vectors: List[Optional[List[float]]] = [None] * len(queries)
+        if self.retrieval_mode != "lexical":
+            try:
+                vectors = self.embeddings.embed_queries(queries)
+            except Exception as e:
+                if self.retrieval_mode != "hybrid":
+                    raise
+                print(f"查询嵌入失败，退回词法检索: {e}")
+        
+        products = products or [""] * len(queries)
+        return [
+            self._filtered_search(self._searcher(vectorstore, lexical_index, query, vector), vectorstore, k, product)
+            for query, vector, product in zip(queries, vectors, products)
+        ]
     
     def get_knowledge_base_info(self) -> Dict[str, Any]:
         """获取知识库信息"""
-        if not self.vectorstore:
+        vectorstore, lexical_index = self._current_state()
+        if not vectorstore:
             return {"status": "未初始化", "document_count": 0}
         
         try:
             # 获取索引信息
-            index = self.vectorstore.index
+            index = vectorstore.index
             return {
                 "status": "已初始化",
                 "document_count": index.ntotal if hasattr(index, 'ntotal') else "未知",
-                "dimension": index.d if hasattr(index, 'd') else "未知"
+                "dimension": index.d if hasattr(index, 'd') else "未知",
+                "version": self.version_stamp,
+                "snapshot": {"id": self.snapshot_id, "version": self.version, "retention": self.snapshot_retention},
+                "rule_count": len(self.rule_table) if self.rule_table else 0,
+                "rule_table_checksum": self.rule_table.checksum if self.rule_table else "",
+                "embedding_cache": self.embedding_cache.get_stats(),
+                "embedding_pipeline": self.embedding_pipeline.get_stats(),
+                "query_cache": self.query_cache.get_stats(),
+                "retrieval_mode": self.retrieval_mode,
+                "index": FaissIndexFactory.describe(index),
+                "storage": {
+                    "format": "faiss+sqlite",
+                    "mmap": index is self._mmapped_index,
+                    "active_dir": self._active_dir()
+                },
+                "lexical_terms": len(lexical_index.postings) if lexical_index else 0
             }
         except Exception as e:
             return {"status": "已初始化", "error": str(e)}
 
-class ComplianceMatcher:
-    """合规匹配器"""
+class ContextPacker:
+    """提示词上下文打包器 - 去除相邻片段重叠、近似重复去重、MMR多样性排序并按token预算截断"""
     
-    def __init__(self, llm: ChatOpenAI, knowledge_base: ComplianceKnowledgeBase):
-        self.llm = llm
-        self.knowledge_base = knowledge_base
+    # 编码名 -> tiktoken编码（加载失败为None），进程内共享，避免重复下载
+    _encodings: Dict[str, Any] = {}
+    _encodings_lock = threading.Lock()
     
-    def match_compliance_rules(self, text: str, product_name: str = "") -> List[ComplianceResult]:
-        """匹配合规规则"""
-        results = []
+    def __init__(self, token_budget: int = 1500, mmr_lambda: float = 0.7, dedupe_threshold: float = 0.85,
+                 encoding_name: str = "o200k_base", min_overlap: int = 20, max_overlap: int = 400):
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.dedupe_threshold = dedupe_threshold
+        self.encoding_name = encoding_name
+        self.min_overlap = min_overlap
+        self.max_overlap = max_overlap
+        self._lock = threading.Lock()
+        self.packed = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.dropped_passages = 0
+    
+    def _get_encoding(self):
+        """延迟加载tiktoken编码，离线环境无法下载编码文件时退回字符估算"""
+        with self._encodings_lock:
+            if self.encoding_name not in self._encodings:
+                try:
+                    self._encodings[self.encoding_name] = tiktoken.get_encoding(self.encoding_name)
+                except Exception as e:
+                    self._encodings[self.encoding_name] = None
+                    print(f"⚠️ tiktoken编码 {self.encoding_name} 加载失败，按字符数估算token: {e}")
+            return self._encodings[self.encoding_name]
+    
+    def count_tokens(self, text: str) -> int:
+        """计算文本token数；无编码时中日韩字符按1个token、其余按4个字符1个token估算"""
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text))
+        cjk = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
+        return cjk + math.ceil((len(text) - cjk) / 4)
+    
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """按token数截断文本"""
+        if max_tokens <= 0:
+            return ""
+        encoding = self._get_encoding()
+        if encoding is not None:
+            tokens = encoding.encode(text)
+            return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
         
-        # 构建查询
-        query = f"产品: {product_name}, 文本: {text}"
+        end = len(text)
+        while end > 0 and self.count_tokens(text[:end]) > max_tokens:
+            end = max(0, end - max(1, (end - max_tokens) // 2))
+        return text[:end]
+    
+    @staticmethod
+    def shingles(text: str, size: int = 3) -> set:
+        """字符n-gram集合（预处理并去除空白后）"""
+        chars = "".join(TextPreprocessor.preprocess(text).split())
+        return {chars[i:i + size] for i in range(len(chars) - size + 1)} or {chars}
+    
+    @staticmethod
+    def similarity(a: set, b: set) -> float:
+        """Jaccard相似度"""
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+    
+    def strip_overlap(self, text: str, emitted: List[str]) -> str:
+        """去除与已输出片段首尾重叠的部分（文本切分产生的相邻片段重叠）"""
+        for previous in emitted:
+            # 已输出片段的结尾 == 当前片段的开头
+            for size in range(min(len(previous), len(text), self.max_overlap), self.min_overlap - 1, -1):
+                if previous.endswith(text[:size]):
+                    text = text[size:]
+                    break
+            # 当前片段的结尾 == 已输出片段的开头
+            for size in range(min(len(previous), len(text), self.max_overlap), self.min_overlap - 1, -1):
+                if previous.startswith(text[-size:]):
+                    text = text[:-size]
+                    break
+        return text.strip()
+    
+    def order(self, passages: List[str]) -> List[int]:
+        """近似重复去重后按MMR排序，输入顺序即相关度顺序，返回保留片段的下标"""
+        signatures = [self.shingles(passage) for passage in passages]
         
-        # 搜索相关规则
-        relevant_docs = self.knowledge_base.search_compliance_rules(query, k=10)
+        candidates = []
+        for index, signature in enumerate(signatures):
+            if any(self.similarity(signature, signatures[kept]) >= self.dedupe_threshold for kept in candidates):
+                continue
+            candidates.append(index)
         
-        if not relevant_docs:
-            return [ComplianceResult(
-                category=product_name,
-                original_text=text,
-                review_result="安全通过"
-            )]
+        count = len(passages)
+        selected: List[int] = []
+        while candidates:
+            def mmr(index: int) -> float:
+                relevance = 1.0 - index / count
+                redundancy = max((self.similarity(signatures[index], signatures[chosen]) for chosen in selected), default=0.0)
+                return self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            best = max(candidates, key=mmr)
+            selected.append(best)
+            candidates.remove(best)
+        return selected
+    
+    def pack(self, docs: List[Document]) -> str:
+        """将检索到的片段打包为不超过token预算的规则文本"""
+        passages = [doc.page_content.strip() for doc in docs if doc.page_content.strip()]
+        input_tokens = sum(self.count_tokens(passage) for passage in passages)
+        
+        emitted: List[str] = []
+        used = 0
+        for index in self.order(passages):
+            passage = self.strip_overlap(passages[index], emitted)
+            if not passage:
+                continue
+            tokens = self.count_tokens(passage) + (1 if emitted else 0)
+            if used + tokens > self.token_budget:
+                # 预算剩余较多时截断该片段，否则停止
+                remaining = self.token_budget - used - 1
+                if remaining >= 32:
+                    emitted.append(self.truncate(passage, remaining))
+                break
+            emitted.append(passage)
+            used += tokens
         
-        # 使用LLM进行合规分析
-        analysis_prompt = PromptTemplate(
-            input_variables=["text", "product_name", "compliance_rules"],
-            template="""
+        rules_text = "\n".join(emitted)
+        with self._lock:
+            self.packed += 1
+            self.input_tokens += input_tokens
+            self.output_tokens += self.count_tokens(rules_text)
+            self.dropped_passages += len(passages) - len(emitted)
+        return rules_text
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取打包统计"""
+        with self._lock:
+            return {
+                "token_budget": self.token_budget,
+                "encoding": self.encoding_name if self._get_encoding() is not None else "estimate",
+                "packed": self.packed,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "saved_ratio": round(1 - self.output_tokens / self.input_tokens, 4) if self.input_tokens else 0.0,
+                "dropped_passages": self.dropped_passages
+            }
+
+class ComplianceMatcher:
+    """合规匹配器"""
+    
+    ANALYSIS_PROMPT = PromptTemplate(
+        input_variables=["text", "product_name", "compliance_rules"],
+        template="""
 你是一个专业的合规审查专家。请根据以下合规规则分析文本的合规性。
 
 产品名称: {product_name}
@@ -543,117 +3697,525 @@ class ComplianceMatcher:
     "manual_review_needed": false
 }}
 """
-        )
+    )
+    
+    BATCH_ANALYSIS_PROMPT = PromptTemplate(
+        input_variables=["items", "compliance_rules"],
+        template="""
+你是一个专业的合规审查专家。请根据以下合规规则逐条分析每段文本的合规性，各条文本相互独立。
+
+合规规则:
+{compliance_rules}
+
+待审查文本（每行一条，方括号内为编号）:
+{items}
+
+对每条文本，如果违反合规规则，请提供：命中的违规词汇、风险类别（绝对化/医疗术语/超范围/产品专属禁用）、
+风险等级（绝对禁止/警告/灰色提醒）、规则出处和简要说明。产品名称为空时，请从文本中识别产品名称。
+
+请以JSON格式返回结果，items中每个编号各返回一项：
+{{
+    "items": [
+        {{
+            "index": 0,
+            "product_name": "产品名称",
+            "violations": [
+                {{
+                    "hit_word": "违规词汇",
+                    "risk_category": "风险类别",
+                    "risk_level": "风险等级",
+                    "rule_source": "规则出处",
+                    "brief_description": "简要说明"
+                }}
+            ],
+            "manual_review_needed": false
+        }}
+    ]
+}}
+"""
+    )
+    
+    SINGLE_PASS_PROMPT = PromptTemplate(
+        input_variables=["text", "product_hint", "compliance_rules"],
+        template="""
+你是一个专业的合规审查专家。请一次性完成产品名称识别和合规分析。
+
+待审查文本: {text}
+产品名称提示: {product_hint}
+
+合规规则:
+{compliance_rules}
+
+第一步：识别产品名称。产品名称通常出现在方括号【】中，或者是文本开头的主要产品标识；
+如果提供了产品名称提示则直接使用，无法识别时返回空字符串。
+第二步：分析文本是否违反合规规则，优先匹配该产品的专属禁用词汇，再匹配共性禁用词汇。如果违反，请提供：
+1. 命中的违规词汇
+2. 风险类别（绝对化/医疗术语/超范围/产品专属禁用）
+3. 风险等级（绝对禁止/警告/灰色提醒）
+4. 规则出处
+5. 简要说明
+
+请以JSON格式返回结果：
+{{
+    "product_name": "产品名称",
+    "violations": [
+        {{
+            "hit_word": "违规词汇",
+            "risk_category": "风险类别",
+            "risk_level": "风险等级",
+            "rule_source": "规则出处",
+            "brief_description": "简要说明"
+        }}
+    ],
+    "manual_review_needed": false
+}}
+"""
+    )
+    
+    def __init__(self, llm: ChatOpenAI, knowledge_base: ComplianceKnowledgeBase,
+                 context_packer: Optional[ContextPacker] = None):
+        self.llm = llm
+        self.knowledge_base = knowledge_base
+        
+        # 规则上下文按token预算打包，控制提示词长度
+        if context_packer is None:
+            context_packer = ContextPacker(
+                token_budget=int(os.getenv('COMPLIANCE_CONTEXT_TOKENS', '1500')),
+                mmr_lambda=float(os.getenv('COMPLIANCE_CONTEXT_MMR_LAMBDA', '0.7')),
+                encoding_name=os.getenv('COMPLIANCE_CONTEXT_ENCODING', 'o200k_base')
+            )
+        self.context_packer = context_packer
+        
+        # 片段按规则单元切分，少量片段即可覆盖相关规则
+        self.retrieval_k = int(os.getenv('COMPLIANCE_RETRIEVAL_K', '3'))
+    
+    def match_compliance_rules(self, text: str, product_name: str = "") -> List[ComplianceResult]:
+        """匹配合规规则"""
+        # 构建查询
+        query = f"产品: {product_name}, 文本: {text}"
+        
+        # 搜索相关规则
+        relevant_docs = self.knowledge_base.search_compliance_rules(query, k=self.retrieval_k, product=product_name)
+        
+        if not relevant_docs:
+            return [ComplianceResult(
+                category=product_name,
+                original_text=text,
+                review_result="安全通过"
+            )]
         
         # 准备合规规则文本
-        rules_text = "\n".join([doc.page_content for doc in relevant_docs])
+        rules_text = self.context_packer.pack(relevant_docs)
         
         try:
-            response = self.llm.invoke(analysis_prompt.format(
+            # 使用LLM进行合规分析
+            response = self.llm.invoke(self.ANALYSIS_PROMPT.format(
                 text=text,
                 product_name=product_name,
                 compliance_rules=rules_text
             ))
+            return self._parse_analysis_response(response.content, text, product_name)
+        except Exception as e:
+            return self._analysis_failed_results(e, text, product_name)
+    
+    async def amatch_compliance_rules(self, text: str, product_name: str = "") -> List[ComplianceResult]:
+        """异步匹配合规规则"""
+        query = f"产品: {product_name}, 文本: {text}"
+        relevant_docs = await self.knowledge_base.asearch_compliance_rules(query, k=self.retrieval_k, product=product_name)
+        
+        if not relevant_docs:
+            return [ComplianceResult(
+                category=product_name,
+                original_text=text,
+                review_result="安全通过"
+            )]
+        
+        rules_text = self.context_packer.pack(relevant_docs)
+        
+        try:
+            response = await self.llm.ainvoke(self.ANALYSIS_PROMPT.format(
+                text=text,
+                product_name=product_name,
+                compliance_rules=rules_text
+            ))
+            return self._parse_analysis_response(response.content, text, product_name)
+        except Exception as e:
+            return self._analysis_failed_results(e, text, product_name)
+    
+    def match_compliance_rules_single_pass(self, text: str, product_hint: str = "") -> List[ComplianceResult]:
+        """单次LLM调用同时完成产品名识别与合规分析，检索仅依赖文本与本地产品名提示"""
+        relevant_docs = self.knowledge_base.search_compliance_rules(
+            self._single_pass_query(text, product_hint), k=self.retrieval_k, product=product_hint
+        )
+        
+        if not relevant_docs:
+            return [ComplianceResult(
+                category=product_hint,
+                original_text=text,
+                review_result="安全通过"
+            )]
+        
+        rules_text = self.context_packer.pack(relevant_docs)
+        
+        try:
+            response = self.llm.invoke(self.SINGLE_PASS_PROMPT.format(
+                text=text,
+                product_hint=product_hint,
+                compliance_rules=rules_text
+            ))
+            return self._parse_single_pass_response(response.content, text, product_hint)
+        except Exception as e:
+            return self._analysis_failed_results(e, text, product_hint)
+    
+    async def amatch_compliance_rules_single_pass(self, text: str, product_hint: str = "") -> List[ComplianceResult]:
+        """异步单次调用完成产品名识别与合规分析"""
+        relevant_docs = await self.knowledge_base.asearch_compliance_rules(
+            self._single_pass_query(text, product_hint), k=self.retrieval_k, product=product_hint
+        )
+        
+        if not relevant_docs:
+            return [ComplianceResult(
+                category=product_hint,
+                original_text=text,
+                review_result="安全通过"
+            )]
+        
+        rules_text = self.context_packer.pack(relevant_docs)
+        
+        try:
+            response = await self.llm.ainvoke(self.SINGLE_PASS_PROMPT.format(
+                text=text,
+                product_hint=product_hint,
+                compliance_rules=rules_text
+            ))
+            return self._parse_single_pass_response(response.content, text, product_hint)
+        except Exception as e:
+            return self._analysis_failed_results(e, text, product_hint)
+    
+    @staticmethod
+    def _single_pass_query(text: str, product_hint: str) -> str:
+        """单次调用模式的检索查询，不等待LLM提取产品名"""
+        return f"产品: {product_hint}, 文本: {text}" if product_hint else f"文本: {text}"
+    
+    def _parse_single_pass_response(self, content: str, text: str, product_hint: str) -> List[ComplianceResult]:
+        """解析单次调用的响应，产品名优先使用本地提示"""
+        content = self._extract_json_content(content)
+        
+        try:
+            result_data = json.loads(content)
+        except json.JSONDecodeError:
+            print(f"JSON解析失败，使用备用解析方法")
+            result_data = self._parse_compliance_result_fallback(content, text, product_hint)
+        
+        product_name = product_hint or ProductNameExtractor._clean_llm_product_name(
+            str(result_data.get("product_name") or "")
+        )
+        return self._build_results(
+            text,
+            product_name,
+            result_data["violations"],
+            result_data.get("manual_review_needed", False)
+        )
+    
+    def _parse_analysis_response(self, content: str, text: str, product_name: str) -> List[ComplianceResult]:
+        """解析单条分析的LLM响应"""
+        # 解析JSON响应，处理可能的格式问题
+        content = self._extract_json_content(content)
+        
+        # 尝试解析JSON
+        try:
+            result_data = json.loads(content)
+        except json.JSONDecodeError:
+            # 如果JSON解析失败，尝试手动解析
+            print(f"JSON解析失败，使用备用解析方法")
+            result_data = self._parse_compliance_result_fallback(content, text, product_name)
+        
+        return self._build_results(
+            text,
+            product_name,
+            result_data["violations"],
+            result_data.get("manual_review_needed", False)
+        )
+    
+    def _analysis_failed_results(self, error: Exception, text: str, product_name: str) -> List[ComplianceResult]:
+        """LLM分析失败时返回默认安全通过结果，并记录错误"""
+        print(f"合规分析失败: {error}")
+        return [ComplianceResult(
+            category=product_name,
+            original_text=text,
+            review_result="安全通过",
+            analysis_error=str(error)
+        )]
+    
+    def match_compliance_rules_batch(self, items: List[Tuple[str, str]], k: Optional[int] = None,
+                                     batch_size: int = 10) -> List[List[ComplianceResult]]:
+        """批量匹配合规规则：一次嵌入调用检索，检索结果相同的文本合并为一次LLM请求"""
+        if not items:
+            return []
+        
+        queries = [f"产品: {product_name}, 文本: {text}" for text, product_name in items]
+        docs_per_item = self.knowledge_base.search_compliance_rules_batch(
+            queries, k=k or self.retrieval_k, products=[product_name for _, product_name in items]
+        )
+        
+        # 按检索到的规则集合分组，保持首次出现的顺序
+        groups: "OrderedDict[Tuple[str, ...], List[int]]" = OrderedDict()
+        group_docs: Dict[Tuple[str, ...], List[Document]] = {}
+        for index, docs in enumerate(docs_per_item):
+            group_key = tuple(sorted(doc.page_content for doc in docs))
+            groups.setdefault(group_key, []).append(index)
+            group_docs.setdefault(group_key, docs)
+        
+        results: List[Optional[List[ComplianceResult]]] = [None] * len(items)
+        for group_key, indices in groups.items():
+            docs = group_docs[group_key]
+            if not docs:
+                for index in indices:
+                    text, product_name = items[index]
+                    results[index] = self._build_results(text, product_name, [])
+                continue
             
-            # 解析JSON响应，处理可能的格式问题
-            content = response.content.strip()
-            
-            # 尝试提取JSON部分
-            if "```json" in content:
-                json_start = content.find("```json") + 7
-                json_end = content.find("```", json_start)
-                content = content[json_start:json_end].strip()
-            elif "```" in content:
-                json_start = content.find("```") + 3
-                json_end = content.find("```", json_start)
-                content = content[json_start:json_end].strip()
+            rules_text = self.context_packer.pack(docs)
+            for offset in range(0, len(indices), batch_size):
+                chunk = indices[offset:offset + batch_size]
+                chunk_results = self._analyze_batch([items[index] for index in chunk], rules_text)
+                for index, item_results in zip(chunk, chunk_results):
+                    results[index] = item_results
+        
+        return results
+    
+    def _analyze_batch(self, items: List[Tuple[str, str]], rules_text: str) -> List[List[ComplianceResult]]:
+        """将共享规则的多条文本打包为一次LLM请求，按编号解析结果"""
+        items_text = "\n".join(
+            f"[{i}] 产品名称: {product_name} | 文本: {text}" for i, (text, product_name) in enumerate(items)
+        )
+        
+        try:
+            response = self.llm.invoke(self.BATCH_ANALYSIS_PROMPT.format(
+                items=items_text,
+                compliance_rules=rules_text
+            ))
+            content = self._extract_json_content(response.content)
             
-            # 尝试解析JSON
             try:
-                result_data = json.loads(content)
-            except json.JSONDecodeError:
-                # 如果JSON解析失败，尝试手动解析
-                print(f"JSON解析失败，使用备用解析方法")
-                result_data = self._parse_compliance_result_fallback(content, text, product_name)
-            
-            if result_data["violations"]:
-                for violation in result_data["violations"]:
-                    results.append(ComplianceResult(
-                        category=product_name,
-                        original_text=text,
-                        review_result="拒绝",
-                        hit_word=violation.get("hit_word", ""),
-                        risk_category=violation.get("risk_category", ""),
-                        risk_level=violation.get("risk_level", ""),
-                        rule_source=violation.get("rule_source", ""),
-                        brief_description=violation.get("brief_description", ""),
-                        manual_review_needed=result_data.get("manual_review_needed", False)
-                    ))
-            else:
-                results.append(ComplianceResult(
-                    category=product_name,
-                    original_text=text,
-                    review_result="安全通过",
-                    manual_review_needed=result_data.get("manual_review_needed", False)
+                item_data = {int(item["index"]): item for item in json.loads(content).get("items", [])}
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                print("批量JSON解析失败，使用备用解析方法")
+                item_data = {}
+            
+            results = []
+            for i, (text, product_name) in enumerate(items):
+                data = item_data.get(i)
+                if data is None:
+                    # 缺失的条目使用确定性词库结果
+                    data = self._parse_compliance_result_fallback(content, text, product_name)
+                product_name = product_name or data.get("product_name", "") or ""
+                results.append(self._build_results(
+                    text,
+                    product_name,
+                    data.get("violations", []),
+                    data.get("manual_review_needed", False)
                 ))
-                
+            return results
+        
         except Exception as e:
-            print(f"合规分析失败: {e}")
-            # 返回默认安全通过结果
-            results.append(ComplianceResult(
+            print(f"批量合规分析失败: {e}")
+            return [[ComplianceResult(
+                category=product_name,
+                original_text=text,
+                review_result="安全通过",
+                analysis_error=str(e)
+            )] for text, product_name in items]
+    
+    @staticmethod
+    def _extract_json_content(content: str) -> str:
+        """从LLM响应中提取JSON部分"""
+        content = content.strip()
+        if "```json" in content:
+            json_start = content.find("```json") + 7
+            json_end = content.find("```", json_start)
+            content = content[json_start:json_end].strip()
+        elif "```" in content:
+            json_start = content.find("```") + 3
+            json_end = content.find("```", json_start)
+            content = content[json_start:json_end].strip()
+        return content
+    
+    def gate_compliance_review(self, text: str, product_name: str = "") -> Optional[List[ComplianceResult]]:
+        """确定性预审：无命中直接通过，仅命中共性或本产品的绝对禁止词直接拒绝，其余返回None交由LLM分析"""
+        matches = self.knowledge_base.current_lexicon().scan(text, product_name)
+        
+        if not matches:
+            return [ComplianceResult(
                 category=product_name,
                 original_text=text,
                 review_result="安全通过"
-            ))
+            )]
         
-        return results
+        if all(match.is_forbidden for match in matches):
+            violations = [match.to_violation() for match in matches]
+            return self._build_results(text, product_name, violations)
+        
+        return None
+    
+    def _build_results(self, text: str, product_name: str, violations: List[Dict[str, Any]],
+                       manual_review_needed: bool = False) -> List[ComplianceResult]:
+        """根据违规列表构建审查结果"""
+        if not violations:
+            return [ComplianceResult(
+                category=product_name,
+                original_text=text,
+                review_result="安全通过",
+                manual_review_needed=manual_review_needed
+            )]
+        
+        return [ComplianceResult(
+            category=product_name,
+            original_text=text,
+            review_result="拒绝",
+            hit_word=violation.get("hit_word", ""),
+            risk_category=violation.get("risk_category", ""),
+            risk_level=violation.get("risk_level", ""),
+            rule_source=violation.get("rule_source", ""),
+            brief_description=violation.get("brief_description", ""),
+            manual_review_needed=manual_review_needed
+        ) for violation in violations]
     
     def _parse_compliance_result_fallback(self, content: str, text: str, product_name: str) -> Dict[str, Any]:
         """备用解析方法，当JSON解析失败时使用"""
-        # 简单的文本分析，检查常见的违规词汇
-        violations = []
-        
-        # 绝对化词汇检查
-        absolute_words = ["根治", "彻底", "立竿见影", "百分之百", "完全", "绝对", "全方位", "全面", "顶级", "最", "第一", "瞬间", "永不"]
-        for word in absolute_words:
-            if word in text:
-                violations.append({
-                    "hit_word": word,
-                    "risk_category": "绝对化",
-                    "risk_level": "绝对禁止",
-                    "rule_source": "指引 一、核心法规依据与通用禁用原则",
-                    "brief_description": f"使用绝对化表述: {word}"
-                })
-        
-        # 医疗术语检查
-        medical_words = ["毛囊", "修复", "治疗", "除菌", "抗菌", "排毒", "活化", "颠覆", "逆转", "药用", "消炎", "抗敏"]
-        for word in medical_words:
-            if word in text:
-                violations.append({
-                    "hit_word": word,
-                    "risk_category": "医疗术语",
-                    "risk_level": "绝对禁止",
-                    "rule_source": "指引 一、核心法规依据与通用禁用原则",
-                    "brief_description": f"使用医疗术语: {word}"
-                })
+        # 使用确定性禁用词库扫描文本，模糊语义命中仅提示人工复核
+        matches = self.knowledge_base.current_lexicon().scan(text, product_name)
+        violations = [match.to_violation() for match in matches if match.is_forbidden]
         
         return {
             "violations": violations,
-            "manual_review_needed": False
+            "manual_review_needed": any(not match.is_forbidden for match in matches)
         }
 
+class ReviewCache:
+    """审查结果缓存 - 内存LRU（带TTL）+ 可选SQLite持久层"""
+    
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600, db_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS review_cache "
+                "(key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+    
+    @staticmethod
+    def make_key(text: str, version_stamp: str, mode: str = "") -> str:
+        """由归一化文本、知识库版本与审查模式生成缓存键"""
+        raw = "\x1f".join([version_stamp, mode, text])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，过期条目视为未命中"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT result, created_at FROM review_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[1] <= self.ttl_seconds:
+                    self._store_memory(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+            
+            self.misses += 1
+            return None
+    
+    def put(self, key: str, result: str):
+        """写入缓存"""
+        now = time.time()
+        with self._lock:
+            self._store_memory(key, result, now)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO review_cache (key, result, created_at) VALUES (?, ?, ?)",
+                    (key, result, now)
+                )
+                self._db.commit()
+    
+    def _store_memory(self, key: str, result: str, created_at: float):
+        """写入内存LRU并淘汰最久未使用的条目"""
+        self._entries[key] = (created_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        """清空缓存（规则集变化时调用）"""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM review_cache")
+                self._db.commit()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存命中统计"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "persistent": self._db is not None
+            }
+
 class ComplianceAgent:
     """合规审查Agent主类"""
     
-    def __init__(self):
+    def __init__(self, gating: Optional[bool] = None, review_cache: Optional[ReviewCache] = None,
+                 single_pass: Optional[bool] = None):
+        # 词库预审模式：明确通过/拒绝的文本不调用LLM
+        if gating is None:
+            gating = os.getenv('COMPLIANCE_GATING', 'false').lower() == 'true'
+        self.gating = gating
+        
+        # 单次调用模式：产品名识别与合规分析合并为一次LLM请求
+        if single_pass is None:
+            single_pass = os.getenv('COMPLIANCE_SINGLE_PASS', 'false').lower() == 'true'
+        self.single_pass = single_pass
+        
+        # 审查结果缓存，键中包含知识库版本，规则集变化后自动失效
+        if review_cache is None:
+            review_cache = ReviewCache(
+                max_entries=int(os.getenv('COMPLIANCE_CACHE_SIZE', '1024')),
+                ttl_seconds=float(os.getenv('COMPLIANCE_CACHE_TTL', '3600')),
+                db_path=os.getenv('COMPLIANCE_CACHE_DB', '')
+            )
+        self.review_cache = review_cache
+        
         # 初始化LLM和嵌入模型
         self.llm = ChatOpenAI(model="gpt-4o-mini")
         self.embeddings = OpenAIEmbeddings()
         
         # 初始化各个模块
         self.preprocessor = TextPreprocessor()
-        self.product_extractor = ProductNameExtractor(self.llm)
         self.knowledge_base = ComplianceKnowledgeBase(self.embeddings)
+        self.product_extractor = ProductNameExtractor(self.llm, self.knowledge_base)
         self.matcher = ComplianceMatcher(self.llm, self.knowledge_base)
         
         # 自动初始化知识库
@@ -718,10 +4280,11 @@ class ComplianceAgent:
                 documents = self.knowledge_base.text_splitter.create_documents([custom_text])
                 
                 if self.knowledge_base.vectorstore:
-                    # 添加到现有向量数据库
-                    self.knowledge_base.vectorstore.add_documents(documents)
-                    self.knowledge_base.save_knowledge_base()
-                    return f"成功添加自定义规则，新增 {len(documents)} 个知识片段"
+                    # 添加到现有向量数据库并发布新版本，重复片段不会重复写入
+                    added_count = self.knowledge_base.add_documents(documents)
+                    if added_count:
+                        self.review_cache.clear()
+                    return f"成功添加自定义规则，新增 {added_count} 个知识片段"
                 else:
                     return "知识库未初始化，无法添加自定义规则"
             except Exception as e:
@@ -738,6 +4301,7 @@ class ComplianceAgent:
             try:
                 success = self.knowledge_base.reload_compliance_document()
                 if success:
+                    self.review_cache.clear()
                     return "合规指引文档重新加载成功"
                 else:
                     return "合规指引文档重新加载失败"
@@ -771,22 +4335,198 @@ class ComplianceAgent:
             # 2. 文本预处理
             processed_text = self.preprocessor.preprocess(text)
             
-            # 3. 提取产品名称
-            product_name = self.product_extractor.extract_product_name(processed_text)
+            # 整个审查过程固定使用同一知识库快照，结果标注该快照版本
+            with self.knowledge_base.pin_snapshot() as version_stamp:
+                # 命中缓存时直接返回
+                cache_key = self._cache_key(processed_text)
+                cached = self.review_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+                
+                results = self._review_processed_text(processed_text)
+                return self._finish_review(cache_key, results, version_stamp)
+            
+        except Exception as e:
+            return f"审查过程中发生错误: {str(e)}"
+    
+    async def _aperform_compliance_review(self, text: str, processed_text: Optional[str] = None) -> str:
+        """异步执行合规审查，processed_text为已完成预处理的文本"""
+        try:
+            if not self.knowledge_base.vectorstore:
+                if not await asyncio.to_thread(self.knowledge_base.load_knowledge_base):
+                    return "错误：知识库未初始化，请先上传合规指引文档"
             
-            # 4. 合规匹配
-            results = self.matcher.match_compliance_rules(processed_text, product_name)
+            if processed_text is None:
+                processed_text = self.preprocessor.preprocess(text)
             
-            # 5. 格式化输出
-            return self._format_output(results)
+            # 结果缓存读写SQLite，放到线程中执行
+            with self.knowledge_base.pin_snapshot() as version_stamp:
+                cache_key = self._cache_key(processed_text)
+                cached = await asyncio.to_thread(self.review_cache.get, cache_key)
+                if cached is not None:
+                    return cached
+                
+                results = await self._areview_processed_text(processed_text)
+                return await asyncio.to_thread(self._finish_review, cache_key, results, version_stamp)
             
         except Exception as e:
             return f"审查过程中发生错误: {str(e)}"
     
-    def _format_output(self, results: List[ComplianceResult]) -> str:
-        """格式化输出结果"""
+    def _cache_key(self, processed_text: str) -> str:
+        """生成审查结果缓存键"""
+        return ReviewCache.make_key(processed_text, self.knowledge_base.version_stamp, self._review_mode())
+    
+    def _finish_review(self, cache_key: str, results: List[ComplianceResult], version_stamp: str = "") -> str:
+        """格式化审查结果并写入缓存，LLM分析失败时的默认结果不写入缓存"""
+        output = self._format_output(results, version_stamp)
+        if not any(result.analysis_error for result in results):
+            self.review_cache.put(cache_key, output)
+        return output
+    
+    def review_batch(self, texts: List[str], batch_size: int = 10) -> List[str]:
+        """批量审查：本地预处理与产品名提取，合并嵌入与LLM请求，按输入顺序返回结果"""
+        if not self.knowledge_base.vectorstore and not self.knowledge_base.load_knowledge_base():
+            return ["错误：知识库未初始化，请先上传合规指引文档"] * len(texts)
+        
+        # 整批固定使用同一知识库快照
+        with self.knowledge_base.pin_snapshot() as version_stamp:
+            return self._review_batch_pinned(texts, batch_size, version_stamp)
+    
+    def _review_batch_pinned(self, texts: List[str], batch_size: int, version_stamp: str) -> List[str]:
+        """在固定快照下执行批量审查"""
+        outputs: List[Optional[str]] = [None] * len(texts)
+        pending = []
+        for index, text in enumerate(texts):
+            if not text or not text.strip():
+                outputs[index] = "错误：没有提供有效的文本或图片输入"
+                continue
+            
+            processed_text = self.preprocessor.preprocess(text)
+            cache_key = ReviewCache.make_key(processed_text, version_stamp, self._review_mode())
+            cached = self.review_cache.get(cache_key)
+            if cached is not None:
+                outputs[index] = cached
+                continue
+            
+            # 批量模式只在本地提取产品名，未识别的交由批量分析请求识别
+            product_name = self.product_extractor.extract_product_name(processed_text, allow_llm=False)
+            
+            if self.gating:
+                gated_results = self.matcher.gate_compliance_review(processed_text, product_name)
+                if gated_results is not None:
+                    outputs[index] = self._format_output(gated_results, version_stamp)
+                    self.review_cache.put(cache_key, outputs[index])
+                    continue
+            
+            pending.append((index, processed_text, product_name, cache_key))
+        
+        if pending:
+            batch_results = self.matcher.match_compliance_rules_batch(
+                [(processed_text, product_name) for _, processed_text, product_name, _ in pending],
+                batch_size=batch_size
+            )
+            for (index, _, _, cache_key), results in zip(pending, batch_results):
+                outputs[index] = self._format_output(results, version_stamp)
+                if not any(result.analysis_error for result in results):
+                    self.review_cache.put(cache_key, outputs[index])
+        
+        return outputs
+    
+    def _review_mode(self) -> str:
+        """当前审查模式标识，用于区分缓存"""
+        mode = "gated" if self.gating else "llm"
+        return f"{mode}+single_pass" if self.single_pass else mode
+    
+    def _review_processed_text(self, processed_text: str, single_pass: Optional[bool] = None) -> List[ComplianceResult]:
+        """对预处理后的文本执行审查，返回结构化结果"""
+        # 词库预审：明确通过或明确拒绝时直接返回，不调用LLM
+        if self.gating:
+            product_name = self.product_extractor.extract_product_name(processed_text, allow_llm=False)
+            gated_results = self.matcher.gate_compliance_review(processed_text, product_name)
+            if gated_results is not None:
+                return gated_results
+        
+        # 单次调用模式：仅使用本地产品名提示，由分析请求同时识别产品名
+        if self.single_pass if single_pass is None else single_pass:
+            product_hint = self.product_extractor.extract_product_name(processed_text, allow_llm=False)
+            return self.matcher.match_compliance_rules_single_pass(processed_text, product_hint)
+        
+        # 3. 提取产品名称（【】与已知产品名优先，未命中时才调用LLM）
+        product_name = self.product_extractor.extract_product_name(processed_text)
+        
+        # 4. 合规匹配
+        return self.matcher.match_compliance_rules(processed_text, product_name)
+    
+    async def _areview_processed_text(self, processed_text: str,
+                                      single_pass: Optional[bool] = None) -> List[ComplianceResult]:
+        """异步审查预处理后的文本，single_pass为None时使用Agent的审查模式"""
+        if self.gating:
+            product_name = self.product_extractor.extract_product_name(processed_text, allow_llm=False)
+            gated_results = self.matcher.gate_compliance_review(processed_text, product_name)
+            if gated_results is not None:
+                return gated_results
+        
+        if self.single_pass if single_pass is None else single_pass:
+            product_hint = self.product_extractor.extract_product_name(processed_text, allow_llm=False)
+            return await self.matcher.amatch_compliance_rules_single_pass(processed_text, product_hint)
+        
+        product_name = await self.product_extractor.aextract_product_name(processed_text)
+        return await self.matcher.amatch_compliance_rules(processed_text, product_name)
+    
+    def compare_review_modes(self, texts: List[str]) -> Dict[str, Any]:
+        """对比两次调用与单次调用模式的延迟和结论一致性（不使用结果缓存）"""
+        items = []
+        latencies = {"two_call": [], "single_pass": []}
+        
+        for text in texts:
+            processed_text = self.preprocessor.preprocess(text)
+            outcome = {"text": text}
+            
+            for mode, single_pass in (("two_call", False), ("single_pass", True)):
+                started = time.perf_counter()
+                results = self._review_processed_text(processed_text, single_pass=single_pass)
+                elapsed = time.perf_counter() - started
+                latencies[mode].append(elapsed)
+                outcome[mode] = {
+                    "latency": round(elapsed, 3),
+                    "product_name": results[0].category if results else "",
+                    "rejected": any(result.review_result == "拒绝" for result in results),
+                    "hit_words": sorted({result.hit_word for result in results if result.hit_word})
+                }
+            
+            two_call, single = outcome["two_call"], outcome["single_pass"]
+            outcome["verdict_agree"] = two_call["rejected"] == single["rejected"]
+            outcome["product_agree"] = two_call["product_name"] == single["product_name"]
+            union = set(two_call["hit_words"]) | set(single["hit_words"])
+            intersection = set(two_call["hit_words"]) & set(single["hit_words"])
+            outcome["hit_word_jaccard"] = round(len(intersection) / len(union), 3) if union else 1.0
+            items.append(outcome)
+        
+        count = len(items)
+        
+        def latency_summary(values: List[float]) -> Dict[str, float]:
+            ordered = sorted(values)
+            return {
+                "mean": round(sum(ordered) / count, 3) if count else 0.0,
+                "p50": round(ordered[count // 2], 3) if count else 0.0,
+                "max": round(ordered[-1], 3) if count else 0.0
+            }
+        
+        return {
+            "count": count,
+            "latency": {mode: latency_summary(values) for mode, values in latencies.items()},
+            "verdict_agreement": round(sum(item["verdict_agree"] for item in items) / count, 3) if count else 1.0,
+            "product_agreement": round(sum(item["product_agree"] for item in items) / count, 3) if count else 1.0,
+            "mean_hit_word_jaccard": round(sum(item["hit_word_jaccard"] for item in items) / count, 3) if count else 1.0,
+            "items": items
+        }
+    
+    def _format_output(self, results: List[ComplianceResult], version_stamp: str = "") -> str:
+        """格式化输出结果，version_stamp非空时在表格后标注审查所用的知识库快照"""
+        footer = f"\n知识库快照: {version_stamp}\n" if version_stamp else ""
         if not results:
-            return "| 品类 | 原文输入 | 审核结果 |\n| ------ | ------ | ---- |\n|  |  | 安全通过 |"
+            output = "| 品类 | 原文输入 | 审核结果 |\n| ------ | ------ | ---- |\n|  |  | 安全通过 |"
+            return f"{output}\n{footer}" if footer else output
         
         # 检查是否有违规
         has_violations = any(result.review_result == "拒绝" for result in results)
@@ -807,7 +4547,7 @@ class ComplianceAgent:
             for result in results:
                 output += f"| {result.category} | {result.original_text} | {result.review_result} |\n"
         
-        return output
+        return output + footer
     
     def upload_documents(self, file_paths: List[str]) -> str:
         """上传合规指引文档"""
@@ -820,20 +4560,50 @@ class ComplianceAgent:
     
     def get_status(self) -> Dict[str, Any]:
         """获取系统状态"""
-        return self.knowledge_base.get_knowledge_base_info()
+        status = self.knowledge_base.get_knowledge_base_info()
+        status["review_cache"] = self.review_cache.get_stats()
+        status["context_packer"] = self.matcher.context_packer.get_stats()
+        image_processor = self.knowledge_base.document_uploader.image_processor
+        status["image_http"] = image_processor.get_stats()
+        status["ocr_cache"] = image_processor.ocr_cache.get_stats() if image_processor.ocr_cache else None
+        return status
     
     def reload_document(self) -> str:
         """重新加载合规指引文档"""
         try:
             success = self.knowledge_base.reload_compliance_document()
             if success:
+                self.review_cache.clear()
                 return "合规指引文档重新加载成功"
             else:
                 return "合规指引文档重新加载失败"
         except Exception as e:
             return f"重新加载失败: {str(e)}"
-    
-    
+
+    def start_reload_document(self) -> ReloadJob:
+        """在后台重新加载合规指引文档，新版本就绪后原子切换，期间审查继续使用旧版本"""
+        def on_complete(job: ReloadJob):
+            if job.status == "succeeded":
+                self.review_cache.clear()
+        return self.knowledge_base.start_reload_job(on_complete=on_complete)
+
+    def get_reload_job(self, job_id: str) -> Optional[ReloadJob]:
+        """查询后台重新加载任务"""
+        return self.knowledge_base.get_reload_job(job_id)
+
+    def list_snapshots(self) -> List[Dict[str, Any]]:
+        """列出知识库快照"""
+        return self.knowledge_base.list_snapshots()
+
+    def activate_snapshot(self, snapshot_id: str) -> Dict[str, Any]:
+        """切换到指定知识库快照（结果缓存按快照ID区分，无需清空）"""
+        return self.knowledge_base.activate_snapshot(snapshot_id)
+
+    def rollback_snapshot(self) -> Dict[str, Any]:
+        """回滚到上一个知识库快照"""
+        return self.knowledge_base.rollback_snapshot()
+
+
     def review_with_image(self, text: str = "", image_path: str = "") -> str:
         """智能审查：支持文本+图片组合输入"""
         try:
@@ -872,17 +4642,64 @@ class ComplianceAgent:
             result = self._perform_compliance_review(full_text)
             
             # 添加输入信息
-            input_info = ""
-            if text and text.strip():
-                input_info += f"文本输入: {text}\n"
-            if image_path and os.path.exists(image_path):
-                input_info += f"图片输入: {image_path}\n"
-            input_info += f"完整输入: {full_text}\n\n"
+            return self._format_input_info(text, image_path, full_text) + result
             
-            return input_info + result
+        except Exception as e:
+            return f"智能审查失败: {str(e)}"
+    
+    async def areview(self, text: str) -> str:
+        """异步审查文本"""
+        if not text or not text.strip():
+            return "错误：没有提供有效的文本或图片输入"
+        return await self._aperform_compliance_review(text.strip())
+    
+    async def areview_with_image(self, text: str = "", image_path: str = "") -> str:
+        """异步智能审查：图片OCR与文本预处理并发执行"""
+        try:
+            text_part = text.strip() if text and text.strip() else ""
+            image_processor = self.knowledge_base.document_uploader.image_processor
+            has_image = bool(image_path and os.path.exists(image_path))
+            
+            if has_image and not image_processor.is_image_file(image_path):
+                return f"错误：不是支持的图片格式: {image_path}"
+            
+            # OCR与文本预处理相互独立，并发执行
+            if has_image:
+                print(f"🖼️ 检测到图片输入: {image_path}")
+                image_text, processed_text_part = await asyncio.gather(
+                    image_processor.aextract_text_from_image(image_path),
+                    asyncio.to_thread(self.preprocessor.preprocess, text_part)
+                )
+                if not image_text:
+                    return f"图片 {image_path} 中未识别到文字"
+            else:
+                image_text = ""
+                processed_text_part = self.preprocessor.preprocess(text_part)
+            
+            full_text = " ".join(part for part in (text_part, image_text) if part)
+            if not full_text.strip():
+                return "错误：没有提供有效的文本或图片输入"
+            
+            # 预处理逐字符进行，分段预处理后拼接与整体预处理结果一致
+            processed_text = " ".join(
+                part for part in (processed_text_part, self.preprocessor.preprocess(image_text)) if part
+            )
+            result = await self._aperform_compliance_review(full_text, processed_text)
+            
+            return self._format_input_info(text, image_path, full_text) + result
             
         except Exception as e:
             return f"智能审查失败: {str(e)}"
+    
+    def _format_input_info(self, text: str, image_path: str, full_text: str) -> str:
+        """生成审查结果前的输入信息"""
+        input_info = ""
+        if text and text.strip():
+            input_info += f"文本输入: {text}\n"
+        if image_path and os.path.exists(image_path):
+            input_info += f"图片输入: {image_path}\n"
+        input_info += f"完整输入: {full_text}\n\n"
+        return input_info
 
 def main():
     """主函数 - 演示用法"""
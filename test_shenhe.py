@@ -1,7 +1,46 @@
 # 测试合规审查Agent
 
 import os
-from shenhe import ComplianceAgent
+import json
+import asyncio
+import threading
+import time
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import faiss
+import numpy as np
+from types import SimpleNamespace
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from shenhe import (
+    CachedEmbeddings,
+    ComplianceAgent,
+    ComplianceKnowledgeBase,
+    ComplianceLexicon,
+    ComplianceMatcher,
+    ContextPacker,
+    EmbeddingCache,
+    EmbeddingPipeline,
+    FaissIndexFactory,
+    ImageProcessor,
+    LexicalIndex,
+    OCRCache,
+    ProductNameExtractor,
+    QueryEmbeddingCache,
+    ReviewCache,
+    RuleCompiler,
+    TextPreprocessor
+)
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.docx")
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """在临时目录中运行测试，知识库与缓存文件不写入仓库"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SILICONFLOW_API_KEY", os.getenv("SILICONFLOW_API_KEY", "test"))
+    return tmp_path
 
 def test_built_in_knowledge_base():
     """测试内置知识库功能"""
@@ -107,6 +146,1004 @@ def test_agent_tools():
         except Exception as e:
             print(f"执行失败: {e}")
 
+def test_lexicon_longest_match():
+    """测试禁用词库的长词优先匹配"""
+    lexicon = ComplianceLexicon()
+    lexicon.add_term("生发", "超范围", "绝对禁止", "指引 二、共性禁用词汇补充说明")
+    lexicon.add_term("生发产品", "超范围", "绝对禁止", "指引 二、共性禁用词汇补充说明")
+    lexicon.add_term("修复毛囊", "医疗术语", "绝对禁止", "指引 1、多肽蓬蓬瓶-修护", product="多肽蓬蓬瓶")
+    lexicon.add_term("毛囊", "医疗术语", "绝对禁止", "指引 一、核心法规依据与通用禁用原则")
+    lexicon.build()
+    
+    text = TextPreprocessor.preprocess("【多肽蓬蓬瓶】这款生发产品能修复毛囊")
+    matches = lexicon.scan(text, "多肽蓬蓬瓶")
+    print(f"命中: {[(m.hit_word, m.rule_source) for m in matches]}")
+    
+    assert [m.hit_word for m in matches] == ["生发产品", "修复毛囊"]
+    assert matches[1].rule_source == "指引 1、多肽蓬蓬瓶-修护"
+    
+    # 其他产品不命中产品专属词汇，回退到共性禁用词
+    matches = lexicon.scan(text, "干发喷雾")
+    assert [m.hit_word for m in matches] == ["生发产品", "毛囊"]
+
+def test_default_lexicon():
+    """测试内置通用禁用词库"""
+    lexicon = ComplianceLexicon.from_default_rules()
+    
+    matches = lexicon.scan("本产品能根治脱发并修复毛囊,效果立竿见影")
+    print(f"命中: {[m.hit_word for m in matches]}")
+    assert [m.hit_word for m in matches] == ["根治", "修复", "毛囊", "立竿见影"]
+    assert all(m.risk_level == "绝对禁止" for m in matches)
+    
+    assert lexicon.scan("温和清洁,呵护秀发健康") == []
+
+def test_gate_compliance_review():
+    """测试词库预审：明确通过/明确拒绝不调用LLM，模糊语义交由LLM"""
+    lexicon = ComplianceLexicon.from_default_rules()
+    knowledge_base = SimpleNamespace(lexicon=lexicon, current_lexicon=lambda: lexicon)
+    matcher = ComplianceMatcher(llm=None, knowledge_base=knowledge_base)
+    
+    results = matcher.gate_compliance_review("温和清洁,呵护秀发健康", "洗发水")
+    assert [r.review_result for r in results] == ["安全通过"]
+    
+    results = matcher.gate_compliance_review("百分之百有效,彻底解决头发问题", "护发素")
+    print(f"预审拒绝: {[r.hit_word for r in results]}")
+    assert [r.hit_word for r in results] == ["百分之百", "彻底"]
+    assert all(r.review_result == "拒绝" for r in results)
+    
+    # 模糊语义需要升级到LLM分析
+    assert matcher.gate_compliance_review("有助于缓解轻微头屑", "洗发水") is None
+
+def test_gate_product_scoped_terms_without_product():
+    """测试未提取到产品名时，产品专属禁用词交由LLM判断，共性禁用词仍直接拒绝"""
+    lexicon = ComplianceLexicon.from_default_rules()
+    lexicon.add_term("头皮", "超范围", "绝对禁止", "指引 1、多肽蓬蓬瓶-修护", product="多肽蓬蓬瓶")
+    lexicon.build()
+    knowledge_base = SimpleNamespace(lexicon=lexicon, current_lexicon=lambda: lexicon)
+    matcher = ComplianceMatcher(llm=None, knowledge_base=knowledge_base)
+    
+    # 产品未知：专属规则是否适用需LLM结合上下文判断
+    assert matcher.gate_compliance_review("洗后头皮清爽舒适", "") is None
+    fallback = matcher._parse_compliance_result_fallback("", "洗后头皮清爽舒适", "")
+    assert fallback == {"violations": [], "manual_review_needed": True}
+    
+    # 产品已知：专属规则直接拒绝
+    results = matcher.gate_compliance_review("洗后头皮清爽舒适", "多肽蓬蓬瓶")
+    assert [(r.review_result, r.hit_word) for r in results] == [("拒绝", "头皮")]
+    
+    # 共性禁用词不依赖产品名，仍然直接拒绝
+    results = matcher.gate_compliance_review("根治头屑", "")
+    assert [(r.review_result, r.hit_word) for r in results] == [("拒绝", "根治")]
+
+def test_rule_compiler(tmp_path):
+    """测试rules.docx编译为规则表"""
+    compiler = RuleCompiler()
+    
+    table_path = os.path.join(tmp_path, "compliance_rule_table.json")
+    table = compiler.load_or_compile("rules.docx", table_path)
+    print(f"规则数量: {len(table)}, 产品: {table.products()}")
+    
+    assert "多肽蓬蓬瓶" in table.products()
+    rules = {rule.phrase: rule for rule in table.rules_for_product("多肽蓬蓬瓶")}
+    assert rules["头皮"].rule_source == "指引 1、多肽蓬蓬瓶-修护"
+    assert rules["治疗敏感头皮"].risk_category == "医疗术语"
+    
+    anti_hair_loss = {rule.phrase: rule for rule in table.rules_for_product("防脱洗发水")}
+    assert anti_hair_loss["增加发量"].risk_level == "绝对禁止"
+    
+    general = {rule.phrase for rule in table.general_rules()}
+    assert {"速效", "顶级", "永不", "消炎"} <= general
+    
+    # 校验和未变化时直接加载已编译的规则表
+    cached = compiler.load_or_compile("rules.docx", table_path)
+    assert cached.checksum == table.checksum
+    assert len(cached) == len(table)
+
+def test_product_name_extractor_fast_path():
+    """测试产品名提取的本地快速路径（不调用LLM）"""
+    table = RuleCompiler().compile_document("rules.docx")
+    knowledge_base = SimpleNamespace(rule_table=table)
+    extractor = ProductNameExtractor(llm=None, knowledge_base=knowledge_base, use_llm_fallback=False)
+    
+    assert extractor.extract_product_name("【多肽蓬蓬瓶】本产品能根治脱发") == "多肽蓬蓬瓶"
+    assert extractor.extract_product_name("【蓬蓬瓶】蓬松一整天") == "多肽蓬蓬瓶"
+    assert extractor.extract_product_name("【洗发水】温和清洁") == "洗发水"
+    assert extractor.extract_product_name("这款干喷控油又清爽") == "干发喷雾"
+    assert extractor.extract_product_name("深层补水,让肌肤水润光滑") == ""
+
+def test_review_cache(tmp_path):
+    """测试审查结果缓存的LRU、TTL、版本失效与SQLite持久化"""
+    db_path = os.path.join(tmp_path, "review_cache.db")
+    cache = ReviewCache(max_entries=2, ttl_seconds=60, db_path=db_path)
+    
+    key_v1 = ReviewCache.make_key("温和清洁", "v1:abc")
+    key_v2 = ReviewCache.make_key("温和清洁", "v2:abc")
+    assert key_v1 != key_v2
+    
+    cache.put(key_v1, "安全通过")
+    assert cache.get(key_v1) == "安全通过"
+    assert cache.get(key_v2) is None
+    
+    # 重启后从SQLite读取
+    restarted = ReviewCache(max_entries=2, ttl_seconds=60, db_path=db_path)
+    assert restarted.get(key_v1) == "安全通过"
+    stats = restarted.get_stats()
+    print(f"缓存统计: {stats}")
+    assert stats["disk_hits"] == 1
+    
+    # 过期条目视为未命中
+    expired = ReviewCache(max_entries=2, ttl_seconds=0, db_path=db_path)
+    assert expired.get(key_v1) is None
+    
+    # LRU淘汰
+    memory_cache = ReviewCache(max_entries=2)
+    for key in ("a", "b", "c"):
+        memory_cache.put(key, key)
+    assert memory_cache.get("a") is None
+    assert memory_cache.get("c") == "c"
+    assert memory_cache.get_stats()["hit_ratio"] == 0.5
+
+def test_match_compliance_rules_batch():
+    """测试批量匹配：检索结果相同的文本合并为一次LLM请求，结果保持输入顺序"""
+    shared_docs = [Document(page_content="绝对化词意：如 根治 彻底 等")]
+    other_docs = [Document(page_content="医疗术语：如 毛囊 修复 等")]
+    
+    def search_batch(queries, k=5, products=None):
+        return [other_docs if "毛囊" in query else shared_docs for query in queries]
+    
+    prompts = []
+    
+    def invoke(prompt):
+        prompts.append(prompt)
+        items = []
+        for i, line in enumerate(l for l in prompt.splitlines() if l.startswith("[")):
+            violations = [{"hit_word": "根治", "risk_level": "绝对禁止"}] if "根治" in line else []
+            items.append({"index": i, "violations": violations, "manual_review_needed": False})
+        return SimpleNamespace(content=json.dumps({"items": items}, ensure_ascii=False))
+    
+    knowledge_base = SimpleNamespace(
+        lexicon=ComplianceLexicon.from_default_rules(),
+        search_compliance_rules_batch=search_batch
+    )
+    matcher = ComplianceMatcher(llm=SimpleNamespace(invoke=invoke), knowledge_base=knowledge_base)
+    
+    items = [("能根治脱发", "多肽蓬蓬瓶"), ("修复毛囊", ""), ("温和清洁", "洗发水")]
+    results = matcher.match_compliance_rules_batch(items)
+    print(f"LLM请求次数: {len(prompts)}")
+    
+    assert len(prompts) == 2
+    assert [r[0].original_text for r in results] == ["能根治脱发", "修复毛囊", "温和清洁"]
+    assert results[0][0].review_result == "拒绝"
+    assert results[2][0].review_result == "安全通过"
+
+class CountingEmbeddings:
+    """记录上游请求的假嵌入模型"""
+    model = "fake-embedding"
+    
+    def __init__(self):
+        self.embedded = []
+    
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+    
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+    
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+def test_embedding_cache(tmp_path):
+    """测试持久化嵌入缓存：重建时只嵌入新增或修改的片段"""
+    base = CountingEmbeddings()
+    cache = EmbeddingCache(tmp_path, CachedEmbeddings.model_name_of(base))
+    embeddings = CachedEmbeddings(base, cache)
+    
+    first = embeddings.embed_documents(["修护", "清洁", "修护"])
+    assert base.embedded == ["修护", "清洁"]
+    assert first[0] == first[2]
+    
+    # 重新打开缓存（模拟重启），只有新片段请求上游
+    base = CountingEmbeddings()
+    reopened = CachedEmbeddings(base, EmbeddingCache(tmp_path, "fake-embedding"))
+    second = reopened.embed_documents(["清洁", "控油"])
+    print(f"重启后上游嵌入: {base.embedded}")
+    assert base.embedded == ["控油"]
+    assert second[0] == first[1]
+    assert len(reopened.cache) == 3
+
+class FlakyEmbeddings(CountingEmbeddings):
+    """在第N次请求时失败的假嵌入模型，记录最大并发请求数"""
+    
+    def __init__(self, fail_on_call=0):
+        super().__init__()
+        self.fail_on_call = fail_on_call
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+    
+    def embed_documents(self, texts):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(0.01)
+            if call == self.fail_on_call:
+                raise ConnectionError("上游限流")
+            with self.lock:
+                return super().embed_documents(texts)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+def test_embedding_pipeline(tmp_path):
+    """测试批量嵌入管线：并发受限，中断后从已完成批次继续"""
+    texts = [f"规则片段{i}" for i in range(10)]
+    base = FlakyEmbeddings(fail_on_call=3)
+    cache = EmbeddingCache(tmp_path, "fake-embedding")
+    pipeline = EmbeddingPipeline(base, cache, batch_size=2, max_workers=1, max_retries=0)
+    try:
+        pipeline.embed(texts)
+        assert False, "第3批失败时应抛出异常"
+    except ConnectionError:
+        pass
+    # 失败前完成的批次已写入缓存（失败时已在执行的批次也会完成）
+    completed = len(cache)
+    assert 4 <= completed < len(texts)
+    
+    # 重启后只嵌入剩余批次
+    base = FlakyEmbeddings()
+    progress = []
+    pipeline = EmbeddingPipeline(base, EmbeddingCache(tmp_path, "fake-embedding"), batch_size=2, max_workers=2)
+    vectors = pipeline.embed(texts, lambda done, total: progress.append((done, total)))
+    print(f"断点续传嵌入: {base.embedded}，统计: {pipeline.get_stats()}")
+    remaining = len(texts) - completed
+    assert len(base.embedded) == remaining and not set(base.embedded) & set(texts[:4])
+    assert vectors.shape == (10, 3)
+    assert base.max_active <= 2
+    assert progress[-1] == (remaining, remaining)
+    
+    # 失败的批次按退避重试
+    base = FlakyEmbeddings(fail_on_call=1)
+    pipeline = EmbeddingPipeline(base, EmbeddingCache(tmp_path / "retry", "fake-embedding"),
+                                 batch_size=4, backoff_seconds=0.01)
+    pipeline.embed(texts[:4])
+    assert pipeline.get_stats()["retries"] == 1 and base.embedded == texts[:4]
+    
+    # 空输入不请求上游，返回0行矩阵
+    assert pipeline.embed([]).shape == (0, 3) and base.calls == 2
+
+def test_query_embedding_cache(tmp_path):
+    """测试查询嵌入缓存：归一化后相同的查询只请求一次上游，批量接口合并请求"""
+    db_path = os.path.join(tmp_path, "query_cache.db")
+    base = CountingEmbeddings()
+    query_cache = QueryEmbeddingCache("fake-embedding", max_entries=2, db_path=db_path)
+    embeddings = CachedEmbeddings(base, EmbeddingCache(tmp_path, "fake-embedding"), query_cache)
+    
+    first = embeddings.embed_query("修复毛囊 根治")
+    assert embeddings.embed_query("  修复毛囊   根治 ") == first
+    assert base.embedded == ["修复毛囊 根治"]
+    
+    # 批量查询：命中的直接返回，未命中的去重后一次请求
+    vectors = embeddings.embed_queries(["控油", "修复毛囊 根治", "控油"])
+    assert base.embedded == ["修复毛囊 根治", "控油"]
+    assert vectors[1] == first and vectors[0] == vectors[2]
+    stats = query_cache.get_stats()
+    print(f"查询缓存统计: {stats}")
+    assert stats["hits"] == 2 and stats["misses"] == 3
+    
+    # LRU淘汰最久未使用的条目，重新打开后从磁盘恢复
+    embeddings.embed_query("蓬松")
+    reopened = QueryEmbeddingCache("fake-embedding", max_entries=2, db_path=db_path)
+    assert len(reopened) == 2
+    assert reopened.get(reopened.make_key("控油")) is not None
+    assert reopened.get(reopened.make_key("修复毛囊 根治")) is None
+    
+    # 命中会刷新磁盘上的使用时间，再次重启时保留最近命中的条目
+    reopened.put(reopened.make_key("清洁"), [1.0, 2.0, 3.0])
+    restarted = QueryEmbeddingCache("fake-embedding", max_entries=2, db_path=db_path)
+    assert restarted.get(restarted.make_key("控油")) is not None
+    assert restarted.get(restarted.make_key("蓬松")) is None
+    
+    # 磁盘条目超出上限一批后才淘汰
+    for i in range(40):
+        restarted.put(restarted.make_key(f"文案{i}"), [float(i)] * 3)
+    rows = restarted._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+    assert rows <= restarted.max_entries + restarted.batch_size and len(restarted) == 2
+
+def test_incremental_reload(workdir):
+    """测试增量重载：只嵌入新增片段，删除已移除片段，未变化片段ID保持不变"""
+    guide = "\n\n".join(["一、通用原则 禁用立竿见影", "1、多肽蓬蓬瓶 禁用修复毛囊", "2、洗发水 禁用根治头屑"])
+    # 本测试不调用OCR，仅需满足图片处理器初始化
+    base = CountingEmbeddings()
+    knowledge_base = ComplianceKnowledgeBase(base)
+    knowledge_base.text_splitter = RecursiveCharacterTextSplitter(chunk_size=20, chunk_overlap=0)
+    knowledge_base.build_knowledge_base_from_text(guide)
+    original_ids = set(knowledge_base.vectorstore.index_to_docstore_id.values())
+    version = knowledge_base.version
+    
+    # 修改一条规则后重载
+    edited = guide.replace("根治头屑", "彻底去屑")
+    knowledge_base.load_compliance_document = lambda: edited
+    base.embedded.clear()
+    assert knowledge_base.reload_compliance_document()
+    
+    changes = knowledge_base.last_reload_changes
+    assert len(changes["added"]) == 1 and len(changes["removed"]) == 1
+    assert set(changes["unchanged"]) <= original_ids
+    assert base.embedded == ["一、通用原则 禁用立竿见影\n2、洗发水 禁用彻底去屑"]
+    assert knowledge_base.version == version + 1
+    assert knowledge_base.vectorstore.index.ntotal == len(original_ids)
+    
+    # 内容未变化时不重新嵌入，版本号保持不变
+    base.embedded.clear()
+    assert knowledge_base.reload_compliance_document()
+    assert base.embedded == []
+    assert knowledge_base.version == version + 1
+    
+    # 片段全部删除：HNSW索引不支持删除，重建为同维度的空索引
+    knowledge_base.index_factory = FaissIndexFactory(index_type="HNSW")
+    hnsw = knowledge_base._create_vectorstore(knowledge_base.split_guideline(edited))
+    emptied, changes = knowledge_base.apply_incremental_update(hnsw, [])
+    assert emptied.index.ntotal == 0 and emptied.index.d == 3
+    assert len(changes["removed"]) == hnsw.index.ntotal and changes["added"] == []
+
+def test_structured_guideline_chunks(workdir):
+    """测试按文档结构切分：每个产品的禁用词表为一个片段，片段标注标题路径"""
+    knowledge_base = ComplianceKnowledgeBase(CountingEmbeddings())
+    documents = knowledge_base.split_guideline_blocks(RuleCompiler()._read_docx_blocks(RULES_PATH))
+    
+    product_docs = [doc for doc in documents if doc.metadata["product"]]
+    assert sorted(doc.metadata["product"] for doc in product_docs) == ["免洗洗发水", "多肽蓬蓬瓶", "干发喷雾", "防脱洗发水"]
+    spray = next(doc for doc in product_docs if doc.metadata["product"] == "干发喷雾")
+    print(f"干发喷雾片段: {spray.metadata['heading_path']}\n{spray.page_content}")
+    assert "持久留香" in spray.page_content and "除菌" in spray.page_content
+    assert spray.metadata["heading_path"].startswith("一、核心法规依据与通用禁用原则 > 2、干发喷雾")
+    
+    general = [doc for doc in documents if doc.metadata["section"].startswith("二、")]
+    assert len(general) == 3 and all(doc.page_content.startswith("二、共性禁用词汇补充说明\n") for doc in general)
+    assert max(len(doc.page_content) for doc in documents) <= 1000
+
+def test_metadata_filtered_search(workdir):
+    """测试片段元数据标注与按产品过滤检索（始终附带通用禁用原则）"""
+    guide = "\n".join([
+        "一、核心法规依据与通用禁用原则",
+        "1. 绝对化词汇禁用：立竿见影、根治",
+        "1、多肽蓬蓬瓶（常规备案功效：09 清洁 / 13 护发）",
+        "禁用：修复毛囊、生发",
+        "2、干发喷雾（常规备案功效：09 清洁 / 12 美容修饰）",
+        "禁用：去屑、修护",
+        "三、功效宣称分类",
+        "清洁：清洗，洁净"
+    ])
+    knowledge_base = ComplianceKnowledgeBase(CountingEmbeddings())
+    documents = knowledge_base.split_guideline(guide)
+    tags = [(doc.metadata["product"], doc.metadata["rule_category"]) for doc in documents]
+    assert tags == [("", "通用禁用"), ("多肽蓬蓬瓶", "产品专属"), ("干发喷雾", "产品专属"), ("", "参考说明")]
+    
+    knowledge_base.build_knowledge_base_from_text(guide)
+    docs = knowledge_base.search_compliance_rules("生发", k=10, product="蓬蓬瓶")
+    products = {doc.metadata["product"] for doc in docs}
+    assert products == {"多肽蓬蓬瓶", ""}
+    assert any(doc.metadata["rule_category"] == "通用禁用" for doc in docs)
+    
+    # 未知产品不过滤
+    assert len(knowledge_base.search_compliance_rules("生发", k=10, product="面膜")) == len(documents)
+
+def test_lexical_index(tmp_path):
+    """测试字符n-gram BM25词法索引：精确禁用词排名靠前，保存后可重新加载"""
+    documents = {
+        "a": Document(page_content="多肽蓬蓬瓶 禁用：修复毛囊、生发"),
+        "b": Document(page_content="干发喷雾 禁用：去屑、修护"),
+        "c": Document(page_content="清洁：清洗，洁净，洗发")
+    }
+    index = LexicalIndex.from_documents(documents)
+    ranked = index.search("本产品能修复毛囊", k=2)
+    print(f"词法检索结果: {ranked}")
+    assert ranked[0][0] == "a"
+    assert index.search("面膜补水") == []
+    
+    path = os.path.join(tmp_path, "lexical_index.json")
+    index.save(path)
+    assert LexicalIndex.load(path).search("本产品能修复毛囊", k=2) == ranked
+
+def test_faiss_index_factory():
+    """测试FAISS索引按规模自动选择，IVF索引训练后可检索并暴露nprobe"""
+    factory = FaissIndexFactory()
+    assert factory.select_type(500) == "Flat"
+    assert factory.select_type(50000) == "HNSW"
+    assert FaissIndexFactory(recall_target=0.9).select_type(50000) == "IVFFlat"
+    assert factory.select_type(1000000) == "IVFSQ8"
+    assert factory.select_type(5000000) == "IVFPQ"
+    
+    vectors = np.random.default_rng(0).normal(size=(2000, 16)).astype(np.float32)
+    index = FaissIndexFactory(index_type="IVFFlat", nprobe=8).build(vectors)
+    index.add(vectors)
+    info = FaissIndexFactory.describe(index)
+    print(f"IVF索引信息: {info}")
+    assert info["nprobe"] == 8 and info["nlist"] == FaissIndexFactory.nlist_for(2000)
+    _, ids = index.search(vectors[:5], 1)
+    assert list(ids[:, 0]) == [0, 1, 2, 3, 4]
+    
+    # 样本不足以训练时退回精确索引
+    small = FaissIndexFactory(index_type="IVFPQ").build(vectors[:20])
+    assert FaissIndexFactory.describe(small)["type"].startswith("IndexFlat")
+
+def test_faiss_index_mmap(tmp_path):
+    """测试只有实际映射自磁盘的索引才被视为内存映射（faiss<1.10的Flat/HNSW会完整读入内存）"""
+    vectors = np.random.default_rng(0).normal(size=(2000, 16)).astype(np.float32)
+    flat_supported = hasattr(faiss, "IO_FLAG_MMAP_IFC")
+    for index_type, expected in [("IVFFlat", True), ("Flat", flat_supported), ("HNSW", flat_supported)]:
+        index = FaissIndexFactory(index_type=index_type).build(vectors)
+        index.add(vectors)
+        path = os.path.join(tmp_path, f"{index_type}.faiss")
+        faiss.write_index(index, path)
+        loaded = faiss.read_index(path, FaissIndexFactory.mmap_io_flags())
+        print(f"{index_type}: mmap={FaissIndexFactory.is_memory_mapped(loaded)}")
+        assert FaissIndexFactory.is_memory_mapped(loaded) == expected
+
+def test_knowledge_base_persistence(workdir):
+    """测试无pickle持久化：内存映射加载结果与原库一致，修改前自动转为可写索引"""
+    guide = "\n\n".join(f"{i}、规则{i} 禁用词汇{i * 7919 % 1000}" for i in range(60))
+    knowledge_base = ComplianceKnowledgeBase(CountingEmbeddings())
+    knowledge_base.text_splitter = RecursiveCharacterTextSplitter(chunk_size=20, chunk_overlap=0)
+    knowledge_base.index_factory = FaissIndexFactory(index_type="IVFFlat", nprobe=2)
+    knowledge_base.build_knowledge_base_from_text(guide)
+    assert sorted(os.listdir("compliance_knowledge_base")) == ["CURRENT", "embedding_cache", "manifest.json", "ocr_cache.db", "versions"]
+    assert sorted(os.listdir(knowledge_base._active_dir())) == [
+        "docstore.sqlite", "index.faiss", "lexical_index.json"
+    ]
+    
+    loaded = ComplianceKnowledgeBase(CountingEmbeddings())
+    loaded.index_factory = knowledge_base.index_factory
+    assert loaded.load_knowledge_base()
+    info = loaded.get_knowledge_base_info()
+    print(f"加载后的知识库信息: {info['index']} {info['storage']}")
+    assert info["storage"]["mmap"] and info["index"]["nprobe"] == 2
+    expected = [doc.id for doc in knowledge_base.search_compliance_rules("规则7 禁用词汇", k=3)]
+    assert [doc.id for doc in loaded.search_compliance_rules("规则7 禁用词汇", k=3)] == expected
+    
+    # 在可写副本上追加片段并发布新版本
+    assert loaded.add_documents([Document(page_content="新增规则 禁用奇迹")]) == 1
+    assert not loaded.get_knowledge_base_info()["storage"]["mmap"]
+    assert loaded.vectorstore.index.ntotal == knowledge_base.vectorstore.index.ntotal + 1
+
+def test_context_packer():
+    """测试上下文打包：去除相邻片段重叠、近似重复去重并控制在token预算内"""
+    guide = "".join(f"第{i}条：禁止使用“绝对词汇{i}”等表述，违者下架处理。" for i in range(30))
+    splitter = RecursiveCharacterTextSplitter(chunk_size=120, chunk_overlap=40, separators=["。"], keep_separator="end")
+    docs = [Document(page_content=chunk) for chunk in splitter.split_text(guide)][:4]
+    docs.append(Document(page_content=docs[0].page_content + " "))
+    
+    packer = ContextPacker(token_budget=10000)
+    packed = packer.pack(docs)
+    print(f"打包结果: {packer.get_stats()}")
+    joined = "\n".join(doc.page_content for doc in docs)
+    assert len(packed) < len(joined)
+    # 每条规则只出现一次，重叠部分与重复片段被去除
+    for i in range(3):
+        assert packed.count(f"第{i}条") == 1
+    assert packer.get_stats()["dropped_passages"] == 1
+    
+    budgeted = ContextPacker(token_budget=60)
+    packed = budgeted.pack(docs)
+    assert packed and budgeted.count_tokens(packed) <= 60
+    assert ContextPacker(token_budget=60).pack([]) == ""
+
+def test_knowledge_base_snapshots(workdir):
+    """测试内容寻址快照：误添加规则后回滚不重新嵌入，审查结果标注快照版本"""
+    # 仓库中随附的旧版布局文件不属于快照，清理旧快照时保持不动
+    os.makedirs("compliance_knowledge_base")
+    legacy_files = [os.path.join("compliance_knowledge_base", name) for name in ("index.faiss", "index.pkl")]
+    for path in legacy_files:
+        with open(path, "wb") as f:
+            f.write(b"legacy")
+    
+    embeddings = CountingEmbeddings()
+    knowledge_base = ComplianceKnowledgeBase(embeddings)
+    knowledge_base.build_knowledge_base_from_text("1、禁止使用最好\n\n2、禁止使用第一")
+    original_id = knowledge_base.snapshot_id
+    
+    assert knowledge_base.add_documents([Document(page_content="误添加的规则")]) == 1
+    assert knowledge_base.snapshot_id != original_id and knowledge_base.version == 2
+    
+    snapshots = knowledge_base.list_snapshots()
+    print(f"知识库快照: {snapshots}")
+    assert [item["id"] for item in snapshots] == [knowledge_base.snapshot_id, original_id]
+    assert snapshots[0]["active"] and snapshots[0]["parent"] == original_id and snapshots[0]["added"] == 1
+    assert snapshots[1]["embedding_model"] == "fake-embedding" and snapshots[1]["dimension"] == 3
+    
+    # 回滚只切换指针并加载索引，不产生嵌入请求
+    embedded = len(embeddings.embedded)
+    assert knowledge_base.rollback_snapshot()["id"] == original_id
+    assert knowledge_base.snapshot_id == original_id and len(embeddings.embedded) == embedded
+    assert knowledge_base.vectorstore.index.ntotal == 2
+    assert knowledge_base.version_stamp.startswith(original_id)
+    
+    # 再次添加相同内容得到相同快照ID，直接切换
+    knowledge_base.add_documents([Document(page_content="误添加的规则")])
+    assert knowledge_base.snapshot_id == snapshots[0]["id"] and len(knowledge_base.list_snapshots()) == 2
+    
+    # 固定快照期间切换不影响已取得的版本标识
+    with knowledge_base.pin_snapshot() as version_stamp:
+        knowledge_base.activate_snapshot(original_id)
+        assert knowledge_base.version_stamp == version_stamp
+        assert knowledge_base.search_compliance_rules("误添加", k=1)
+    assert knowledge_base.version_stamp != version_stamp
+    
+    output = ComplianceAgent._format_output(None, [], version_stamp)
+    assert output.endswith(f"知识库快照: {version_stamp}\n")
+    
+    try:
+        knowledge_base.activate_snapshot("missing")
+        assert False, "不存在的快照应抛出ValueError"
+    except ValueError:
+        pass
+    
+    knowledge_base.snapshot_retention = 1
+    knowledge_base.add_documents([Document(page_content="新增规则")])
+    assert os.listdir(os.path.join("compliance_knowledge_base", "versions")) == [knowledge_base.snapshot_id]
+    assert all(open(path, "rb").read() == b"legacy" for path in legacy_files)
+
+def test_background_reload(workdir):
+    """测试后台重新加载：新版本写入独立目录后切换，切换前已取得的旧版本仍可检索"""
+    knowledge_base = ComplianceKnowledgeBase(CountingEmbeddings())
+    knowledge_base.text_splitter = RecursiveCharacterTextSplitter(chunk_size=20, chunk_overlap=0)
+    guide = "1、禁止使用最好\n\n2、禁止使用第一"
+    knowledge_base.load_compliance_document = lambda: guide
+    knowledge_base.load_rule_table = lambda: None
+    assert knowledge_base.reload_compliance_document()
+    old_dir = knowledge_base._active_dir()
+    old_vectorstore, _ = knowledge_base._current_state()
+    
+    guide = "1、禁止使用最好\n\n3、禁止使用根治"
+    progress = []
+    job = knowledge_base.start_reload_job(on_complete=lambda job: progress.append(job.progress))
+    for _ in range(100):
+        if knowledge_base.get_reload_job(job.job_id).status in ("succeeded", "failed"):
+            break
+        time.sleep(0.05)
+    print(f"重新加载任务: {job.to_dict()}")
+    assert job.status == "succeeded" and progress == [1.0]
+    assert job.result["added"] == 1 and job.result["removed"] == 1
+    
+    # 指针指向新版本目录，旧版本对象未被修改
+    assert knowledge_base._active_dir() != old_dir
+    assert "根治" in "".join(doc.page_content for doc in knowledge_base.vectorstore.docstore._dict.values())
+    assert "第一" in "".join(doc.page_content for doc in old_vectorstore.docstore._dict.values())
+    assert knowledge_base.get_reload_job("missing") is None
+
+class FakeVLMHandler(BaseHTTPRequestHandler):
+    """返回固定OCR结果的本地多模态接口，支持keep-alive"""
+    protocol_version = "HTTP/1.1"
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"choices": [{"message": {"content": "修护精华\n温和不刺激"}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def vlm_server(workdir, monkeypatch):
+    """启动本地模拟多模态接口，并将SILICONFLOW_BASE_URL指向它"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeVLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("SILICONFLOW_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}/v1")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_image_processor_connection_reuse(vlm_server):
+    """测试图片OCR复用长连接：连续识别多张图片只建立一次连接，重复图片命中OCR缓存"""
+    processor = ImageProcessor()
+    image_paths = []
+    for i in range(3):
+        image_paths.append(f"detail_{i}.jpg")
+        with open(image_paths[-1], "wb") as f:
+            f.write(f"fake-image-{i}".encode())
+    texts = [processor.extract_text_from_image(path) for path in image_paths]
+    assert processor.extract_text_from_image(image_paths[0]) == texts[0]
+    stats = processor.get_stats()
+    print(f"连接复用统计: {stats}")
+    assert texts == ["修护精华 温和不刺激"] * 3
+    assert stats["requests"] == 3 and stats["connections"] == 1 and stats["reused"] == 2
+    assert stats["timeout"]["connect"] < stats["timeout"]["read"]
+    assert processor.ocr_cache.get_stats()["exact_hits"] == 1
+    processor.close()
+
+def make_banner(seed, width=400, height=240):
+    """生成带随机色块的测试图片"""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    for _ in range(12):
+        x, y = int(rng.integers(0, width - 60)), int(rng.integers(0, height - 30))
+        cv2.rectangle(image, (x, y), (x + 60, y + 30), tuple(int(c) for c in rng.integers(0, 200, 3)), -1)
+    return image
+
+def test_ocr_cache(tmp_path):
+    """测试OCR缓存：重新压缩、缩放的图片按感知哈希命中，按大小淘汰旧条目"""
+    cache = OCRCache(os.path.join(tmp_path, "ocr.db"), "fake-vlm")
+    banner = make_banner(0)
+    original = cv2.imencode(".png", banner)[1].tobytes()
+    cache.put(original, "修护精华 温和不刺激")
+    
+    # 缩小并重新压缩为JPEG后仍命中同一结果
+    resized = cv2.imencode(".jpg", cv2.resize(banner, (300, 180)), [cv2.IMWRITE_JPEG_QUALITY, 70])[1].tobytes()
+    assert cache.get(original) == "修护精华 温和不刺激"
+    assert cache.get(resized) == "修护精华 温和不刺激"
+    assert cache.get(cv2.imencode(".png", make_banner(1))[1].tobytes()) is None
+    
+    # 同一模板上改动文案的图片不命中
+    edited = banner.copy()
+    cv2.putText(edited, "SALE", (10, 230), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+    assert cache.get(cv2.imencode(".png", edited)[1].tobytes()) is None
+    stats = cache.get_stats()
+    print(f"OCR缓存统计: {stats}")
+    assert (stats["exact_hits"], stats["near_hits"], stats["misses"]) == (1, 1, 2)
+    
+    # 重启后仍然命中；超出大小上限时淘汰最久未使用的条目
+    reopened = OCRCache(os.path.join(tmp_path, "ocr.db"), "fake-vlm", max_bytes=10000)
+    assert reopened.get(resized) == "修护精华 温和不刺激"
+    for seed in range(2, 6):
+        reopened.put(cv2.imencode(".png", make_banner(seed))[1].tobytes(), f"文案{seed}" * 10)
+    assert reopened.get(original) is None
+    assert len(reopened) < 5 and reopened.get_stats()["size_bytes"] <= 10000
+    
+    # 新写入的条目追加到内存索引后即可近似命中，内存索引与数据库一致
+    newest = cv2.imencode(".jpg", cv2.resize(make_banner(5), (300, 180)), [cv2.IMWRITE_JPEG_QUALITY, 70])[1].tobytes()
+    assert reopened.get(newest) == "文案5" * 10
+    restarted = OCRCache(os.path.join(tmp_path, "ocr.db"), "fake-vlm", max_bytes=10000)
+    assert (len(restarted), sorted(restarted._keys)) == (len(reopened), sorted(reopened._keys))
+    
+    # 同一数据库中不同模型的条目分别计算大小上限
+    other = OCRCache(os.path.join(tmp_path, "ocr.db"), "other-vlm", max_bytes=10000)
+    other.put(original, "其他模型结果")
+    for seed in range(6, 10):
+        reopened.put(cv2.imencode(".png", make_banner(seed))[1].tobytes(), f"文案{seed}" * 10)
+    assert other.get(original) == "其他模型结果" and len(other) == 1
+
+def test_image_prepare(workdir):
+    """测试上传前压缩图片：限制最长边、按实际格式标注MIME类型，透明背景合成白底"""
+    processor = ImageProcessor()
+    processor.ocr_cache = None
+    
+    # 大尺寸PNG照片缩放到最长边2048并转为JPEG
+    noise = np.random.default_rng(0).integers(-8, 9, (1800, 3000, 3), dtype=np.int16)
+    photo = np.clip(cv2.resize(make_banner(0), (3000, 1800)) + noise, 0, 255).astype(np.uint8)
+    png = cv2.imencode(".png", photo)[1].tobytes()
+    payload, mime_type = processor.prepare_image(png)
+    decoded = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    assert mime_type == "image/jpeg" and len(payload) < len(png) / 4
+    assert max(decoded.shape[:2]) == 2048
+    
+    # 纯色块截图保留PNG（比JPEG更小），但仍然缩放
+    screenshot = cv2.imencode(".png", cv2.resize(make_banner(0), (3000, 1800), interpolation=cv2.INTER_NEAREST))[1].tobytes()
+    payload, mime_type = processor.prepare_image(screenshot)
+    assert mime_type == "image/png" and len(payload) < len(screenshot)
+    
+    # 长图保留短边分辨率，已足够小的JPEG原样上传
+    tall = cv2.imencode(".png", cv2.resize(make_banner(1), (750, 6000)))[1].tobytes()
+    assert cv2.imdecode(np.frombuffer(processor.prepare_image(tall)[0], dtype=np.uint8), cv2.IMREAD_COLOR).shape[1] == 750
+    small = cv2.imencode(".jpg", make_banner(2), [cv2.IMWRITE_JPEG_QUALITY, 60])[1].tobytes()
+    assert processor.prepare_image(small) == (small, "image/jpeg")
+    assert processor.prepare_image(b"GIF89a...") == (b"GIF89a...", "image/gif")
+    
+    # 透明PNG合成到白底，可选输出灰度WebP
+    transparent = np.zeros((100, 100, 4), dtype=np.uint8)
+    processor.image_format, processor.grayscale = "webp", True
+    payload, mime_type = processor.prepare_image(cv2.imencode(".png", transparent)[1].tobytes())
+    decoded = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    assert mime_type == "image/webp" and decoded.min() > 250
+    processor.close()
+
+def test_tall_image_tiling(workdir):
+    """测试长图切块：重叠切块并行识别，拼接时去除重叠区域的重复行"""
+    processor = ImageProcessor()
+    processor.text_detector = None  # 测试图片只有色块，不做文字预检
+    page = np.full((6000, 750, 3), 255, dtype=np.uint8)
+    for i in range(100):
+        cv2.rectangle(page, (40, 60 * i + 20), (40 + 6 * i, 60 * i + 40), (0, 0, 0), -1)
+    cv2.imwrite("详情页.png", page)
+    bounds = processor.tile_bounds(6000, 750)
+    assert len(bounds) == 5 and bounds[0][0] == 0 and bounds[-1][1] == 6000
+    assert all(bottom > next_top for (_, bottom), (next_top, _) in zip(bounds, bounds[1:]))
+    
+    # 每60像素一行文字，块边缘被切断的行只识别出前两个字
+    lines = [(60 * i + 30, f"第{i}行 温和修护") for i in range(100)]
+    split_tiles = processor.split_tiles
+    payloads = []
+    active = [0, 0]
+    lock = threading.Lock()
+    
+    def record_tiles(image_bytes):
+        payloads.extend(split_tiles(image_bytes))
+        return payloads
+    
+    def fake_ocr(payload):
+        with lock:
+            active[0] += 1
+            active[1] = max(active[1], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        top, bottom = bounds[payloads.index(payload)]
+        return "\n".join(
+            text if top + 10 <= y < bottom - 10 else text[:2]
+            for y, text in lines if top <= y < bottom
+        )
+    
+    processor.split_tiles = record_tiles
+    processor._ocr_payload = fake_ocr
+    text = processor.extract_text_from_image("详情页.png")
+    print(f"切块统计: {processor.get_stats()['tiling']}，最大并发 {active[1]}")
+    assert text == " ".join(line for _, line in lines)
+    assert 1 < active[1] <= processor.tile_workers
+    assert processor.get_stats()["tiling"] == {"tiled_images": 1, "tiles": len(bounds)}
+    assert processor.ocr_cache.get_stats()["entries"] == 1
+    processor.close()
+
+def make_photo(seed, width=800, height=600):
+    """生成不含文字的模拟产品照片：渐变背景、模糊色块与噪点"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    image = np.stack([xx * 255 / width, yy * 255 / height, np.full((height, width), 128)], axis=-1).astype(np.float32)
+    for _ in range(6):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(image, center, int(rng.integers(30, 150)), tuple(float(c) for c in rng.integers(0, 255, 3)), -1)
+    image = cv2.GaussianBlur(image, (31, 31), 0) + rng.normal(0, 4, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def make_glow_text(seed):
+    """生成低对比度柔光艺术字叠加在照片上的促销图（MSER检测不到的文字）"""
+    photo = make_photo(seed)
+    text = np.zeros(photo.shape[:2], dtype=np.uint8)
+    cv2.putText(text, "SALE 50% OFF", (60, 320), cv2.FONT_HERSHEY_SCRIPT_COMPLEX, 2.5, 255, 4)
+    glow = cv2.GaussianBlur(text, (9, 9), 0).astype(np.int16)[..., None] * 24 // 255
+    return np.clip(photo.astype(np.int16) + glow, 0, 255).astype(np.uint8)
+
+def test_text_region_prescreen(workdir, monkeypatch):
+    """测试文字区域预检：默认关闭；crop模式只裁剪文字条带，未检测到文字时仍整张上传；skip模式跳过无文字图片"""
+    assert ImageProcessor().get_stats()["prescreen"]["mode"] == "off"
+    monkeypatch.setenv("COMPLIANCE_OCR_PRESCREEN", "crop")
+    processor = ImageProcessor()
+    sent = []
+    processor._ocr_payload = lambda payload: sent.append(payload) or "限时特惠"
+    
+    # 低对比度艺术字检测不到文字区域，仍整张上传
+    for seed in range(3):
+        assert processor.text_detector.detect(make_photo(seed)) == []
+        assert processor.text_detector.detect(make_glow_text(seed)) == []
+    cv2.imwrite("艺术字.png", make_glow_text(0))
+    assert processor.extract_text_from_image("艺术字.png") == "限时特惠"
+    assert cv2.imdecode(np.frombuffer(sent[0][0], dtype=np.uint8), cv2.IMREAD_COLOR).shape[:2] == (600, 800)
+    
+    # 照片角落的小字只上传所在条带
+    photo = make_photo(1)
+    cv2.putText(photo, "Sale 50% off today", (50, 500), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+    cv2.imwrite("促销图.png", photo)
+    assert processor.extract_text_from_image("促销图.png") == "限时特惠"
+    crop = cv2.imdecode(np.frombuffer(sent[1][0], dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert crop.shape[1] == 800 and crop.shape[0] < 100
+    
+    # 文字铺满的图片整张上传
+    page = np.full((1200, 750, 3), 255, dtype=np.uint8)
+    for y in range(30, 1200, 40):
+        cv2.putText(page, f"Ingredients water glycerin {y}", (20, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (30, 30, 30), 1)
+    cv2.imwrite("成分表.png", page)
+    processor.extract_text_from_image("成分表.png")
+    assert cv2.imdecode(np.frombuffer(sent[2][0], dtype=np.uint8), cv2.IMREAD_COLOR).shape[:2] == (1200, 750)
+    stats = processor.get_stats()["prescreen"]
+    print(f"预检统计: {stats}")
+    assert stats == {"mode": "crop", "undetected_images": 1, "skipped_images": 0, "cropped_images": 1}
+    processor.close()
+    
+    # skip模式不上传未检测到文字的图片
+    monkeypatch.setenv("COMPLIANCE_OCR_PRESCREEN", "skip")
+    processor = ImageProcessor()
+    processor._ocr_payload = lambda payload: sent.append(payload) or "限时特惠"
+    cv2.imwrite("产品图.png", make_photo(2))
+    assert processor.extract_text_from_image("产品图.png") == "" and len(sent) == 3
+    assert processor.get_stats()["prescreen"]["skipped_images"] == 1
+    processor.close()
+
+REVIEW_GUIDE = "\n".join([
+    "一、核心法规依据与通用禁用原则",
+    "1. 绝对化词汇禁用：立竿见影、根治",
+    "1、多肽蓬蓬瓶（常规备案功效：09 清洁 / 13 护发）",
+    "禁用：修复毛囊、生发"
+])
+
+class FakeChatLLM:
+    """按待审查文本返回分析JSON的假LLM，记录异步调用的最大并发数"""
+    
+    def __init__(self, delay=0.0, content=None):
+        self.delay = delay
+        self.content = content
+        self.prompts = []
+        self.active = 0
+        self.max_active = 0
+    
+    def invoke(self, prompt):
+        self.prompts.append(prompt)
+        if self.content is not None:
+            return SimpleNamespace(content=self.content)
+        text = next(line for line in prompt.splitlines() if line.startswith("待审查文本"))
+        violations = [{"hit_word": "根治", "risk_category": "绝对化", "risk_level": "绝对禁止",
+                       "rule_source": "通用禁用原则", "brief_description": "绝对化用语"}] if "根治" in text else []
+        return SimpleNamespace(content=json.dumps({"violations": violations, "manual_review_needed": False},
+                                                  ensure_ascii=False))
+    
+    async def ainvoke(self, prompt):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(self.delay)
+        self.active -= 1
+        return self.invoke(prompt)
+
+def make_review_agent(llm, single_pass=False):
+    """不经过ComplianceAgent.__init__构建审查Agent：假LLM、本地假嵌入知识库"""
+    knowledge_base = ComplianceKnowledgeBase(CountingEmbeddings())
+    knowledge_base.build_knowledge_base_from_text(REVIEW_GUIDE)
+    agent = ComplianceAgent.__new__(ComplianceAgent)
+    agent.gating = False
+    agent.single_pass = single_pass
+    agent.review_cache = ReviewCache(max_entries=16)
+    agent.llm = llm
+    agent.preprocessor = TextPreprocessor()
+    agent.knowledge_base = knowledge_base
+    agent.product_extractor = ProductNameExtractor(llm, knowledge_base)
+    agent.matcher = ComplianceMatcher(llm, knowledge_base)
+    return agent
+
+def test_asearch_compliance_rules(workdir):
+    """测试异步检索：结果与同步检索一致，FAISS检索不在事件循环线程中执行"""
+    knowledge_base = ComplianceKnowledgeBase(CountingEmbeddings())
+    knowledge_base.build_knowledge_base_from_text(REVIEW_GUIDE)
+    search_threads = []
+    filtered_search = knowledge_base._filtered_search
+    
+    def record_thread(*args, **kwargs):
+        search_threads.append(threading.get_ident())
+        return filtered_search(*args, **kwargs)
+    
+    knowledge_base._filtered_search = record_thread
+    expected = knowledge_base.search_compliance_rules("生发", k=10, product="蓬蓬瓶")
+    docs = asyncio.run(knowledge_base.asearch_compliance_rules("生发", k=10, product="蓬蓬瓶"))
+    assert [doc.page_content for doc in docs] == [doc.page_content for doc in expected]
+    assert search_threads[0] == threading.get_ident() and search_threads[1] != threading.get_ident()
+
+def test_areview(workdir):
+    """测试异步审查：并发审查多条文本，结果与同步审查一致，重复文本命中结果缓存"""
+    llm = FakeChatLLM(delay=0.05)
+    agent = make_review_agent(llm)
+    texts = ["【多肽蓬蓬瓶】能根治脱发", "【多肽蓬蓬瓶】生发效果好", "【多肽蓬蓬瓶】温和清洁", "【多肽蓬蓬瓶】立竿见影"]
+    
+    async def review_all():
+        return await asyncio.gather(*(agent.areview(text) for text in texts))
+    
+    outputs = asyncio.run(review_all())
+    print(f"异步审查最大并发LLM请求: {llm.max_active}")
+    assert llm.max_active == len(texts)
+    assert "| 拒绝 | 根治 |" in outputs[0] and "安全通过" in outputs[2]
+    assert outputs == [agent._perform_compliance_review(text) for text in texts]
+    assert len(llm.prompts) == len(texts)
+    assert asyncio.run(agent.areview("   ")) == "错误：没有提供有效的文本或图片输入"
+
+def test_aextract_text_from_image(vlm_server):
+    """测试异步OCR：并发识别复用连接池，异步客户端不跨事件循环复用，事件循环结束时关闭"""
+    processor = ImageProcessor()
+    for i in range(4):
+        with open(f"detail_{i}.jpg", "wb") as f:
+            f.write(f"fake-image-{i}".encode())
+    
+    async def extract_all():
+        return await asyncio.gather(*(processor.aextract_text_from_image(f"detail_{i}.jpg") for i in range(3)))
+    
+    assert asyncio.run(extract_all()) == ["修护精华 温和不刺激"] * 3
+    first_client = processor._async_client
+    assert first_client.is_closed
+    assert asyncio.run(processor.aextract_text_from_image("detail_0.jpg")) == "修护精华 温和不刺激"
+    assert processor.get_stats()["requests"] == 3 and processor.ocr_cache.get_stats()["exact_hits"] == 1
+    
+    # 新的事件循环创建新的客户端；未结束的事件循环上的客户端由close()关闭
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(processor.aextract_text_from_image("detail_3.jpg")) == "修护精华 温和不刺激"
+    second_client = processor._async_client
+    assert second_client is not first_client and not second_client.is_closed
+    processor.close()
+    assert second_client.is_closed and processor._async_client is None
+    loop.close()
+
+def test_areview_with_image(vlm_server):
+    """测试异步图文审查：OCR与文本预处理并发执行，结果与同步审查一致"""
+    agent = make_review_agent(FakeChatLLM())
+    with open("detail.jpg", "wb") as f:
+        f.write(b"fake-image")
+    
+    output = asyncio.run(agent.areview_with_image("【多肽蓬蓬瓶】能根治脱发", "detail.jpg"))
+    print(output)
+    assert "完整输入: 【多肽蓬蓬瓶】能根治脱发 修护精华 温和不刺激" in output
+    assert "| 拒绝 | 根治 |" in output
+    assert output == agent.review_with_image("【多肽蓬蓬瓶】能根治脱发", "detail.jpg")
+    assert asyncio.run(agent.areview_with_image("", "detail.txt")) == "错误：没有提供有效的文本或图片输入"
+    agent.knowledge_base.document_uploader.image_processor.close()
+
+def test_single_pass_response_parsing(workdir):
+    """测试单次调用响应解析：带或不带代码块的JSON、缺少产品名、响应格式错误时的降级"""
+    agent = make_review_agent(FakeChatLLM())
+    matcher = agent.matcher
+    violation = {"hit_word": "根治", "risk_category": "绝对化", "risk_level": "绝对禁止",
+                 "rule_source": "通用禁用原则", "brief_description": "绝对化用语"}
+    
+    def respond(content, text="能根治脱发", product_hint=""):
+        matcher.llm = FakeChatLLM(content=content)
+        return matcher.match_compliance_rules_single_pass(text, product_hint)
+    
+    # 代码块包裹的JSON，产品名由LLM识别
+    payload = json.dumps({"product_name": "多肽蓬蓬瓶", "violations": [violation]}, ensure_ascii=False)
+    results = respond(f"```json\n{payload}\n```")
+    assert (results[0].category, results[0].review_result, results[0].hit_word) == ("多肽蓬蓬瓶", "拒绝", "根治")
+    
+    # 未包裹的JSON，本地产品名提示优先
+    results = respond(payload, product_hint="洗发水")
+    assert results[0].category == "洗发水" and results[0].hit_word == "根治"
+    
+    # 缺少产品名或LLM未识别时品类为空
+    assert respond(json.dumps({"violations": []}))[0].category == ""
+    assert respond(json.dumps({"product_name": "未识别", "violations": []}))[0].review_result == "安全通过"
+    
+    # 非JSON响应使用词库扫描；结构不符时返回分析失败的默认结果（不写入缓存）
+    assert respond("根治属于违规词")[0].analysis_error == ""
+    failed = respond(json.dumps({"product_name": "多肽蓬蓬瓶"}))
+    assert failed[0].review_result == "安全通过" and failed[0].analysis_error
+    assert respond(json.dumps(["根治"]))[0].analysis_error
+
+def test_areview_single_pass_override(workdir):
+    """测试异步审查的单次调用模式开关：参数优先于Agent配置"""
+    llm = FakeChatLLM()
+    agent = make_review_agent(llm, single_pass=False)
+    text = agent.preprocessor.preprocess("能根治脱发")
+    
+    results = asyncio.run(agent._areview_processed_text(text, single_pass=True))
+    assert len(llm.prompts) == 1 and "产品名称提示" in llm.prompts[0]
+    assert results[0].hit_word == "根治"
+    asyncio.run(agent._areview_processed_text(text))
+    assert "产品名称提示" not in llm.prompts[-1]
+    
+    agent.single_pass = True
+    asyncio.run(agent._areview_processed_text(text, single_pass=False))
+    assert "产品名称提示" not in llm.prompts[-1]
+
+def test_compare_review_modes(workdir, monkeypatch, capsys):
+    """测试两种审查模式对比报告与对比脚本"""
+    import compare_review_modes
+    
+    agent = make_review_agent(FakeChatLLM())
+    texts = ["【多肽蓬蓬瓶】能根治脱发", "【多肽蓬蓬瓶】温和清洁"]
+    report = agent.compare_review_modes(texts)
+    assert report["verdict_agreement"] == 1.0 and report["product_agreement"] == 1.0
+    assert [item["two_call"]["rejected"] for item in report["items"]] == [True, False]
+    assert report["items"][0]["single_pass"]["hit_words"] == ["根治"]
+    assert set(report["latency"]) == {"two_call", "single_pass"}
+    
+    # 脚本从文件读取待审查文本
+    with open("texts.txt", "w", encoding="utf-8") as f:
+        f.write("\n".join(texts) + "\n\n")
+    monkeypatch.setattr(compare_review_modes, "ComplianceAgent", lambda gating: agent)
+    monkeypatch.setattr("sys.argv", ["compare_review_modes.py", "texts.txt"])
+    compare_review_modes.main()
+    output = capsys.readouterr().out
+    assert "对比 2 条文本" in output and "审核结论一致率: 100.0%" in output
+
 if __name__ == "__main__":
     # 运行所有测试
     test_built_in_knowledge_base()
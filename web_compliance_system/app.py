@@ -17,6 +17,7 @@ app.secret_key = 'spes_compliance_2024'
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'webp'}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
+MAX_BATCH_SIZE = 100  # 批量审查单次最多条数
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
@@ -111,6 +112,37 @@ def review_content():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/review_batch', methods=['POST'])
+def review_batch():
+    """批量合规审查API"""
+    if not agent:
+        return jsonify({"error": "系统未初始化"}), 500
+    
+    try:
+        data = request.get_json()
+        texts = data.get('texts', [])
+        
+        if not isinstance(texts, list) or not texts:
+            return jsonify({"error": "请提供待审查的文本列表"}), 400
+        
+        if len(texts) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"单次最多审查 {MAX_BATCH_SIZE} 条文本"}), 400
+        
+        # 执行批量审查，结果与输入顺序一致
+        results = agent.review_batch([str(text) for text in texts])
+        
+        return jsonify({
+            "success": True,
+            "count": len(results),
+            "results": [
+                {"input_text": text, "result": result}
+                for text, result in zip(texts, results)
+            ]
+        })
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     """文件上传API"""
@@ -173,8 +205,57 @@ def reload_document():
         return jsonify({"error": "系统未初始化"}), 500
     
     try:
-        result = agent.reload_document()
-        return jsonify({"success": True, "message": result})
+        # 后台重建，新版本就绪后原子切换，进行中的审查继续使用旧版本
+        job = agent.start_reload_document()
+        return jsonify({"success": True, **job.to_dict()}), 202
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/reload/<job_id>')
+def reload_progress(job_id):
+    """查询重新加载任务进度"""
+    if not agent:
+        return jsonify({"error": "系统未初始化"}), 500
+    
+    job = agent.get_reload_job(job_id)
+    if not job:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify({"success": True, **job.to_dict()})
+
+@app.route('/api/snapshots')
+def list_snapshots():
+    """列出知识库快照"""
+    if not agent:
+        return jsonify({"error": "系统未初始化"}), 500
+    
+    try:
+        return jsonify({"success": True, "snapshots": agent.list_snapshots()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/snapshots/<snapshot_id>/activate', methods=['POST'])
+def activate_snapshot(snapshot_id):
+    """切换到指定知识库快照"""
+    if not agent:
+        return jsonify({"error": "系统未初始化"}), 500
+    
+    try:
+        return jsonify({"success": True, "snapshot": agent.activate_snapshot(snapshot_id)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/snapshots/rollback', methods=['POST'])
+def rollback_snapshot():
+    """回滚到上一个知识库快照"""
+    if not agent:
+        return jsonify({"error": "系统未初始化"}), 500
+    
+    try:
+        return jsonify({"success": True, "snapshot": agent.rollback_snapshot()})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
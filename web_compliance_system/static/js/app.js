@@ -283,13 +283,30 @@ async function reloadDocument() {
     
     try {
         const response = await fetch('/api/reload');
-        const data = await response.json();
+        let data = await response.json();
         
-        if (response.ok) {
+        if (!response.ok) {
+            showError('重新加载失败: ' + data.error);
+            return;
+        }
+        
+        // 后台任务，轮询进度直到完成
+        while (data.status === 'pending' || data.status === 'running') {
+            document.getElementById('loadingText').textContent = `正在重新加载文档... ${Math.round(data.progress * 100)}%`;
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const progressResponse = await fetch(`/api/reload/${data.job_id}`);
+            data = await progressResponse.json();
+            if (!progressResponse.ok) {
+                showError('重新加载失败: ' + data.error);
+                return;
+            }
+        }
+        
+        if (data.status === 'succeeded') {
             showSuccess(data.message);
             checkStatus(); // 刷新状态
         } else {
-            showError('重新加载失败: ' + data.error);
+            showError('重新加载失败: ' + data.message);
         }
     } catch (error) {
         console.error('重新加载错误:', error);